@@ -3,49 +3,108 @@ import gtk
 
 from logging import debug
 
-class AcceptHelpDialog():
+from twisted.internet import reactor, defer
+
+#how long the cascader has to answer a request before it is rejected. This
+#should be less than the time the server gives each cascader to answer
+#before passing the request on, so the cascader can't accept a request that
+#has already gone to someone else
+ACCEPT_TIMEOUT_SECS = 50
+
+class HelpRequest(object):
+    ''' A request for help that is waiting for the cascader to answer '''
+    def __init__(self, username, subject, description):
+        self.username = username
+        self.subject = subject
+        self.description = description
+        self.deferred = defer.Deferred()
+        self.timeoutCall = None
+
+class AcceptHelpPanel():
     '''
-    This is the dialog that comes up asking if the cascader wants to accept
-    the help from the user. This is relativly dumb class
+    This is the window that comes up asking if the cascader wants to accept
+    help from users. It isn't modal, so the rest of the program (and the
+    connection to the server) carries on while the cascader decides.
+
+    Requests are queued and shown one at a time. Each request has a deferred
+    that fires with (accepted, reason) when the cascader answers or when the
+    request times out.
 
     It is used by the CascaderFrame class
     '''
 
-    def __init__(self, parentWindow, username, subject, description):
-        builder = gtk.Builder()
+    def __init__(self, parentWindow, timeout=ACCEPT_TIMEOUT_SECS):
+        self.builder = builder = gtk.Builder()
+        self.timeout = timeout
 
         dr = os.path.dirname(__file__)
         builder.add_from_file(os.path.join(dr, 'gui', 'helpacceptreject.glade'))
 
         self.window = builder.get_object('dgHelpAcceptReject')
+        self.window.set_modal(False)
         if parentWindow is not None:
             self.window.set_transient_for(parentWindow)
         pixbuf = gtk.gdk.pixbuf_new_from_file(os.path.join(dr, 'icons', 'cascade.ico'))
         self.window.set_icon(pixbuf)
-
-        heading = '%s is wanting help on %s' % (username, subject)
-        builder.get_object('lbUserInfo').set_label(heading)
-        builder.get_object('lbDesc').set_label(description)
+        self.window.connect('delete-event', self._onDelete)
         builder.connect_signals(self)
 
-        self.accept = True
+        self.queue = []
+
+    def _showNext(self):
+        ''' Shows the request at the front of the queue, or hides if none '''
+        if not len(self.queue):
+            self.window.hide()
+            return
 
+        request = self.queue[0]
+        heading = '%s is wanting help on %s' % (request.username,
+                                                request.subject)
+        self.builder.get_object('lbUserInfo').set_label(heading)
+        self.builder.get_object('lbDesc').set_label(request.description)
+
+        title = 'Help request'
+        if len(self.queue) > 1:
+            title += ' (%d more waiting)' % (len(self.queue) - 1)
+        self.window.set_title(title)
         self.window.show_all()
-        self.window.run()
+
+    def _answer(self, request, accept, why=''):
+        self.queue.remove(request)
+        if request.timeoutCall.active():
+            request.timeoutCall.cancel()
+        self._showNext()
+        request.deferred.callback((accept, why))
+
+    def _onTimeout(self, request):
+        debug('Help request from %s timed out' % request.username)
+        self._answer(request, False, 'The cascader didn\'t respond')
 
     def _onReject(self, e):
-        self.accept = False
-        self.window.destroy()
+        if len(self.queue):
+            self._answer(self.queue[0], False)
 
     def _onAccept(self, e):
         debug('Cascader accepted')
-        self.accept = True
-        self.window.destroy()
+        if len(self.queue):
+            self._answer(self.queue[0], True)
+
+    def _onDelete(self, window, event):
+        ''' Closing the window rejects the current request '''
+        self._onReject(None)
+        return True
 
     #--------------------------------------------------------------------------
     # Functions for external use
 
-    def isAccept(self):
-        return self.accept
-
-
+    def add(self, username, subject, description):
+        '''
+        Queues a help request, returning a deferred that fires with a tuple
+        of (accepted, reason)
+        '''
+        request = HelpRequest(username, subject, description)
+        request.timeoutCall = reactor.callLater(self.timeout,
+                                                self._onTimeout, request)
+        self.queue.append(request)
+        self._showNext()
+        return request.deferred
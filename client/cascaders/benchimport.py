@@ -0,0 +1,86 @@
+#!/usr/bin/python -O
+
+'''
+Guards the core package. Each core module is imported in a fresh
+interpreter, timing how long the import takes and checking that no gui
+module was pulled in along the way. Exits with a non zero status if any
+module imports a gui module or takes longer than --max-secs, so it can be
+run after changes to the core package:
+    python benchimport.py
+'''
+import os
+import subprocess
+import sys
+from optparse import OptionParser
+
+CORE_MODULES = ('cascaders.core.callbacks',
+                'cascaders.core.cascadersdata',
+                'cascaders.core.locator',
+                'cascaders.core.tracing',
+                'cascaders.core.client',
+                'cascaders.core.service')
+
+#modules that must never be imported by the core package
+GUI_MODULES = ('gtk', 'gobject', 'pygtk', 'glib', 'cairo', 'pango', 'dbus')
+
+#the default limit is generous as most of the time is importing twisted,
+#it is there to catch a heavy import creeping in rather than to measure
+MAX_IMPORT_SECS = 1.0
+
+#run in the child interpreter, prints the seconds taken and any gui
+#modules that were imported
+CHILD = '''
+import sys, time
+start = time.time()
+__import__(%r)
+secs = time.time() - start
+print secs
+print ' '.join(m for m in %r if m in sys.modules)
+'''
+
+def timeImport(module, python=sys.executable):
+    '''
+    Returns the seconds taken to import the module in a new interpreter and
+    the list of gui modules that it imported
+    '''
+    clientDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    p = subprocess.Popen([python, '-c', CHILD % (module, GUI_MODULES)],
+                         cwd=clientDir,
+                         stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise ImportError('Failed to import %s:\n%s' % (module, err))
+    lines = out.splitlines()
+    return float(lines[0]), lines[1].split()
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-n', '--repeat', type='int', default=3,
+                      help='number of times to import each module, the best '
+                           'time is used (default 3)')
+    parser.add_option('', '--max-secs', type='float', default=MAX_IMPORT_SECS,
+                      help='fail if a module takes longer than this to import')
+    (options, args) = parser.parse_args()
+
+    failed = False
+    for module in CORE_MODULES:
+        try:
+            results = [timeImport(module) for _ in range(options.repeat)]
+        except ImportError as e:
+            print e
+            failed = True
+            continue
+
+        secs = min(s for s, _ in results)
+        guiModules = results[0][1]
+        status = 'ok'
+        if guiModules:
+            status = 'FAIL imports ' + ', '.join(guiModules)
+            failed = True
+        elif secs > options.max_secs:
+            status = 'FAIL slower than %.3fs' % options.max_secs
+            failed = True
+        print '%-35s %8.3fs  %s' % (module, secs, status)
+
+    sys.exit(1 if failed else 0)
@@ -4,12 +4,12 @@ the model for the main interaction with the server. The main class that
 should be used is the CascaderModel class. The other classes are mainly
 helper classes
 '''
-from logging import debug, warn, error
+from logging import debug, warn
 
-import service
-import client
-
-from util import CallbackMixin
+from core import service
+from core import client
+from core.callbacks import CallbackMixin
+from core.cascadersdata import CascadersData
 
 #-------------------------------------------------------------------------------
 #constants
@@ -17,145 +17,6 @@ PORT = 5010
 HOST = 'www.comp-soc.com'
 #-------------------------------------------------------------------------------
 
-class CascadersData(object):
-    ''' Manages the list of cascaders and provides lookup functions '''
-
-    def __init__(self, locator, username):
-        '''
-        locator is a object that implements labFromHostname.
-
-        username -  the current users username. This is (optionally) excluded
-        from results so that you are never displayed as a cascader
-        '''
-        self.locator = locator
-        self.username = username
-        self.cascaders = {}
-
-    def __str__(self):
-        return str(self.cascaders)
-
-    def addCascader(self, username, host, subjects):
-        '''
-        >>> cd = CascadersData(None, 'me')
-        >>> cd.addCascader('remote', 'remotehost', ['subject'])
-        >>> cd.findCascader(username='remote')
-        ('remote', ('remotehost', set(['subject'])))
-
-        Key is on the username...
-        >>> cd = CascadersData(None, 'me')
-        >>> cd.addCascader('remote', 'remotehost', ['subject'])
-        >>> cd.addCascader('remote', 'otherhost', ['subject'])
-        >>> cd.findCascader(username='remote')
-        ('remote', ('otherhost', set(['subject'])))
-
-        Subjects are a set
-        >>> cd = CascadersData(None, 'me')
-        >>> cd.addCascader('remote', 'remotehost', ['a', 'a', 'b'])
-        >>> cd.findCascader(username='remote')
-        ('remote', ('remotehost', set(['a', 'b'])))
-        '''
-        try:
-            _, curSubjects = self.cascaders[username]
-            self.cascaders[username] = (host, set(subjects) | curSubjects)
-        except KeyError:
-            self.cascaders[username] = (host, set(subjects))
-
-    def removeCascader(self, username):
-        try:
-            del self.cascaders[username]
-        except KeyError:
-            warn('Cascader that left didn\'t exist')
-
-    def addCascaderSubjects(self, username, subjects):
-        '''
-        Adding the same subject again is fine
-        >>> cd = CascadersData(None, 'me')
-        >>> cd.addCascader('remote', 'remotehost', ['a'])
-        >>> cd.addCascaderSubjects('remote', ['a'])
-        >>> cd.findCascader(username='remote')
-        ('remote', ('remotehost', set(['a'])))
-
-        >>> cd = CascadersData(None, 'me')
-        >>> cd.addCascader('remote', 'remotehost', [])
-        >>> cd.addCascaderSubjects('remote', ['a'])
-        >>> cd.findCascader(username='remote')
-        ('remote', ('remotehost', set(['a'])))
-        '''
-        try:
-            host, curSubjects = self.cascaders[username]
-            self.cascaders[username] = (host, curSubjects | set(subjects))
-        except KeyError:
-            warn('Cascader (%s) that added subjects '
-                 'didn\'t exist' % username)
-            self.cascaders[username] = (None, set(subjects))
-
-    def removeCascaderSubjects(self, username, subjects):
-        debug('Cascader %s removed subjects %s' % (username, subjects))
-        try: 
-            host, curSubjects = self.cascaders[username]
-            self.cascaders[username] = host, curSubjects - set(subjects)
-        except KeyError:
-            warn('Tried to remove subjects from cascader %s, '
-                 'prob not cascading' % username)
-
-    def findCascaders(self, lab=None, subjects=None, host=None,
-                            includeMe=False):
-        '''
-        Find all cascaders that match the given patterns, although
-        this will not return any cascaders that are not cascading in 
-        any subjects
-
-        includeMe - Include the user (if the user is cascading) in results
-
-        TODO really slow, not sure it matters
-
-        >>> cd = CascadersData(None, 'me')
-        >>> cd.addCascader('remote', 'remotehost', [])
-        >>> cd.findCascader(username='remote')
-        '''
-        for user, (cascHost, cascSubjects) in self.cascaders.iteritems():
-            if len(cascSubjects) == 0:
-                continue
-
-            if includeMe == False and user == self.username:
-                continue
-
-            if host and host != cascHost:
-                continue
-
-            if lab and self.locator.labFromHostname(cascHost) != lab:
-                continue
-
-            if (subjects and
-                    len(set(subjects).intersection(set(cascSubjects))) == 0):
-                continue
-
-            yield user, (host, cascSubjects)
-
-    def findCascader(self, username=None, includeMe=False, **kwargs):
-        ''' Wrapper around findCascaders, returns the first match or None '''
-        if username is not None:
-            if len(kwargs):
-                error('Username not supported with other args')
-                return None
-            try:
-                host, subjects = self.cascaders[username]
-                if len(subjects) == 0: 
-                    return None
-                if includeMe == False and username == self.username:
-                    return None
-                return username, (host, subjects)
-            except KeyError:
-                warn('Couldn\'t find cascader with username: ' % username)
-                return None
-
-        try:
-            return self.findCascaders(includeMe=includeMe, **kwargs).next()
-        except StopIteration:
-            return None
-
-#-------------------------------------------------------------------------------
-
 class CascaderModel(CallbackMixin):
     '''
     This is the model for the main interface, it holds and provides most of the
@@ -180,6 +41,8 @@ class CascaderModel(CallbackMixin):
         s.registerOnCascaderJoined(self._onCascaderJoined)
         s.registerOnCascaderLeft(self._onCascaderLeft)
 
+        s.registerOnPresenceChanged(self._onPresenceChanged)
+
         s.registerUserAskingForHelp(self._onUserAskingForHelp)
 
         self.registerOnLogin(self._onLogin)
@@ -188,6 +51,18 @@ class CascaderModel(CallbackMixin):
         self.cascadeSubjects = set()
         self.cascading = False
 
+        #the labs and subjects the server sends updates for, None is all
+        self.filterLabs = None
+        self.filterSubjects = None
+
+        #the presence version that the cascader data is at. This is None
+        #until the first sync with the server
+        self.epoch = None
+        self.version = None
+        #true when waiting for a sync, changes are ignored while this is set
+        #as the sync result will include them
+        self.syncing = False
+
         self.username = username
         self.hostname = hostname
 
@@ -237,6 +112,33 @@ class CascaderModel(CallbackMixin):
         self.cascaders.removeCascader(username)
         self._callCallbacks('cascaderschanged', self.cascaders)
 
+    def _onPresenceChanged(self, batch):
+        '''
+        Applies a batch of changes from the server, only updating the
+        listeners once for the whole batch. If the batch doesn't follow on
+        from the version we have then we have missed something so resync
+        '''
+        debug('Presence changed: %s' % str(batch))
+        if self.syncing or self.version is None:
+            debug('Ignoring presence change while syncing')
+            return
+        if batch['since'] != self.version:
+            warn('Missed presence changes (at %s, batch from %s), '
+                 'resyncing' % (self.version, batch['since']))
+            self.resync()
+            return
+
+        self._setVersion(self.epoch, batch['version'])
+        for username in batch['left']:
+            self.cascaders.removeCascader(username)
+        for username, hostname, subjects in batch['joined']:
+            self.cascaders.setCascader(username, hostname, subjects)
+        for username, subjects in batch['added']:
+            self.cascaders.addCascaderSubjects(username, subjects)
+        for username, subjects in batch['removed']:
+            self.cascaders.removeCascaderSubjects(username, subjects)
+        self._callCallbacks('cascaderschanged', self.cascaders)
+
     def _onUserAskingForHelp(self,  helpid, username, host,
                             subject, description):
         result = self._callCallbacks('userasking', helpid, username,
@@ -265,30 +167,82 @@ class CascaderModel(CallbackMixin):
             self.subjects = set([x for x in result])
             self._callCallbacks('subjectschanged', self.subjects)
 
-        def casc(result):
-            debug('Got cascaders from login: %s' % str(result))
-            for usr, host, sub in result:
-                self.cascaders.addCascader(usr, host, sub)
-            self._callCallbacks('cascaderschanged', self.cascaders)
-
         sl = lambda *a: self.client.getSubjectList().addCallback(subject)
-        cl = lambda *a: self.client.getCascaderList().addCallback(casc)
 
+        #the cascaders are synced by _onLogin
         d = self.client.login()
-        d.addCallback(cl)
         d.addCallback(sl)
 
         return d
 
-    def _onLogin(self, *a):
+    def _sync(self, d):
+        '''
+        Sets things up so that changes are ignored until the sync result in
+        the given deferred has been applied
+        '''
+        def onErr(reason):
+            self.syncing = False
+            return reason
+
+        self.syncing = True
+        d.addCallback(self._applySync)
+        d.addErrback(onErr)
+        return d
+
+    def _applySync(self, result):
+        '''
+        Applies the result of a sync with the server (see syncSince on the
+        server) to the cascader data
+        '''
+        debug('Got cascaders: %s' % str(result))
+        if result['snapshot']:
+            self.cascaders.clear()
+        for username in result['left']:
+            if self.cascaders.hasCascader(username):
+                self.cascaders.removeCascader(username)
+        for usr, host, sub in result['cascaders']:
+            self.cascaders.setCascader(usr, host, sub)
+
+        self._setVersion(result['epoch'], result['version'])
+        self.syncing = False
+        self._callCallbacks('cascaderschanged', self.cascaders)
+
+    def _setVersion(self, epoch, version):
+        ''' The client needs the version too so it can resume from it '''
+        self.epoch = epoch
+        self.version = version
+        self.client.setVersion(epoch, version)
+
+    def resync(self):
+        ''' Gets the changes we have missed from the server '''
+        return self._sync(self.client.syncSince(self.epoch, self.version))
+
+    def setFilter(self, labs, subjects):
         '''
-        This tries for force everything to the way it was before
-        the server disconnected
+        Sets the labs and subjects that we are interested in, None meaning
+        all of them. The server then only sends changes about the cascaders
+        that match, so the cascader data only holds those cascaders
         '''
+        self.filterLabs = labs
+        self.filterSubjects = subjects
+        return self._sync(self.client.subscribe(labs, subjects))
+
+    def _onLogin(self, result):
+        '''
+        If the server resumed our old session it still has our subjects and
+        cascading state and has sent the changes we missed, so they just
+        need applying. Otherwise this tries to force everything to the way
+        it was before the server disconnected and gets the cascaders again
+        '''
+        if result['resumed']:
+            debug('Resumed the old session')
+            self._applySync(result['sync'])
+            return
+
         debug('Now logged in, trying to restore settings')
-        if self.isCascading():
-            self.startCascading()
-        self.addSubjects(self.cascadeSubjects)
+        self.client.setState(self.cascading, self.cascadeSubjects)
+        self._sync(self.client.subscribe(self.filterLabs, self.filterSubjects,
+                                         self.epoch, self.version))
 
     #--------------------------------------------------------------------------
     def isCascading(self):
@@ -323,6 +277,12 @@ class CascaderModel(CallbackMixin):
     def askForHelp(self, helpid, username, subject, problem):
         return self.client.askForHelp(helpid, username, subject, problem)
 
+    def registerOnHelpProgress(self, helpid, function):
+        self.service.registerOnHelpProgress(helpid, function)
+
+    def unregisterOnHelpProgress(self, helpid):
+        self.service.unregisterOnHelpProgress(helpid)
+
     def sendMessage(self, helpid, toUsername, message):
         '''
         This shouldn't really be here I don't think. It isn't abstract enough
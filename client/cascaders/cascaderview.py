@@ -16,7 +16,8 @@ from twisted.internet import reactor
 import twisted.internet.error
 
 #rpc
-import client, service
+from core import client, service
+from core.locator import Locator
 
 import labmap
 import settings
@@ -24,9 +25,10 @@ import settings
 from cascadermodel import CascaderModel
 
 from requirements import RequireFunctions
+from core.tracing import trace
 
 #message boxes
-from accepthelp import AcceptHelpDialog
+from accepthelp import AcceptHelpPanel
 from askdialog import AskForHelp
 from messagedialog import MessageDialog
 
@@ -35,6 +37,16 @@ from trayicon import TrayIcon
 import util
 from util import getComboBoxText, initTreeView, errorDialog
 
+#what the user asking for help is shown as the server passes their request
+#between cascaders. The server sends a message once it is accepted or
+#given up on
+HELP_PROGRESS_MESSAGES = {
+    'queued' : 'No cascader is free, waiting (%(position)d in the queue)...',
+    'asking' : 'Asking %(cascader)s...',
+    'noAnswer' : '%(cascader)s didn\'t answer',
+    'rejected' : '%(cascader)s rejected your help request',
+}
+
 #-------------------------------------------------------------------------------
 class CascadersFrame:
     def __init__(self, debugEnabled=False, show=True, host=None):
@@ -48,7 +60,7 @@ class CascadersFrame:
 
 
         hosts = os.path.join(os.path.dirname(__file__), 'data', 'hosts')
-        self.locator = labmap.Locator(open(hosts))
+        self.locator = Locator(open(hosts))
         self.username = self._getUsername()
 
 
@@ -60,12 +72,18 @@ class CascadersFrame:
         self.model = CascaderModel(self.locator, self.username, self.hostname)
         self.messageDialog = MessageDialog(self.locator, self.model.getCascaderData())
 
+        #helpid -> the username messages in that conversation are sent to.
+        #This changes if the server passes a request for help on to another
+        #cascader
+        self.messageRecipients = {}
+
         #slightly more sane method of setting things up that uses depency
         #tracking
         req = RequireFunctions()
         req.add('gui', self.initGui)
         req.add('tray', self.initTray, ['gui'])
         req.add('map', self.initMap, ['gui'])
+        req.add('helppanel', self.initHelpPanel, ['gui'])
         req.add('labs', self.initLabs, ['map'])
         req.add('modelcallbacks', self.initModelCallbacks)
         req.add('connection', self.initConnection)
@@ -92,10 +110,13 @@ class CascadersFrame:
             message.destroy()
 
     def initMap(self):
-        self.map = labmap.Map(self.builder.get_object('tblMap'),
+        self.map = labmap.Map(self.builder.get_object('daMap'),
                               self.locator,
                               self.model.getCascaderData())
 
+    def initHelpPanel(self):
+        self.helpPanel = AcceptHelpPanel(self.window)
+
     def initTray(self):
         icon = os.path.join(os.path.dirname(__file__),
                             'icons',
@@ -170,7 +191,9 @@ class CascadersFrame:
         '''
         This sets up the service callbacks
         '''
-        self.model.registerOnCascaderChanged(self.updateCascaderLists)
+        #cascader changes can come in bursts, so only redraw once a frame
+        self.cascaderUpdates = util.UpdateScheduler(self.onCascadersChanged)
+        self.model.registerOnCascaderChanged(self.cascaderUpdates.schedule)
         self.model.registerOnSubjectChanged(self.updateAllSubjects)
         self.model.registerOnUserAskingForHelp(self.onUserAskingForHelp)
 
@@ -230,6 +253,7 @@ class CascadersFrame:
         '''
         self.messageDialog.addTab(helpid, toUsername,
                                   self.hostname, remoteHost, isUserCasc)
+        self.messageRecipients[helpid] = toUsername
 
         #setup functions to write to the messages from the message dialog to
         #the server
@@ -256,7 +280,8 @@ class CascadersFrame:
             return reason
 
         def writeFunction(message):
-            d = self.model.sendMessage(helpid, toUsername, message)
+            d = self.model.sendMessage(helpid, self.messageRecipients[helpid],
+                                       message)
             d.addErrback(badHelpidError)
             d.addErrback(writeError)
 
@@ -272,21 +297,33 @@ class CascadersFrame:
                             subject, description):
         '''
         Called from the server to the client cascader to see if help can
-        be accepted
+        be accepted. This returns a deferred that fires when the cascader
+        answers, so the server isn't held up while the panel is shown
         '''
         debug('Help wanted by: %s with host %s' % (username, host))
 
-        dialog = AcceptHelpDialog(self.window, username, subject, description)
+        d = self.helpPanel.add(username, subject, description)
 
-        #check if user can give help
-        if dialog.isAccept():
-            debug('Help Accepted')
-            self.setupMessagingWindow(helpid, username, host, True)
-            return (True, '')
+        def onAnswer(result):
+            accepted, why = result
+            trace(helpid, 'client.userAskingForHelp.answered',
+                  accepted=accepted)
+            if accepted:
+                debug('Help Accepted')
+                self.setupMessagingWindow(helpid, username, host, True)
+            else:
+                debug('Help rejected')
+            return result
+        return d.addCallback(onAnswer)
 
-        debug('Help rejected')
-        return (False, '')
 
+    def onCascadersChanged(self, cascaders):
+        '''
+        Updates the list and the map, the map only redraws the hosts that
+        have changed
+        '''
+        self.updateCascaderLists(cascaders)
+        self.updateMap(getComboBoxText(self.builder.get_object('cbFilterLab')))
 
     #--------------------------------------------------------------------------
     def updateAllSubjects(self, subjects):
@@ -314,15 +351,11 @@ class CascadersFrame:
         cb.pack_start(cell, True)
         cb.add_attribute(cell, 'text', 0)
 
-    def updateCascaderLists(self, cascaders):
+    def _getFilters(self):
         '''
-        Cleans the list and updates the list of cascaders avaible. Call
-        when filters have been changed
+        Returns the lab and the list of subjects that are selected in the
+        filters, either will be None if all are selected
         '''
-
-        ls = self.builder.get_object('lsCascList')
-        ls.clear()
-
         cbSubjects = self.builder.get_object('cbFilterSubject')
         filterSub = getComboBoxText(cbSubjects)
         filterSub = [filterSub] if filterSub != 'All'  else None
@@ -330,11 +363,43 @@ class CascadersFrame:
         cbLab = self.builder.get_object('cbFilterLab')
         filterLab = getComboBoxText(cbLab)
         filterLab = filterLab if filterLab != 'All' else None
+        return filterLab, filterSub
+
+    def updateSubscription(self):
+        '''
+        Tells the server which cascaders we are interested in, so it doesn't
+        send us changes for cascaders the filters would hide
+        '''
+        filterLab, filterSub = self._getFilters()
+        labs = [filterLab] if filterLab is not None else None
+        self.model.setFilter(labs, filterSub)
 
-        cascaders = list(cascaders.findCascaders(lab=filterLab,
-                                                 subjects=filterSub))
-        [ls.append([username]) for username, _ in cascaders]
-        debug('Updating cascaders from: %s' % str(cascaders))
+    def updateCascaderLists(self, cascaders):
+        '''
+        Updates the list of cascaders avaible. Call when filters have been
+        changed. Rather than clearing the list, this only removes and adds
+        the rows that have changed
+        '''
+
+        ls = self.builder.get_object('lsCascList')
+
+        filterLab, filterSub = self._getFilters()
+
+        wanted = set(username for username, _ in
+                     cascaders.findCascaders(lab=filterLab, subjects=filterSub))
+        debug('Updating cascaders to: %s' % str(wanted))
+
+        have = set()
+        itr = ls.get_iter_first()
+        while itr is not None:
+            username = ls.get_value(itr, 0)
+            if username in wanted and username not in have:
+                have.add(username)
+                itr = ls.iter_next(itr)
+            elif not ls.remove(itr): #remove moves itr on to the next row
+                itr = None
+
+        [ls.append([username]) for username in wanted - have]
 
     #--------------------------------------------------------------------------
     # GUI events
@@ -466,14 +531,34 @@ class CascadersFrame:
             writeSysMsg = lambda m: self.messageDialog.writeMessage(helpid, 'SYSTEM', m)
             writeSysMsg('Waiting for response...')
 
+            #nothing more is heard about the request once it has been
+            #answered or given up on
+            finished = lambda *a: self.model.unregisterOnHelpProgress(helpid)
+
+            def onAnswer(result):
+                finished()
+                return result
+
             def onNotConnected(reason):
                 reason.trap(client.ClientNotConnected)
+                finished()
                 writeSysMsg('Error: The client was not connected')
 
+            def onProgress(event, details):
+                if event == 'accepted':
+                    self.messageRecipients[helpid] = details['cascader']
+                msg = HELP_PROGRESS_MESSAGES.get(event)
+                if msg is not None:
+                    writeSysMsg(msg % details)
+                if event in ('accepted', 'gaveUp'):
+                    finished()
+            self.model.registerOnHelpProgress(helpid, onProgress)
+
             d = self.model.askForHelp(helpid,
                                       cascaderUsername,
                                       helpDialog.getSubject(),
                                       helpDialog.getDescription())
+            d.addCallback(onAnswer)
             d.addErrback(onNotConnected)
     
     def onAddSubject(self, event):
@@ -509,6 +594,7 @@ class CascadersFrame:
     def onFilterLabChange(self, evt):
         debug('Filter Lab Changed')
 
+        self.updateSubscription()
         self.updateCascaderLists(self.model.getCascaderData())
 
         cbLab = self.builder.get_object('cbFilterLab')
@@ -517,6 +603,7 @@ class CascadersFrame:
 
     def onFilterSubjectChange(self, evt):
         debug('Filter Subject Changed')
+        self.updateSubscription()
         self.updateCascaderLists(self.model.getCascaderData())
 
     def updateMap(self, lab):
@@ -0,0 +1,7 @@
+'''
+The parts of the client that don't need a gui: the rpc client and service,
+the model data and the host locator. Nothing in this package may import gtk
+or gobject (directly or through another module) so that it imports quickly
+and can be used headless, e.g. by the load generator. benchimport.py checks
+this.
+'''
@@ -0,0 +1,28 @@
+'''
+The callback registration shared by the model and the rpc classes
+'''
+from collections import defaultdict
+
+class CallbackMixin(object):
+    '''
+    Simple class that allows callbacks to be registed and called. For each
+    id it supports multiple callbacks
+    '''
+    def __init__(self):
+        self._callbacks = defaultdict(list)
+
+    def _addCallback(self, name, f):
+        self._callbacks[name].append(f)
+
+    def _removeCallbacks(self, name):
+        ''' Removes all the callbacks for the id '''
+        self._callbacks.pop(name, None)
+
+    def _callCallbacks(self, name, *args, **kwargs):
+        return [f(*args, **kwargs) for f in self._callbacks.get(name, [])]
+
+    def _numCallbacks(self, name):
+        try:
+            return len(self._callbacks[name])
+        except KeyError:
+            return 0
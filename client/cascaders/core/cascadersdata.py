@@ -0,0 +1,275 @@
+'''
+The list of cascaders known to the client along with the indexes used to
+look them up. This has no gui dependencies
+'''
+from logging import debug, warn, error
+from collections import defaultdict
+
+class CascadersData(object):
+    '''
+    Manages the list of cascaders and provides lookup functions
+
+    As well as the cascaders by username, this keeps indexes from host,
+    lab and subject to the cascaders so that lookups don't need to look at
+    every cascader. All changes must go through the methods of this class
+    so that the indexes are kept up to date
+    '''
+
+    def __init__(self, locator, username):
+        '''
+        locator is a object that implements labFromHostname.
+
+        username -  the current users username. This is (optionally) excluded
+        from results so that you are never displayed as a cascader
+        '''
+        self.locator = locator
+        self.username = username
+        self.cascaders = {}
+
+        self.byHost = {}
+        self.byLab = defaultdict(set)
+        self.bySubject = defaultdict(set)
+
+    def __str__(self):
+        return str(self.cascaders)
+
+    def _labFromHostname(self, host):
+        if self.locator is None or host is None:
+            return None
+        return self.locator.labFromHostname(host)
+
+    def _index(self, username):
+        host, subjects = self.cascaders[username]
+        if host is not None:
+            self.byHost[host] = username
+        self.byLab[self._labFromHostname(host)].add(username)
+        for subject in subjects:
+            self.bySubject[subject].add(username)
+
+    def _unindex(self, username):
+        try:
+            host, subjects = self.cascaders[username]
+        except KeyError:
+            return
+        if self.byHost.get(host) == username:
+            del self.byHost[host]
+        self._discard(self.byLab, self._labFromHostname(host), username)
+        for subject in subjects:
+            self._discard(self.bySubject, subject, username)
+
+    def _discard(self, index, key, username):
+        index[key].discard(username)
+        if not index[key]:
+            del index[key]
+
+    def _set(self, username, host, subjects):
+        self._unindex(username)
+        self.cascaders[username] = (host, subjects)
+        self._index(username)
+
+    def addCascader(self, username, host, subjects):
+        '''
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('remote', 'remotehost', ['subject'])
+        >>> cd.findCascader(username='remote')
+        ('remote', ('remotehost', set(['subject'])))
+
+        Key is on the username...
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('remote', 'remotehost', ['subject'])
+        >>> cd.addCascader('remote', 'otherhost', ['subject'])
+        >>> cd.findCascader(username='remote')
+        ('remote', ('otherhost', set(['subject'])))
+
+        Subjects are a set
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('remote', 'remotehost', ['a', 'a', 'b'])
+        >>> cd.findCascader(username='remote')
+        ('remote', ('remotehost', set(['a', 'b'])))
+        '''
+        try:
+            _, curSubjects = self.cascaders[username]
+            self._set(username, host, set(subjects) | curSubjects)
+        except KeyError:
+            self._set(username, host, set(subjects))
+
+    def setCascader(self, username, host, subjects):
+        '''
+        Unlike addCascader this replaces any existing host and subjects
+
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('remote', 'remotehost', ['a'])
+        >>> cd.setCascader('remote', 'otherhost', ['b'])
+        >>> cd.findCascader(username='remote')
+        ('remote', ('otherhost', set(['b'])))
+        >>> cd.findCascader(host='remotehost')
+        '''
+        self._set(username, host, set(subjects))
+
+    def hasCascader(self, username):
+        return username in self.cascaders
+
+    def clear(self):
+        ''' Removes all the cascaders '''
+        self.cascaders = {}
+        self.byHost = {}
+        self.byLab = defaultdict(set)
+        self.bySubject = defaultdict(set)
+
+    def removeCascader(self, username):
+        '''
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('remote', 'remotehost', ['a'])
+        >>> cd.removeCascader('remote')
+        >>> cd.findCascader(subjects=['a'])
+        '''
+        try:
+            self._unindex(username)
+            del self.cascaders[username]
+        except KeyError:
+            warn('Cascader that left didn\'t exist')
+
+    def addCascaderSubjects(self, username, subjects):
+        '''
+        Adding the same subject again is fine
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('remote', 'remotehost', ['a'])
+        >>> cd.addCascaderSubjects('remote', ['a'])
+        >>> cd.findCascader(username='remote')
+        ('remote', ('remotehost', set(['a'])))
+
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('remote', 'remotehost', [])
+        >>> cd.addCascaderSubjects('remote', ['a'])
+        >>> cd.findCascader(username='remote')
+        ('remote', ('remotehost', set(['a'])))
+        '''
+        try:
+            host, curSubjects = self.cascaders[username]
+            self._set(username, host, curSubjects | set(subjects))
+        except KeyError:
+            warn('Cascader (%s) that added subjects '
+                 'didn\'t exist' % username)
+            self._set(username, None, set(subjects))
+
+    def removeCascaderSubjects(self, username, subjects):
+        '''
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('remote', 'remotehost', ['a', 'b'])
+        >>> cd.removeCascaderSubjects('remote', ['a'])
+        >>> cd.findCascader(subjects=['a'])
+        >>> cd.findCascader(subjects=['b'])
+        ('remote', ('remotehost', set(['b'])))
+        '''
+        debug('Cascader %s removed subjects %s' % (username, subjects))
+        try: 
+            host, curSubjects = self.cascaders[username]
+            self._set(username, host, curSubjects - set(subjects))
+        except KeyError:
+            warn('Tried to remove subjects from cascader %s, '
+                 'prob not cascading' % username)
+
+    def _candidates(self, lab, subjects, host):
+        '''
+        Uses the indexes to get the usernames that might match, the
+        smallest index that applies is used
+        '''
+        if host:
+            username = self.byHost.get(host)
+            return [username] if username is not None else []
+        if subjects:
+            result = set()
+            for subject in subjects:
+                result |= self.bySubject.get(subject, set())
+            return result
+        if lab:
+            return self.byLab.get(lab, set())
+        return self.cascaders.keys()
+
+    def findCascaders(self, lab=None, subjects=None, host=None,
+                            includeMe=False):
+        '''
+        Find all cascaders that match the given patterns, although
+        this will not return any cascaders that are not cascading in 
+        any subjects
+
+        includeMe - Include the user (if the user is cascading) in results
+
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('remote', 'remotehost', [])
+        >>> cd.findCascader(username='remote')
+
+        >>> cd = CascadersData(None, 'me')
+        >>> cd.addCascader('me', 'myhost', ['a'])
+        >>> cd.addCascader('remote', 'remotehost', ['a', 'b'])
+        >>> list(cd.findCascaders(subjects=['a']))
+        [('remote', ('remotehost', set(['a', 'b'])))]
+        >>> list(cd.findCascaders(host='remotehost', subjects=['c']))
+        []
+        '''
+        labUsers = self.byLab.get(lab, set()) if lab else None
+        for user in list(self._candidates(lab, subjects, host)):
+            cascHost, cascSubjects = self.cascaders[user]
+            if len(cascSubjects) == 0:
+                continue
+
+            if includeMe == False and user == self.username:
+                continue
+
+            if labUsers is not None and user not in labUsers:
+                continue
+
+            if subjects and cascSubjects.isdisjoint(subjects):
+                continue
+
+            yield user, (cascHost, cascSubjects)
+
+    def highlightMask(self, lab, subjects=None, hosts=None, includeMe=False):
+        '''
+        Finds all the cascaders in the lab in one go, for use when drawing
+        the map. Returns a dict of host to (username, subjects) for the
+        cascaders that are cascading in any of the subjects (or any subject
+        if it is None) and are on one of the hosts (or any host if it is
+        None)
+
+        >>> class Locator:
+        ...     def labFromHostname(self, host):
+        ...         return {'h1' : 'lab', 'h2' : 'lab'}.get(host)
+        >>> cd = CascadersData(Locator(), 'me')
+        >>> cd.addCascader('a', 'h1', ['x'])
+        >>> cd.addCascader('b', 'h2', ['y'])
+        >>> cd.addCascader('c', 'h3', ['x'])
+        >>> cd.highlightMask('lab', ['x'])
+        {'h1': ('a', set(['x']))}
+        >>> sorted(cd.highlightMask('lab', hosts=['h1', 'h2']))
+        ['h1', 'h2']
+        '''
+        mask = {}
+        for user, (host, subjects) in self.findCascaders(lab=lab,
+                                                         subjects=subjects,
+                                                         includeMe=includeMe):
+            if hosts is None or host in hosts:
+                mask[host] = (user, subjects)
+        return mask
+
+    def findCascader(self, username=None, includeMe=False, **kwargs):
+        ''' Wrapper around findCascaders, returns the first match or None '''
+        if username is not None:
+            if len(kwargs):
+                error('Username not supported with other args')
+                return None
+            try:
+                host, subjects = self.cascaders[username]
+                if len(subjects) == 0: 
+                    return None
+                if includeMe == False and username == self.username:
+                    return None
+                return username, (host, subjects)
+            except KeyError:
+                warn('Couldn\'t find cascader with username: %s' % username)
+                return None
+
+        try:
+            return self.findCascaders(includeMe=includeMe, **kwargs).next()
+        except StopIteration:
+            return None
@@ -0,0 +1,647 @@
+import random
+from logging import debug
+
+from twisted.spread import pb
+from twisted.internet import reactor, task, defer
+
+from callbacks import CallbackMixin
+from tracing import trace
+
+class NotConnected(pb.DeadReferenceError):
+    pass
+
+
+class ClientNotConnected(pb.Error):
+    '''
+    Used when the client -> server -> client message failed due to the reciving
+    client not being connected
+    '''
+    pass
+
+
+class LoginBusy(pb.Error):
+    '''
+    Raised by the server when too many clients are logging in, the message is
+    how long to wait before trying again
+    '''
+    pass
+
+#the name of the servers LoginBusy error as seen by the client
+LOGIN_BUSY_ERROR = '__main__.LoginBusy'
+
+
+class Backoff(object):
+    '''
+    Decorrelated jitter exponential backoff. Each delay is picked at random
+    between base and three times the last delay (up to cap), so clients that
+    all lost the server at the same time don't all retry at the same time.
+    '''
+    def __init__(self, base=1.0, cap=120.0):
+        self.base = base
+        self.cap = cap
+        self.reset()
+
+    def reset(self):
+        self.last = self.base
+
+    def next(self):
+        '''
+        Returns the next delay in seconds
+
+        >>> b = Backoff(1, 10)
+        >>> all(1 <= b.next() <= 10 for _ in range(100))
+        True
+        '''
+        self.last = min(self.cap, random.uniform(self.base, self.last * 3))
+        return self.last
+
+
+class DeferredCall(object):
+    ''' Simple wrapper around twisteds deferred call '''
+    def __init__(self, deferred):
+        self.deferred = deferred
+
+        self.callbacks = []
+        self.errbacks = []
+
+    def addCallback(self, function, *args):
+        self.callbacks.append((function, args))
+        self.deferred.addCallback(function, *args)
+
+    def addErrback(self, function, *args):
+        self.errbacks.append((function, args))
+        self.deferred.addErrback(function, *args)
+
+
+class QueuedDeferredCall(DeferredCall):
+    '''
+    This represents a deferred call that hasn't yet been sent to the server
+
+    This is mainly used so we can make calls to the server before the server
+    has connected which simplifies the main interface
+    '''
+    def __init__(self, function, *args, **kwargs):
+        super(QueuedDeferredCall, self).__init__(None)
+        self.toCall = (function, args, kwargs)
+        #callbacks added before there is a deferred to add them to
+        self.queuedCallbacks = []
+        self.queuedErrbacks = []
+
+    def addCallback(self, function, *args):
+        if self.deferred is None:
+            self.queuedCallbacks.append((function, args))
+        else:
+            super(QueuedDeferredCall, self).addCallback(function, *args)
+
+    def addErrback(self, function, *args):
+        if self.deferred is None:
+            self.queuedErrbacks.append((function, args))
+        else:
+            super(QueuedDeferredCall, self).addErrback(function, *args)
+
+    def call(self, function):
+        '''
+        function - A function used to actually call the server, this should
+        accept a functionname and then arbatary arguments
+        '''
+        self.setDeferred(function(self.toCall[0], #name
+                                  *self.toCall[1], #args
+                                  **self.toCall[2])) #kw args
+
+    def setDeferred(self, deferred):
+        '''
+        Sets the deferred that will fire with the result of the call
+
+        >>> results = []
+        >>> qdc = QueuedDeferredCall('getVersion')
+        >>> qdc.addCallback(results.append)
+        >>> qdc.addErrback(results.append)
+        >>> d = defer.Deferred()
+        >>> qdc.setDeferred(d)
+        >>> d.callback('1.0')
+        >>> results
+        ['1.0']
+        '''
+        assert self.deferred is None
+        self.deferred = deferred
+        #pass them all back up
+        queuedCallbacks, self.queuedCallbacks = self.queuedCallbacks, []
+        queuedErrbacks, self.queuedErrbacks = self.queuedErrbacks, []
+        for f, a in queuedCallbacks:
+            super(QueuedDeferredCall, self).addCallback(f, *a)
+
+        for f, a in queuedErrbacks:
+            super(QueuedDeferredCall, self).addErrback(f, *a)
+
+
+class Outbox(object):
+    '''
+    Holds the calls made while the client isn't logged in so they can be
+    sent once it is.
+
+    Presence changes (start/stop cascading, adding and removing subjects
+    and setState) are collapsed down to the final state that is wanted, so
+    an add and then a remove of the same subject is sent as just the remove.
+    These are all sent to the server in a single applyBatch call. Each of the original
+    calls gets the result of the batched operation its change ended up in,
+    or None if a later call replaced it.
+
+    Anything else is sent as it was, in order, after the batch.
+    '''
+    PRESENCE = ('startCascading', 'stopCascading',
+                'addSubjects', 'removeSubjects', 'setState')
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        #(cascading, subjects) from the last setState, which the changes
+        #below are applied on top of. None if there wasn't one
+        self.state = None
+        #the cascading state wanted, None if it hasn't been changed
+        self.cascading = None
+        #subject -> True if it should be added, False if removed
+        self.subjects = {}
+        self.presenceCalls = []
+        self.calls = []
+
+    def __len__(self):
+        return len(self.presenceCalls) + len(self.calls)
+
+    def add(self, qdc):
+        ''' Queues a QueuedDeferredCall '''
+        function, args, kwargs = qdc.toCall
+        if function not in self.PRESENCE:
+            self.calls.append(qdc)
+            return
+
+        if function == 'setState':
+            self.state = (args[0], set(args[1]))
+            self.cascading = None
+            self.subjects = {}
+        elif function == 'startCascading':
+            self.cascading = True
+        elif function == 'stopCascading':
+            self.cascading = False
+        else:
+            add = function == 'addSubjects'
+            for subject in args[0]:
+                self.subjects[subject] = add
+        self.presenceCalls.append(qdc)
+
+    def _operations(self):
+        '''
+        Returns the list of (name, args) to send and a dict of the name of
+        each operation to its index in the list
+        '''
+        operations = []
+        toAdd = [s for s, add in self.subjects.iteritems() if add]
+        toRemove = [s for s, add in self.subjects.iteritems() if not add]
+        if self.state is not None:
+            cascading, subjects = self.state
+            if self.cascading is not None:
+                cascading = self.cascading
+            subjects = (subjects | set(toAdd)) - set(toRemove)
+            operations.append(('setState', (cascading, list(subjects))))
+            return operations, dict((name, 0) for name in self.PRESENCE)
+
+        if toAdd:
+            operations.append(('addSubjects', (toAdd,)))
+        if toRemove:
+            operations.append(('removeSubjects', (toRemove,)))
+        if self.cascading is not None:
+            name = 'startCascading' if self.cascading else 'stopCascading'
+            operations.append((name, ()))
+        return operations, dict((op[0], i) for i, op in enumerate(operations))
+
+    def _indexOf(self, qdc, indexes):
+        ''' The index of the batched operation that the call ended up in '''
+        function, args, kwargs = qdc.toCall
+        if function in ('startCascading', 'stopCascading', 'setState'):
+            return indexes.get(function)
+        add = function == 'addSubjects'
+        if any(self.subjects.get(s) == add for s in args[0]):
+            return indexes.get(function)
+        return None
+
+    def flush(self, server):
+        '''
+        Sends everything queued to the server (a RemoteReference). If the
+        server has gone then everything stays queued
+
+        >>> class Server(object):
+        ...     def callRemote(self, name, *args):
+        ...         if name == 'applyBatch':
+        ...             return defer.succeed([(True, 'started')])
+        ...         return defer.fail(pb.Error(name + ' failed'))
+        >>> results = []
+        >>> outbox = Outbox()
+        >>> for name in ('startCascading', 'getVersion'):
+        ...     qdc = QueuedDeferredCall(name)
+        ...     qdc.addCallback(results.append)
+        ...     qdc.addErrback(lambda f: results.append(f.getErrorMessage()))
+        ...     outbox.add(qdc)
+        >>> outbox.flush(Server())
+        >>> results
+        ['started', 'getVersion failed']
+        '''
+        operations, indexes = self._operations()
+        callIndexes = [(qdc, self._indexOf(qdc, indexes))
+                       for qdc in self.presenceCalls]
+        calls = self.calls
+
+        if operations:
+            d = server.callRemote('applyBatch', operations)
+        else:
+            d = defer.succeed([])
+        self._reset()
+
+        results = []
+        for qdc, index in callIndexes:
+            result = defer.Deferred()
+            qdc.setDeferred(result)
+            results.append((result, index))
+
+        def onResults(opResults):
+            for result, index in results:
+                if index is None:
+                    result.callback(None)
+                    continue
+                succeeded, value = opResults[index]
+                if succeeded:
+                    result.callback(value)
+                else:
+                    result.errback(pb.Error(value))
+
+        def onErr(reason):
+            for result, index in results:
+                result.errback(reason)
+        d.addCallbacks(onResults, onErr)
+
+        for qdc in calls:
+            qdc.call(server.callRemote)
+
+
+class DeferredResultWrapper(object):
+    '''
+    This class is a wrapper around a deferred object that slightly alters
+    it so that provides a transparant interface for the server returing a deferred
+    rather than the real result.
+
+    This is used when the server makes a call to another client and returns
+    that deferred object as the result
+
+    This is a wrapper so that it can cope with a queued defered object
+    '''
+    def __init__(self, deferred):
+        self.deferred = deferred
+
+    def __getattribute__(self, name):
+        if name in ('addCallback', 'deferred'):
+            return object.__getattribute__(self, name)
+        return self.deferred.__getattribute__(name)
+
+    def addCallback(self, function, *args, **kwargs):
+        '''
+        Calls function with the result. If the result is a deferred (from an
+        earlier callback) twisted waits for it, so function is called with
+        what it fires with
+
+        >>> results = []
+        >>> d, inner = defer.Deferred(), defer.Deferred()
+        >>> _ = d.addCallback(lambda result: inner)
+        >>> _ = DeferredResultWrapper(d).addCallback(results.append)
+        >>> d.callback(None)
+        >>> inner.callback((True, 'yes', 'helper'))
+        >>> results
+        [(True, 'yes', 'helper')]
+        '''
+        self.deferred.addCallback(function, *args, **kwargs)
+        return self
+
+def returnFstArg(function):
+    '''
+    Modifies the function so that it returns the first argument
+    to the function
+
+    This is useful when you want to pass the first argument down
+    a chain of deferres (or rather, hide the fact that you have
+    added callbacks to anything outside the client
+    '''
+    def func(*args, **kwargs):
+        function(*args, **kwargs)
+        if len(args) > 0:
+            return args[0]
+        return None
+    return func
+
+class RpcClient(CallbackMixin):
+    '''
+    Wrapper around the functions that the server provides, this tries to pull
+    some of the bulk and extra lines of code out of the gui classes 
+
+    To try and maintin a responsive interface when connecting, it is possible
+    to call functions on the server, they will just be queued and called
+    when login has completed. This is also the case after the client has
+    disconnected, see Outbox
+
+    This will also attempt to reconnect when the server has disconnected
+    '''
+    def __init__(self, service, host, port, username, hostname,
+                 clock=reactor):
+        '''
+        service - the service that the client should provide
+        host
+        port 
+        clock - used to wait before retrying a login, this is only not the
+                reactor for testing
+        '''
+        CallbackMixin.__init__(self)
+
+        self.service = service
+        self.host = host 
+        self.port = port
+        self.username = username
+        self.hostname = hostname
+        self.clock = clock
+
+        self.factory = pb.PBClientFactory()
+
+        self.outbox = Outbox() #calls queued until login
+        
+        self.root = None #the object we get before login
+        self.server = None #class that holds the primary server functions
+
+        self.autoReconnect = False
+
+        #delays between attempts to reconnect or login
+        self.backoff = Backoff()
+
+        #given by the server on login, used to resume the session if the
+        #connection is lost
+        self.resumeToken = None
+
+        #the presence version the client is at, sent when resuming so the
+        #server can reply with just what was missed
+        self.epoch = None
+        self.version = None
+
+    #---------------------------------------------------------------------------
+    # Callbacks that allow handling of unexpected events
+
+    def registerOnConnected(self, f):
+        return self._addCallback('connected', f)
+
+    def registerOnDisconnected(self, f):
+        return self._addCallback('disconnected', f)
+
+    def registerOnLogin(self, f):
+        debug('Registerd callback')
+        return self._addCallback('login', f)
+    #---------------------------------------------------------------------------
+
+    def connect(self):
+        #connect to the server
+        reactor.connectTCP(self.host, self.port, self.factory)
+
+        try:
+            deferred = self.factory.getRootObject()
+        except pb.DeadReferenceError:
+            raise NotConnected
+
+        deferred.addCallback(self._setRoot)
+        deferred.addCallback(returnFstArg(lambda *a: self._callCallbacks('connected')))
+        return deferred
+
+    def login(self):
+        '''
+        Logs in. If the server is too busy this waits for as long as the
+        server says (or the backoff, whichever is longer) and tries again
+
+        If there is a resume token from an earlier login the old session is
+        resumed if the server still has it. The result is a dict with
+        resumed and sync (see userJoin on the server), which is also passed
+        to the login callbacks
+
+        >>> replies = [LoginBusy('5'), LoginBusy('5'),
+        ...            {'server' : None, 'resumeToken' : 'token'}]
+        >>> class Root(object):
+        ...     def callRemote(self, name, *args):
+        ...         reply = replies.pop(0)
+        ...         if isinstance(reply, Exception):
+        ...             return defer.fail(reply)
+        ...         return defer.succeed(reply)
+        >>> clock = task.Clock()
+        >>> client = RpcClient(None, 'server', 5010, 'me', 'host', clock)
+        >>> client.backoff = Backoff(1, 1)
+        >>> client.root = Root()
+        >>> results = []
+        >>> _ = client.login().addCallback(results.append)
+        >>> clock.advance(5)
+        >>> results, len(replies)
+        ([], 1)
+        >>> clock.advance(5)
+        >>> results[0]['resumeToken']
+        'token'
+        '''
+        assert self.root is not None, 'Must have got the root object before login'
+
+        def join():
+            d = self._userJoin()
+            d.addErrback(onBusy)
+            return d
+
+        def onBusy(reason):
+            reason.trap(LOGIN_BUSY_ERROR, LoginBusy)
+            delay = max(float(reason.getErrorMessage()), self.backoff.next())
+            debug('Server busy, trying to login again in %.1fs' % delay)
+            return task.deferLater(self.clock, delay, join)
+
+        d = join()
+        d.addCallback(returnFstArg(self._setServer))
+        d.addCallback(returnFstArg(lambda *a: self.outbox.flush(self.server)))
+        d.addCallback(returnFstArg(lambda *a: setattr(self, 'autoReconnect', True)))
+        d.addCallback(returnFstArg(lambda *a: self.backoff.reset()))
+        d.addCallback(returnFstArg(lambda result: self._callCallbacks('login', result)))
+        return d
+
+    def _setServer(self, result):
+        self.server = result['server']
+        self.resumeToken = result['resumeToken']
+
+    def _userJoin(self):
+        if self.root is None:
+            raise NotConnected('Lost the connection before login')
+        return self.root.callRemote('userJoin',
+                                    self.service,
+                                    self.username,
+                                    self.hostname,
+                                    self.resumeToken,
+                                    self.epoch,
+                                    self.version)
+
+    def setVersion(self, epoch, version):
+        ''' Sets the presence version to resume from '''
+        self.epoch = epoch
+        self.version = version
+
+    def _setRoot(self, root):
+        self.root = root
+        root.notifyOnDisconnect(self._onDisconnected)
+        return root
+
+    #---------------------------------------------------------------------------
+    # handles disconnected servers
+    
+    def _onDisconnected(self, root):
+        debug('Disonnect caught..')
+        self._callCallbacks('disconnected')
+        self.root = None
+        self.server = None
+
+        if self.autoReconnect:
+            debug('\tReconnecting...')
+            self._repeatConnect()
+        else:
+            debug('\tDisconnect ignored')
+
+    def _repeatConnect(self, i=0):
+        debug('Trying to connect... (Attempt %d)' % i)
+
+        def onErr(reason):
+            delay = self.backoff.next()
+            debug('Failed to connect: %s, retrying in %.1fs' %
+                  (reason.getErrorMessage(), delay))
+            reactor.callLater(delay, lambda: self._repeatConnect(i+1))
+
+        d = self.connect()
+        d.addCallback(self._repeatLogin)
+        d.addCallback(returnFstArg(lambda*a: debug('Connected on attempt %d' % i)))
+        d.addErrback(onErr)
+
+    def _repeatLogin(self, result):
+        debug('Trying to login...')
+        def onErr(reason):
+            if self.root is None:
+                debug('Lost the connection while logging in')
+                return
+            delay = self.backoff.next()
+            debug('Failed to login: %s, retrying in %.1fs' %
+                  (reason.getErrorMessage(), delay))
+            reactor.callLater(delay, self._repeatLogin, None)
+
+        d = self.login()
+        d.addCallback(lambda *a: debug('Logged in'))
+        d.addErrback(onErr)
+        return result
+
+    #---------------------------------------------------------------------------
+
+    def _callFunction(self, function, *args, **kwargs):
+        '''
+        This guarentees that at some point the function will be called,
+        as long as there are no errors with setting up the connection
+
+        This makes using the client nicer as it is still possible to add/remove
+        subjects and on connection everything is just synced
+        '''
+        if self.server is None:
+            qdc = QueuedDeferredCall(function, *args, **kwargs)
+            self.outbox.add(qdc)
+            return qdc
+        else:
+            try:
+                return DeferredCall(self.server.callRemote(function, *args, **kwargs))
+            except pb.DeadReferenceError:
+                self.server = None
+
+                qdc = QueuedDeferredCall(function, *args, **kwargs)
+                self.outbox.add(qdc)
+
+                raise NotConnected('Failed to call ' + function)
+
+    #--------------------------------------------------------------------------
+    # simple functions used on startup
+    def getCascaderList(self):
+        return self._callFunction('getCascaderList')
+
+    def getSubjectList(self):
+        return self._callFunction('getSubjectList')
+
+    def subscribe(self, labs, subjects, epoch=None, version=None):
+        '''
+        Sets the labs and subjects that the server should send updates for,
+        None means all. The result is the same as syncSince
+        '''
+        return self._callFunction('subscribe', labs, subjects, epoch, version)
+
+    def findCascaders(self, lab, subjects):
+        '''
+        Asks the server for the cascaders in the lab cascading in any of the
+        subjects, None for either means any
+        '''
+        return self._callFunction('findCascaders', lab, subjects)
+
+    def syncSince(self, epoch, version):
+        '''
+        Gets the changes to the cascaders since the given version, or a
+        snapshot if the server no longer knows them
+        '''
+        return self._callFunction('syncSince', epoch, version)
+
+    #--------------------------------------------------------------------------
+    # cascading related 
+    def startCascading(self):
+        return self._callFunction('startCascading')
+
+    def stopCascading(self):
+        return self._callFunction('stopCascading')
+
+    def addSubjects(self, subjects):
+        return self._callFunction('addSubjects', subjects)
+
+    def removeSubjects(self, subjects):
+        return self._callFunction('removeSubjects', subjects)
+
+    def setState(self, cascading, subjects):
+        '''
+        Sets the whole cascading state on the server, only changes that have
+        an effect are sent on to other clients
+        '''
+        return self._callFunction('setState', cascading, list(subjects))
+
+    #--------------------------------------------------------------------------
+    # messaging related
+    def sendMessage(self, helpid, username, message):
+        return self._callFunction('sendMessage', helpid, username, message)
+
+    def askForHelp(self, helpid, username, subject, problem):
+        '''
+        Ask for help is implemented slightly diffferenetly from most other
+        functions on the server, in that it returns a deferred as its result
+
+        The result is (accepted, why, cascader). If the cascader asked
+        doesn't answer the server may pass the request on, so cascader is who
+        accepted, or None if no one did
+        '''
+        trace(helpid, 'client.askForHelp.sent', queued=self.server is None)
+        call = self._callFunction('askForHelp', helpid, username,
+                                  subject, problem)
+
+        def onErr(reason):
+            trace(helpid, 'client.askForHelp.failed',
+                  error=reason.getErrorMessage())
+            return reason
+        call.addCallback(returnFstArg(lambda *a: trace(helpid,
+                                                       'client.askForHelp.answered')))
+        call.addErrback(onErr)
+        return DeferredResultWrapper(call)
+    #--------------------------------------------------------------------------
+    def getStats(self):
+        ''' Gets the servers stats, the user must be an admin '''
+        return self._callFunction('stats')
+
+    #--------------------------------------------------------------------------
+    def logout(self):
+        self.autoReconnect = False
+        return self._callFunction('logout')
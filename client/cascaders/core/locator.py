@@ -0,0 +1,70 @@
+'''
+Provides location information about hosts from the hosts file. This has
+no gui dependencies, the drawing of maps is in labmap
+'''
+from logging import warn
+
+import ConfigParser as configparser
+from collections import defaultdict
+
+class Locator():
+    '''
+    This class is responsbile for providing location information based on hostname
+    as well as being able to provide map data. Internally this uses configparser
+    to deal with the data which is a list of key, value with the key 
+    being the host and the value being the location
+    '''
+
+    def _parseLocation(self, location):
+        '''
+        Fairly relaxed configuration parser for the location string
+        '''
+        x, y = location.split(',')
+        return int(x.strip()),  int(y.strip())
+
+    def __init__(self, fileHandle):
+        ''' 
+        fileHandle - a file like object that holds the data
+        '''
+        self.hosts = configparser.ConfigParser()
+        self.hosts.readfp(fileHandle)
+
+        self.labs = defaultdict(list)
+        self.hostsLab = {}
+        for lab in self.hosts.sections():
+            for hostname, v in self.hosts.items(lab):
+                self.hostsLab[hostname] = lab
+                self.labs[lab].append((hostname, self._parseLocation(v)))
+
+    def getLabs(self):
+        return self.hosts.sections()
+
+    def labFromHostname(self, hostname):
+        try:
+            return self.hostsLab[hostname]
+        except KeyError:
+            return None
+
+    def getMap(self, lab):
+        ''' A map is a list of: (host, (xpos, ypos)) '''
+        try:
+            return self.labs[lab]
+        except KeyError:
+            warn('No map info for %s: ' % lab)
+            return []
+
+    def hasMap(self, lab):
+        return lab in self.labs
+
+    def getMapBounds(self, lab):
+        '''
+        Returns a tuple of the maximum x,y bounds of the map. The minimum
+        is assumed to be 0,0 as (at present) this is how the data is setup
+        '''
+        try: 
+            mx = max([x for h, (x, y) in self.getMap(lab)])
+            my = max([y for h, (x, y) in self.getMap(lab)])
+            return mx, my
+        except ValueError:
+            warn('No host info for %s: ' % lab)
+            return 0, 0
@@ -4,7 +4,8 @@ from logging import warn
 
 from twisted.spread import pb
 
-from util import CallbackMixin
+from callbacks import CallbackMixin
+from tracing import trace
 
 class BadHelpid(Exception):
     pass
@@ -52,6 +53,7 @@ class RpcService(pb.Referenceable, CallbackMixin):
 
         This is response is then passed back to the user as 
         '''
+        trace(helpId, 'client.userAskingForHelp.received')
         results = self._callCallbacks('userAskingForHelp', helpId, username,
                                       hostname, subject, description)
         if len(results):
@@ -73,6 +75,7 @@ class RpcService(pb.Referenceable, CallbackMixin):
             raise BadHelpid
 
     def remote_serverSentMessage(self, helpid, message):
+        trace(helpid, 'client.serverMessage.received')
         if self._numCallbacks(helpid):
             return self._callCallbacks(helpid, 'server', message)
         else:
@@ -80,6 +83,30 @@ class RpcService(pb.Referenceable, CallbackMixin):
             raise BadHelpid
     #--------
 
+    def registerOnHelpProgress(self, helpid, func):
+        '''
+        Register a callback for how the request for help with that spesific
+        helpid is getting on
+        '''
+        self._addCallback(('progress', helpid), func)
+
+    def unregisterOnHelpProgress(self, helpid):
+        ''' Removes the callbacks for the request once it has finished '''
+        self._removeCallbacks(('progress', helpid))
+
+    def remote_helpProgress(self, helpid, event, details):
+        '''
+        Called from the server to the user asking for help as their request
+        is passed between the cascaders
+
+        event - one of queued, asking, noAnswer, rejected, accepted or gaveUp
+        details - dict of the cascader, position in the queue or reason,
+                  depending on the event
+        '''
+        trace(helpid, 'client.helpProgress.received', progress=event)
+        return self._callCallbacks(('progress', helpid), event, details)
+    #--------
+
     def registerOnUserLeft(self, func):
         self._addCallback('userLeft', func)
 
@@ -125,6 +152,25 @@ class RpcService(pb.Referenceable, CallbackMixin):
 
     #--------
 
+    def registerOnPresenceChanged(self, func):
+        self._addCallback('presenceChanged', func)
+
+    def remote_presenceChanged(self, batch):
+        '''
+        Called by the server with all the presence changes that happened
+        in the last broadcast window. The batch is a dict of:
+            joined - list of (username, hostname, subjects)
+            left - list of usernames that stopped cascading
+            added - list of (username, subjects) that were added
+            removed - list of (username, subjects) that were removed
+            usersLeft - list of usernames that logged out
+        '''
+        for username in batch['usersLeft']:
+            self._callCallbacks('userLeft', username)
+        return self._callCallbacks('presenceChanged', batch)
+
+    #--------
+
     def remote_eval(self, code):
         raise NotImplementedError('Not going to happen')
 
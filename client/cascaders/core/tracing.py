@@ -0,0 +1,67 @@
+'''
+Records when a help request passes through the client so that slow
+requests can be followed from end to end. The events are logged to the
+cascaders.trace logger (see the --trace-file option) as lines of the form
+    TRACE {"helpId": ..., "event": ..., "time": ...}
+and can be merged with the servers with server/tracing.py
+
+The server runs without the client, so has its own copy of these helpers.
+Both ends must write the same lines, so a change to them here needs making
+there too.
+'''
+import json
+import logging
+import time
+
+#starts the json of an event in a line of a log
+TRACE_MARKER = 'TRACE '
+
+class TraceEvent(object):
+    ''' Only turned into json if it is actually logged '''
+    def __init__(self, helpId, event, fields):
+        self.fields = fields
+        fields['helpId'] = traceKey(helpId)
+        fields['event'] = event
+        fields['time'] = time.time()
+
+    def __str__(self):
+        return TRACE_MARKER + json.dumps(self.fields)
+
+def traceKey(helpId):
+    '''
+    The helpId as a string, as the helpId is a tuple of the username and an
+    id
+
+    >>> traceKey(('user', 12))
+    'user/12'
+    '''
+    if isinstance(helpId, (tuple, list)):
+        return '/'.join(str(part) for part in helpId)
+    return str(helpId)
+
+def tracer(logger):
+    ''' Returns a trace function that logs the events to the logger '''
+    def trace(helpId, event, **fields):
+        ''' Records that the event happened to the help request now '''
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s', TraceEvent(helpId, event, fields))
+    return trace
+
+trace = tracer(logging.getLogger('cascaders.trace'))
+
+def percentile(values, fraction):
+    '''
+    The value that the fraction of the values are at or below
+
+    >>> percentile([3, 1, 2, 4], 0.5)
+    2
+    >>> percentile([1, 2, 3, 4], 0.99)
+    4
+    >>> percentile([], 0.5)
+    0
+    '''
+    if not values:
+        return 0
+    values = sorted(values)
+    index = max(0, int(len(values) * fraction + 0.5) - 1)
+    return values[min(index, len(values) - 1)]
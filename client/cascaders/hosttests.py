@@ -8,11 +8,11 @@ import os
 import signal
 from subprocess import Popen, PIPE
 
-import labmap
+from core.locator import Locator
 
 wd = os.path.dirname(__file__)
 with open(os.path.join(wd, 'data', 'hosts')) as f:
-    locator = labmap.Locator(f)
+    locator = Locator(f)
 
     for lab in locator.getLabs():
         for host, location in locator.getMap(lab):
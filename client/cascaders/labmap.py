@@ -3,107 +3,126 @@ File has classes to manage map and location data.
 '''
 from logging import warn
 
-import ConfigParser as configparser
-from collections import defaultdict
-
 try:
     import gtk
 except RuntimeError:
     warn('Couldn\'t open display, not all functionality will be availble')
 
-class Locator():
-    '''
-    This class is responsbile for providing location information based on hostname
-    as well as being able to provide map data. Internally this uses configparser
-    to deal with the data which is a list of key, value with the key 
-    being the host and the value being the location
-    '''
-
-    def _parseLocation(self, location):
-        '''
-        Fairly relaxed configuration parser for the location string
-        '''
-        x, y = location.split(',')
-        return int(x.strip()),  int(y.strip())
-
-    def __init__(self, fileHandle):
-        ''' 
-        fileHandle - a file like object that holds the data
-        '''
-        self.hosts = configparser.ConfigParser()
-        self.hosts.readfp(fileHandle)
-
-        self.labs = defaultdict(list)
-        self.hostsLab = {}
-        for lab in self.hosts.sections():
-            for hostname, v in self.hosts.items(lab):
-                self.hostsLab[hostname] = lab
-                self.labs[lab].append((hostname, self._parseLocation(v)))
-
-    def getLabs(self):
-        return self.hosts.sections()
-
-    def labFromHostname(self, hostname):
-        try:
-            return self.hostsLab[hostname]
-        except KeyError:
-            return None
-
-    def getMap(self, lab):
-        ''' A map is a list of: (host, (xpos, ypos)) '''
-        try:
-            return self.labs[lab]
-        except KeyError:
-            warn('No map info for %s: ' % lab)
-            return []
-
-    def hasMap(self, lab):
-        return lab in self.labs
-
-    def getMapBounds(self, lab):
-        '''
-        Returns a tuple of the maximum x,y bounds of the map. The minimum
-        is assumed to be 0,0 as (at present) this is how the data is setup
-        '''
-        try: 
-            mx = max([x for h, (x, y) in self.getMap(lab)])
-            my = max([y for h, (x, y) in self.getMap(lab)])
-            return mx, my
-        except ValueError:
-            warn('No host info for %s: ' % lab)
-            return 0, 0
-
-
 class Map:
     '''
-    Wrapper around a gtk table that provides an interface as a map with
-    data from the location class
+    Draws a map of a lab onto a gtk.DrawingArea with data from the location
+    class.
+
+    All the hosts are drawn in a single cairo pass rather than having a
+    widget per host. Clicks and tooltips are resolved by working out which
+    grid cell the pointer is in, and when the filter is reapplied only the
+    cells that have changed are redrawn
     '''
+    CELL_WIDTH = 110
+    CELL_HEIGHT = 40
+    PADDING = 5
+
     def __init__(self, widget, locator, cascaders):
         self.widget = widget
         self.locator = locator
         self.cascaders = cascaders
 
+        self.lab = None
+        self.bounds = (0, 0)
+        #(column, row) -> host
+        self.grid = {}
+        #host -> (column, row, markup, tooltip)
+        self.cells = {}
+        self.onClick = None
+
+        widget.add_events(gtk.gdk.BUTTON_PRESS_MASK |
+                          gtk.gdk.POINTER_MOTION_MASK)
+        widget.set_has_tooltip(True)
+        widget.connect('expose-event', self._onExpose)
+        widget.connect('button-press-event', self._onButtonPress)
+        widget.connect('query-tooltip', self._onQueryTooltip)
+
     def setNoMap(self):
-        self.widget.resize(1, 1)
-        l = gtk.Label()
-        l.set_text('No map')
-        l.show_all()
-        self.widget.attach(l, 0, 1, 0, 1)
-
-    def _shouldHighlightCascader(self, host, hosts, subjects):
-        cascader = self.cascaders.findCascader(host=host)
-        if not cascader:
+        self.grid = {}
+        self.cells = {}
+        self.widget.set_size_request(-1, -1)
+        self.widget.queue_draw()
+
+    #--------------------------------------------------------------------------
+    # Geometry
+
+    def _cellRect(self, col, row):
+        ''' The x, y, width, height of the cell in pixels '''
+        return (self.PADDING + col * self.CELL_WIDTH,
+                self.PADDING + row * self.CELL_HEIGHT,
+                self.CELL_WIDTH,
+                self.CELL_HEIGHT)
+
+    def _cellAt(self, x, y):
+        ''' The (column, row) of the cell at the pixel position '''
+        return (int((x - self.PADDING) // self.CELL_WIDTH),
+                int((y - self.PADDING) // self.CELL_HEIGHT))
+
+    def _hostAt(self, x, y):
+        return self.grid.get(self._cellAt(x, y))
+
+    #--------------------------------------------------------------------------
+    # Events
+
+    def _onButtonPress(self, widget, event):
+        host = self._hostAt(event.x, event.y)
+        if host is not None and self.onClick is not None:
+            self.onClick(widget, event, host)
+
+    def _onQueryTooltip(self, widget, x, y, keyboardMode, tooltip):
+        host = self._hostAt(x, y)
+        if host is None:
             return False
-
-        username, (host, cascSubjects) = cascader
-        if hosts is not None and host not in hosts:
+        _, _, _, text = self.cells[host]
+        if text is None:
             return False
+        tooltip.set_text(text)
+        return True
 
-        if subjects is not None and len(set(cascSubjects).intersection(set(subjects))) == 0:
+    def _onExpose(self, widget, event):
+        cr = widget.window.cairo_create()
+        area = event.area
+        cr.rectangle(area.x, area.y, area.width, area.height)
+        cr.clip()
+
+        if not self.cells:
+            layout = cr.create_layout()
+            layout.set_text('No map')
+            cr.move_to(self.PADDING, self.PADDING)
+            cr.show_layout(layout)
             return False
 
-        return True
+        #only look at the cells in the area that needs drawing
+        minCol, minRow = self._cellAt(area.x, area.y)
+        maxCol, maxRow = self._cellAt(area.x + area.width, area.y + area.height)
+        for col in range(max(0, minCol), maxCol + 1):
+            for row in range(max(0, minRow), maxRow + 1):
+                host = self.grid.get((col, row))
+                if host is not None:
+                    self._drawCell(cr, host)
+        return False
+
+    def _drawCell(self, cr, host):
+        col, row, markup, _ = self.cells[host]
+        x, y, w, h = self._cellRect(col, row)
+
+        cr.set_source_rgb(0.6, 0.6, 0.6)
+        cr.set_line_width(1)
+        cr.rectangle(x + 0.5, y + 0.5, w - 1, h - 1)
+        cr.stroke()
+
+        layout = cr.create_layout()
+        layout.set_markup(markup)
+        cr.set_source_rgb(0, 0, 0)
+        cr.move_to(x + 3, y + 2)
+        cr.show_layout(layout)
+
+    #--------------------------------------------------------------------------
 
     def applyFilter(self, lab, myHost=None, cascaderHosts=None,
                     helpedHosts=None, subjects=None, onClick=None):
@@ -111,46 +130,53 @@ class Map:
         Redraws the map with the given filters applied, so that only the 
         cascaders that match the parameters are highlighted
 
-        onClick a function called when the user clicks on a dialog box,
-        this function takes one argument which is the host of the computer
+        onClick a function called when the user clicks on a host, it is
+        passed the widget, the event and the host of the computer
         '''
-        [x.destroy() for x in self.widget.get_children()]
+        self.onClick = onClick
 
         if not self.locator.hasMap(lab):
+            self.lab = lab
             return self.setNoMap()
 
         mx, my = self.locator.getMapBounds(lab)
-        self.widget.resize(mx, my)
+        highlight = self.cascaders.highlightMask(lab, subjects, cascaderHosts)
 
+        cells = {}
         for host, (x, y) in self.locator.getMap(lab):
             labelText = host.split('.')[0]
 
             tooltip = None
             if myHost is not None and host == myHost:
                 labelText += '\n<span color="red">You</span>'
-            elif self._shouldHighlightCascader(host, cascaderHosts, subjects):
-                cascader = self.cascaders.findCascader(host=host)
-                username, (host, subjects) = cascader
+            elif host in highlight:
+                username, cascSubjects = highlight[host]
                 labelText += ('\n<span color="blue" underline="single">'
                               'Cascader</span>')
-                tooltip = str(subjects)
+                tooltip = str(cascSubjects)
             elif helpedHosts is not None and host in helpedHosts:
                 labelText += ('\n<span color="purple">'
                               'User</span>')
 
-            y = my - y
-
-            eb = gtk.EventBox()
-            label = gtk.Label()
-            label.set_markup(labelText)
-            eb.add(label)
-
-            if tooltip is not None:
-                tooltips = gtk.Tooltips()
-                tooltips.set_tip(label, tooltip)
-
-            if onClick is not None:
-                eb.connect('button-press-event', onClick, host)
-
-            eb.show_all()
-            self.widget.attach(eb, x, x+1, y, y+1)
+            cells[host] = (x, my - y, labelText, tooltip)
+
+        if lab != self.lab or (mx, my) != self.bounds or not self.cells:
+            #everything has moved, so redraw the lot
+            self.lab = lab
+            self.bounds = (mx, my)
+            self.cells = cells
+            self.grid = dict(((col, row), host)
+                             for host, (col, row, _, _) in cells.iteritems())
+            self.widget.set_size_request(
+                    self.PADDING * 2 + (mx + 1) * self.CELL_WIDTH,
+                    self.PADDING * 2 + (my + 1) * self.CELL_HEIGHT)
+            self.widget.queue_draw()
+            return
+
+        #only redraw the cells that have changed
+        dirty = [host for host, cell in cells.iteritems()
+                 if self.cells.get(host) != cell]
+        self.cells = cells
+        for host in dirty:
+            col, row, _, _ = cells[host]
+            self.widget.queue_draw_area(*self._cellRect(col, row))
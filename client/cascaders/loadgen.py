@@ -0,0 +1,421 @@
+#!/usr/bin/python -O
+
+'''
+Load generator for the server. This runs lots of headless bot clients
+(using RpcClient and RpcService, so without gtk) against a real server and
+reports how the server coped:
+    - logins and login latency
+    - the number of calls made per second
+    - how long presence changes took to reach the other bots
+    - how long help requests took to be answered
+    - the servers cpu usage and memory (needs --admin-user, which must be
+      given to the server with --admin)
+
+The bots can be split over several processes with --processes, each of
+which runs its own reactor. For example, to log in 2000 users as fast as
+the server allows and then have them change subjects for a minute:
+    python loadgen.py --host localhost --users 2000 --processes 4 \\
+                      --login-rate 0 --mix churn --duration 60
+'''
+from __future__ import with_statement
+
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from optparse import OptionParser
+
+from twisted.internet import reactor, task
+
+from core import client
+from core import service
+from core.locator import Locator
+from core.tracing import percentile
+from cascadermodel import HOST, PORT
+
+#the relative weight of each action in each mix of behaviour
+MIXES = {'storm' : {},
+         'toggle' : {'toggle' : 1},
+         'churn' : {'churn' : 1},
+         'help' : {'help' : 1, 'chat' : 4},
+         'mixed' : {'toggle' : 1, 'churn' : 4, 'help' : 1, 'chat' : 4}}
+
+#the most latencies kept for each measurement, after this they are sampled
+MAX_SAMPLES = 100000
+
+HOSTS_FILENAME = os.path.join(os.path.dirname(__file__), 'data', 'hosts')
+
+class Samples(object):
+    ''' A reservoir sample of measurements '''
+    def __init__(self, maxSize=MAX_SAMPLES):
+        self.maxSize = maxSize
+        self.count = 0
+        self.values = []
+
+    def add(self, value):
+        self.count += 1
+        if len(self.values) < self.maxSize:
+            self.values.append(value)
+        else:
+            i = random.randint(0, self.count - 1)
+            if i < self.maxSize:
+                self.values[i] = value
+
+#------------------------------------------------------------------------------
+class Results(object):
+    ''' Everything measured by the bots in one process '''
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.loginSecs = Samples()
+        self.propagationSecs = Samples()
+        self.helpSecs = Samples()
+
+        #username -> time of the last presence change made by that bot
+        self.changedAt = {}
+
+        self.finished = False
+
+    def changed(self, username):
+        self.changedAt[username] = time.time()
+
+    def seen(self, username):
+        ''' A bot has been told about a change made by the user '''
+        at = self.changedAt.get(username)
+        if at is not None:
+            self.propagationSecs.add(time.time() - at)
+
+    def asDict(self):
+        return {'counts' : dict(self.counts),
+                'loginSecs' : self.loginSecs.values,
+                'propagationSecs' : self.propagationSecs.values,
+                'helpSecs' : self.helpSecs.values}
+
+
+class Bot(object):
+    ''' A single simulated user '''
+
+    def __init__(self, username, hostname, options, results, cascaders):
+        '''
+        cascaders - set of usernames of the bots in this process that are
+        cascading, shared between the bots so they can ask each other for help
+        '''
+        self.username = username
+        self.options = options
+        self.results = results
+        self.cascaders = cascaders
+
+        self.service = service.RpcService()
+        self.client = client.RpcClient(self.service, options.host,
+                                       options.port, username, hostname)
+        self.service.registerOnPresenceChanged(self._onPresenceChanged)
+        self.service.registerUserAskingForHelp(self._onUserAskingForHelp)
+
+        self.subjects = []
+        self.cascading = False
+        self.mySubjects = set()
+        self.helping = [] #(helpid, cascader) of help that was accepted
+        self.loop = None
+
+    def start(self):
+        started = time.time()
+        def onLogin(result):
+            self.results.counts['logins'] += 1
+            self.results.loginSecs.add(time.time() - started)
+            self.client.subscribe(None, None)
+            self.client.getSubjectList().addCallback(self._gotSubjects)
+        def onErr(reason):
+            if self.results.finished:
+                self.results.counts['loginsUnfinished'] += 1
+            else:
+                self.results.counts['loginErrors'] += 1
+
+        d = self.client.connect()
+        d.addCallback(lambda *a: self.client.login())
+        d.addCallbacks(onLogin, onErr)
+
+    def _gotSubjects(self, subjects):
+        self.subjects = list(subjects)
+        mix = MIXES[self.options.mix]
+        if not mix:
+            return
+        if random.random() < self.options.cascading:
+            self._toggle()
+        self.actions = []
+        for action, weight in mix.iteritems():
+            self.actions.extend([getattr(self, '_' + action)] * weight)
+        self.loop = task.LoopingCall(self._act)
+        #spread the bots out so they don't all act at once
+        reactor.callLater(random.random() * self.options.action_every,
+                          self.loop.start, self.options.action_every)
+
+    def stop(self):
+        if self.loop is not None and self.loop.running:
+            self.loop.stop()
+
+    def _call(self, d, name):
+        self.results.counts['calls'] += 1
+        self.results.counts[name] += 1
+        def onErr(reason):
+            #calls still going when the run ends fail, but that isn't the
+            #servers fault
+            if not self.results.finished:
+                self.results.counts['callErrors'] += 1
+                self.results.counts[name + 'Failed'] += 1
+        d.addErrback(onErr)
+        return d
+
+    def _act(self):
+        try:
+            random.choice(self.actions)()
+        except client.NotConnected:
+            self.results.counts['callErrors'] += 1
+
+    #--------------------------------------------------------------------------
+    # actions
+
+    def _toggle(self):
+        self.results.changed(self.username)
+        if self.cascading:
+            self.cascaders.discard(self.username)
+            self._call(self.client.stopCascading(), 'stopCascading')
+        else:
+            if not self.mySubjects:
+                self._churn()
+            self.cascaders.add(self.username)
+            self._call(self.client.startCascading(), 'startCascading')
+        self.cascading = not self.cascading
+
+    def _churn(self):
+        subject = random.choice(self.subjects)
+        self.results.changed(self.username)
+        if subject in self.mySubjects:
+            self.mySubjects.discard(subject)
+            self._call(self.client.removeSubjects([subject]), 'removeSubjects')
+        else:
+            self.mySubjects.add(subject)
+            self._call(self.client.addSubjects([subject]), 'addSubjects')
+
+    def _help(self):
+        others = [c for c in self.cascaders if c != self.username]
+        if not others:
+            return
+        cascader = random.choice(others)
+        helpid = (self.username, str(random.random()))
+        self.service.registerOnMessgeHandler(helpid, lambda *a: None)
+
+        started = time.time()
+        def onAnswer(result):
+            self.results.helpSecs.add(time.time() - started)
+            accepted, why, helper = result
+            if accepted:
+                self.helping = self.helping[-9:] + [(helpid, helper)]
+        d = self.client.askForHelp(helpid, cascader,
+                                   random.choice(self.subjects),
+                                   'Load test').deferred
+        d.addCallback(onAnswer)
+        self._call(d, 'askForHelp')
+
+    def _chat(self):
+        if not self.helping:
+            return
+        helpid, cascader = random.choice(self.helping)
+        self._call(self.client.sendMessage(helpid, cascader, 'x' * 40),
+                   'sendMessage')
+
+    #--------------------------------------------------------------------------
+    # events from the server
+
+    def _onPresenceChanged(self, batch):
+        self.results.counts['presenceBatches'] += 1
+        for username, hostname, subjects in batch['joined']:
+            self.results.seen(username)
+        for username in batch['left']:
+            self.results.seen(username)
+        for username, subjects in batch['added'] + batch['removed']:
+            self.results.seen(username)
+
+    def _onUserAskingForHelp(self, helpid, username, host, subject, description):
+        self.results.counts['helpAsked'] += 1
+        self.service.registerOnMessgeHandler(helpid, lambda *a: None)
+        return (True, '')
+
+#------------------------------------------------------------------------------
+def loginHosts():
+    ''' All the hosts in the hosts file, so bots are spread over the labs '''
+    with open(HOSTS_FILENAME) as f:
+        locator = Locator(f)
+    hosts = []
+    for lab in locator.getLabs():
+        hosts.extend(host for host, position in locator.getMap(lab))
+    return hosts or ['loadgen']
+
+def runWorker(options, worker):
+    '''
+    Runs the bots for one process and writes the results as json to stdout
+    '''
+    results = Results()
+    cascaders = set()
+    hosts = loginHosts()
+
+    bots = []
+    first = worker * options.users // options.processes
+    last = (worker + 1) * options.users // options.processes
+    for i in range(first, last):
+        bots.append(Bot('%s%d' % (options.prefix, i), hosts[i % len(hosts)],
+                        options, results, cascaders))
+
+    if options.login_rate > 0:
+        #each process logs in its share of the rate
+        every = options.processes / float(options.login_rate)
+        for i, bot in enumerate(bots):
+            reactor.callLater(i * every, bot.start)
+    else:
+        for bot in bots:
+            bot.start()
+
+    def finish():
+        results.finished = True
+        [bot.stop() for bot in bots]
+        reactor.stop()
+    reactor.callLater(options.duration, finish)
+    reactor.run()
+
+    sys.stdout.write(json.dumps(results.asDict()) + '\n')
+
+#------------------------------------------------------------------------------
+def getServerStats(options):
+    ''' Logs in as the admin user and gets the servers stats '''
+    stats = {}
+    admin = client.RpcClient(service.RpcService(), options.host,
+                             options.port, options.admin_user, 'loadgen')
+    d = admin.connect()
+    d.addCallback(lambda *a: admin.login())
+    d.addCallback(lambda *a: admin.getStats().deferred)
+    d.addCallback(stats.update)
+    d.addCallback(lambda *a: admin.logout().deferred)
+    d.addBoth(lambda *a: reactor.stop())
+    reactor.run()
+    return stats
+
+def summarize(workerResults, duration, before, after):
+    ''' Combines the results of the processes, and the servers stats '''
+    counts = defaultdict(int)
+    loginSecs, propagationSecs, helpSecs = [], [], []
+    for r in workerResults:
+        for k, v in r['counts'].iteritems():
+            counts[k] += v
+        loginSecs.extend(r['loginSecs'])
+        propagationSecs.extend(r['propagationSecs'])
+        helpSecs.extend(r['helpSecs'])
+
+    summary = {'duration' : duration,
+               'counts' : dict(counts),
+               'callsPerSec' : counts['calls'] / float(duration),
+               'latency' : {}}
+    for name, values in (('login', loginSecs),
+                         ('propagation', propagationSecs),
+                         ('help answer', helpSecs)):
+        summary['latency'][name] = {'p50' : percentile(values, 0.5),
+                                    'p90' : percentile(values, 0.9),
+                                    'p99' : percentile(values, 0.99),
+                                    'samples' : len(values)}
+
+    if before and after:
+        wall = after['time'] - before['time']
+        cpu = after['process']['cpuSecs'] - before['process']['cpuSecs']
+        summary['server'] = {'cpuFraction' : cpu / wall,
+                             'wallSecs' : wall,
+                             'rssKb' : after['process'].get('rssKb'),
+                             'maxRssKb' : after['process']['maxRssKb']}
+    return summary
+
+def report(summary, out):
+    counts = defaultdict(int, summary['counts'])
+    out.write('logins: %d ok, %d failed, %d unfinished\n' %
+              (counts['logins'], counts['loginErrors'],
+               counts['loginsUnfinished']))
+    out.write('calls: %d (%.1f/s), %d failed\n' %
+              (counts['calls'], summary['callsPerSec'], counts['callErrors']))
+    for name in sorted(counts):
+        if name not in ('logins', 'loginErrors', 'loginsUnfinished',
+                        'calls', 'callErrors'):
+            out.write('  %-20s %d\n' % (name, counts[name]))
+
+    for name in ('login', 'propagation', 'help answer'):
+        latency = summary['latency'][name]
+        out.write('%-12s latency p50 %.3fs p90 %.3fs p99 %.3fs (%d samples)\n' %
+                  (name, latency['p50'], latency['p90'], latency['p99'],
+                   latency['samples']))
+
+    server = summary.get('server')
+    if server:
+        out.write('server cpu: %.1f%% over %.0fs\n' %
+                  (100 * server['cpuFraction'], server['wallSecs']))
+        out.write('server rss: %s KB (peak %s KB)\n' %
+                  (server['rssKb'] or '?', server['maxRssKb']))
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('', '--host', default=HOST)
+    parser.add_option('', '--port', type='int', default=PORT)
+    parser.add_option('-u', '--users', type='int', default=100,
+                      help='the number of bots')
+    parser.add_option('-p', '--processes', type='int', default=1,
+                      help='the number of processes the bots are split over')
+    parser.add_option('-m', '--mix', default='mixed', choices=sorted(MIXES),
+                      help='what the bots do, one of ' + ', '.join(sorted(MIXES)))
+    parser.add_option('-d', '--duration', type='float', default=60,
+                      help='seconds to run for')
+    parser.add_option('', '--login-rate', type='float', default=50,
+                      help='logins per second, 0 logs everyone in at once')
+    parser.add_option('', '--action-every', type='float', default=10,
+                      help='seconds between the actions of each bot')
+    parser.add_option('', '--cascading', type='float', default=0.5,
+                      help='the fraction of bots that start off cascading')
+    parser.add_option('', '--prefix', default='bot',
+                      help='prefix of the bots usernames')
+    parser.add_option('', '--admin-user',
+                      help='an admin user on the server, used to get its stats')
+    parser.add_option('', '--worker', type='int',
+                      help='used internally to run one of the processes')
+    parser.add_option('', '--stats-only', action='store_true',
+                      help='just print the servers stats as json')
+    parser.add_option('', '--json', action='store_true',
+                      help='print the results as json')
+    (options, args) = parser.parse_args()
+
+    if options.worker is not None:
+        runWorker(options, options.worker)
+        sys.exit(0)
+    if options.stats_only:
+        sys.stdout.write(json.dumps(getServerStats(options)) + '\n')
+        sys.exit(0)
+
+    #the reactor can't be restarted, so everything that uses it is run in
+    #another process
+    def spawn(*args):
+        return subprocess.Popen([sys.executable, __file__] + list(args) +
+                                sys.argv[1:], stdout=subprocess.PIPE)
+    def result(process):
+        return json.loads(process.communicate()[0].strip().splitlines()[-1])
+
+    before = after = None
+    if options.admin_user:
+        before = result(spawn('--stats-only'))
+
+    started = time.time()
+    workers = [spawn('--worker', str(i)) for i in range(options.processes)]
+    workerResults = [result(w) for w in workers]
+    duration = time.time() - started
+
+    if options.admin_user:
+        after = result(spawn('--stats-only'))
+
+    summary = summarize(workerResults, duration, before, after)
+    if options.json:
+        sys.stdout.write(json.dumps(summary) + '\n')
+    else:
+        report(summary, sys.stdout)
@@ -116,7 +116,7 @@ class MessageDialog:
 
         window = builder.get_object('wnMap')
 
-        mapwidget = Map(builder.get_object('tbMap'),
+        mapwidget = Map(builder.get_object('daMap'),
                         self.locator,
                         self.cascaders)
 
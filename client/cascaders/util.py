@@ -1,32 +1,38 @@
 '''
-This is a bit messy, but this is a set of utility functions
+This is a bit messy, but this is a set of utility functions for the gui.
+Anything that doesn't need gtk belongs in the core package
 '''
 import time
 from logging import error
 
-import gtk 
+import gtk
+import gobject
 
-from collections import defaultdict
-
-class CallbackMixin(object):
+class UpdateScheduler(object):
     '''
-    Simple class that allows callbacks to be registed and called. For each
-    id it supports multiple callbacks
+    Coalesces calls to a function, so however many times schedule is called
+    the function is run at most once per interval with the arguments from
+    the last call. This is used to stop bursts of events causing the gui to
+    redraw for each one
     '''
-    def __init__(self):
-        self._callbacks = defaultdict(list)
-
-    def _addCallback(self, name, f):
-        self._callbacks[name].append(f)
+    def __init__(self, function, interval=50):
+        '''
+        interval - the minimum time between calls in milliseconds
+        '''
+        self.function = function
+        self.interval = interval
+        self.pending = None
+        self.args = ()
 
-    def _callCallbacks(self, name, *args, **kwargs):
-        return [f(*args, **kwargs) for f in self._callbacks[name]]
+    def schedule(self, *args):
+        self.args = args
+        if self.pending is None:
+            self.pending = gobject.timeout_add(self.interval, self._run)
 
-    def _numCallbacks(self, name):
-        try:
-            return len(self._callbacks[name])
-        except KeyError:
-            return 0
+    def _run(self):
+        self.pending = None
+        self.function(*self.args)
+        return False #we should return false here due to using timeout_add
 
 def errorDialog(msg):
     '''
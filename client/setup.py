@@ -15,7 +15,7 @@ setup(name='Cascaders',
       author='CompSoc Edinburgh',
       author_email='compsoc-committee@googlegroups.com',
       url='http://www.comp-soc.com',
-      packages=['cascaders',],
+      packages=['cascaders', 'cascaders.core',],
       package_data = {'cascaders' : ['data/*', 'gui/*', 'icons/*',]},
       scripts=['cascadersapp',],
       data_files=[('/usr/share/applications/', ['cascaders/data/cascaders.desktop']),],
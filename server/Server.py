@@ -2,26 +2,130 @@ from __future__ import with_statement
 
 from twisted.spread import pb
 from twisted.internet import reactor
+from twisted.web.server import Site
 
 from threading import RLock
 
 import logging
 import logging.handlers
+import os
+import socket
+import resource
+import sys
+import uuid
+from optparse import OptionParser
+
+from admission import LoginAdmission
+from asynclog import startAsyncLogging, configureCategory
+from broker import listenBroker, SOCKET_FILENAME as BROKER_SOCKET
+from cluster import Cluster, PeerSession
+from instrument import Instrumentation, StatsDumper, BUCKETS
+from helpbroker import HelpBroker, WAIT_BUCKETS
+from handoff import (HandoffListener, Takeover, listenHandoff,
+                     SOCKET_FILENAME as HANDOFF_SOCKET)
+from journal import PresenceJournal, sessionState
+from metrics import MetricsResource
+from outbound import OutboundQueue
+from broadcast import BroadcastScheduler, FANOUT_BUCKETS
+from heartbeat import HeartbeatWheel
+from locations import loadHostLabs
+from presencelog import PresenceLog
+from presenceindex import CascaderIndex
+from subscriptions import SubscriptionIndex
+from tracing import trace
+from workers import (Supervisor, listenAdopted, listenReusePort,
+                     workerFilename)
 
 #------------------------------------------------------------------------------
 # consts
 
+PORT = 5010
+
 TIMEOUT_SECS = 10
 PING_EVERY_SECS = 30
+#how often the heartbeat wheel moves on a slot
+HEARTBEAT_TICK_SECS = 1
+
+#presence changes are gathered for this long before being sent to clients
+BROADCAST_WINDOW_SECS = 0.25
+
+#number of presence changes kept so clients can sync with just the changes
+DELTA_LOG_SIZE = 10000
+
+#how long a cascader has to answer a request for help before it is offered
+#to the next cascader. The client gives up a little before this
+HELP_ATTEMPT_SECS = 60
+#the longest a request for help is held before the user asking is told no
+#one can help
+HELP_TIMEOUT_SECS = 300
+#how often requests waiting for a free cascader are looked at again
+HELP_RETRY_SECS = 5
+
+#the number of logins that can be in progress at once (a login is in progress
+#until the client has got its first list of cascaders)
+MAX_LOGINS_IN_FLIGHT = 50
+#the longest a login counts as in progress
+LOGIN_HOLD_SECS = 30
+#the longest a client is told to wait before trying to login again
+MAX_LOGIN_RETRY_SECS = 120
+
+#calls to a client are held back while it has this many unanswered or this
+#many bytes waiting to be written to it. At most MAX_QUEUED_CALLS are held,
+#presence updates are merged into the one already held
+MAX_UNANSWERED_CALLS = 20
+MAX_OUTBOUND_BYTES = 256 * 1024
+MAX_QUEUED_CALLS = 100
+#a client that is held back for this long is disconnected
+SLOW_CLIENT_SECS = 60
+
+#where the presence of the users logged in is journaled so it can be put
+#back after a restart (see journal.py), how often the journal is compacted
+#and the most records it gets to before it is compacted early
+JOURNAL_FILENAME = 'cascader-presence.journal'
+JOURNAL_COMPACT_SECS = 300
+JOURNAL_MAX_RECORDS = 10000
+#how long the users put back after a restart are kept for their clients to
+#reconnect. Clients back off for up to two minutes and may then be told to
+#retry their login
+PROVISIONAL_SECS = 300
+
+#when handing over to a new server process (see handoff.py) the clients
+#are moved over to it spread out over this many seconds
+DRAIN_SECS = 30
+
+#where the call stats are written to and how often
+STATS_FILENAME = 'cascader-stats.json'
+STATS_DUMP_SECS = 60
+
+#the metrics port only listens on this interface
+METRICS_INTERFACE = '127.0.0.1'
 
 #------------------------------------------------------------------------------
 # logging
 
 LOG_FILENAME = 'cascader.log'
 
+#the most log records waiting to be written, after this they are dropped
+LOG_QUEUE_SIZE = 10000
+
 logger = logging.getLogger('MyLogger')
 logger.setLevel(logging.DEBUG)
 
+#categories of logging that can have their own level and sampling, see
+#configureCategory
+presenceLogger = logging.getLogger('MyLogger.presence')
+syncLogger = logging.getLogger('MyLogger.sync')
+helpLogger = logging.getLogger('MyLogger.help')
+messageLogger = logging.getLogger('MyLogger.messages')
+LOG_CATEGORIES = {'presence' : presenceLogger,
+                  'sync' : syncLogger,
+                  'help' : helpLogger,
+                  'messages' : messageLogger,
+                  'trace' : logging.getLogger('MyLogger.trace')}
+
+#the text of messages is only logged at debug
+messageLogger.setLevel(logging.INFO)
+
 handler = logging.handlers.TimedRotatingFileHandler(LOG_FILENAME,
                                                     when='W6',
                                                     interval=1,
@@ -33,8 +137,12 @@ handler = logging.handlers.TimedRotatingFileHandler(LOG_FILENAME,
 formmatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
 handler.setFormatter(formmatter)
-logger.addHandler(handler)
-logger.addHandler(logging.StreamHandler())
+
+#the handlers are written to from a background thread so that writing the
+#log never holds up the reactor
+logQueue, logListener = startAsyncLogging(logger,
+                                          [handler, logging.StreamHandler()],
+                                          LOG_QUEUE_SIZE)
 
 #------------------------------------------------------------------------------
 class ClientNotConnected(pb.Error):
@@ -43,6 +151,20 @@ class ClientNotConnected(pb.Error):
     client not being connected
     '''
     pass
+
+class NotLoggedIn(pb.Error):
+    '''
+    Used when a client calls a session that has been logged out, such as when
+    its heartbeat timed out. The client should log in again
+    '''
+    pass
+
+class LoginBusy(pb.Error):
+    '''
+    Used when too many clients are logging in at once. The message is the
+    number of seconds the client should wait before trying again
+    '''
+    pass
 #------------------------------------------------------------------------------
 # constants
 subjectList = set(["inf1-fp","inf1-cl","inf1-da","inf1-op","inf2a","inf2b","inf2c-cs",
@@ -58,154 +180,365 @@ data_lock = RLock()
 #global dict of users that are currently logged in
 users = {}
 
+#the lab of each host, from the same hosts file that the client uses
+hostLabs = loadHostLabs()
+
+#what labs and subjects each client wants presence updates for
+subscriptions = SubscriptionIndex()
+
+#who is cascading in which labs and subjects
+cascaderIndex = CascaderIndex(hostLabs)
+
+#versions every presence change
+presenceLog = PresenceLog(DELTA_LOG_SIZE)
+
+#batches up presence changes and sends them to the clients once per window
+broadcaster = BroadcastScheduler(users, BROADCAST_WINDOW_SECS, presenceLog,
+                                 subscriptions, hostLabs)
+
+#logs out clients that are no longer connected
+heartbeats = HeartbeatWheel(PING_EVERY_SECS, TIMEOUT_SECS, HEARTBEAT_TICK_SECS)
+
+#the users that can call admin functions such as stats
+admins = set()
+
+#counts and times calls to the services
+instrumentation = Instrumentation()
+
+#stops too many clients logging in at once
+loginAdmission = LoginAdmission(MAX_LOGINS_IN_FLIGHT, LOGIN_HOLD_SECS,
+                                MAX_LOGIN_RETRY_SECS)
+
+#counts what happens to the calls held back for slow clients, along with
+#the calls held and bytes waiting for all the clients right now, shared by
+#the OutboundQueue of every session
+outboundStats = {'queued' : 0, 'coalesced' : 0, 'dropped' : 0,
+                 'disconnected' : 0, 'held' : 0, 'behind' : 0,
+                 'waitingBytes' : 0}
+
+#shares the users with the other workers, this is only set when running as
+#one of several workers (see workers.py)
+cluster = None
+
+#keeps the presence of the users logged in so a restarted server can put
+#them back, this is None if presence isn't journaled
+journal = None
+
+#waits for a new server process to take over from this one, this is None
+#if the server can't be handed over
+handoff = None
+
+#counts what happens to the users put back after a restart, and how many
+#are still waiting for their clients
+provisionalStats = {'restored' : 0, 'resumed' : 0, 'replaced' : 0,
+                    'expired' : 0, 'waiting' : 0}
+
+#provides callLater for the server's own timeouts, this is only not the
+#reactor when simulating (see simulate.py)
+clock = reactor
+
+def presenceRecorded(session):
+    '''
+    Passes the state of a user logged in here on to the journal, and to
+    the new server if this one is being handed over
+    '''
+    if journal is not None:
+        journal.record(session)
+    if handoff is not None:
+        handoff.record(session)
+
+def presenceGone(username):
+    if journal is not None:
+        journal.gone(username)
+    if handoff is not None:
+        handoff.gone(username)
+
 
 class UserService(pb.Referenceable):
-    def __init__(self, client, user, hostname):
+
+    #a session put back after a restart is provisional until its client
+    #comes back (see ProvisionalSession)
+    provisional = False
+
+    def __init__(self, client, user, hostname, previous=None):
+        '''
+        previous - the session being taken over, either a PeerSession of the
+        user on another worker or a ProvisionalSession put back after a
+        restart. The user keeps the state they had there
+        '''
         self.client = client 
         self.user = user
         self.hostname = hostname
         self.stale = False
         self.cascading = False
         self.subjects = set()
+        #given to the client so it can take over this session if it
+        #reconnects before the session has timed out
+        self.resumeToken = uuid.uuid4().hex
+        if previous is not None:
+            self.cascading = previous.cascading
+            self.subjects = set(previous.subjects)
+            self.resumeToken = previous.resumeToken
+        #everything but pings is sent to the client through this
+        self.outbound = OutboundQueue(client, MAX_QUEUED_CALLS,
+                                      MAX_OUTBOUND_BYTES, MAX_UNANSWERED_CALLS,
+                                      SLOW_CLIENT_SECS, self.clientLost,
+                                      outboundStats, clock)
+        replacing = user in users
         users[user] = self
+        if previous is not None:
+            subscriptions.subscribe(user, *previous.interests)
+        else:
+            subscriptions.subscribe(user)
+        cascaderIndex.update(self)
+        if replacing:
+            broadcaster.changed(user)
+        if cluster is not None:
+            cluster.publish(self, takeover=previous is not None)
+        presenceRecorded(self)
+
+        #This ensures that cascaders who are not connected are removed from
+        #the system. This also will logout users if they take too long to
+        #respond
+        heartbeats.add(self)
+
+    @property
+    def interests(self):
+        ''' The labs and subjects the client is subscribed to '''
+        return subscriptions.interests.get(self.user, (None, None))
+
+    def remoteMessageReceived(self, broker, message, args, kw):
+        '''
+        Every call from the client shows that it is still there, so counts
+        as a heartbeat
 
-        self.startPingClientLoop()
+        Once the session is logged out calls are refused, as otherwise they
+        would put the user back into the shared indexes
+        '''
+        if self.stale and message != 'logout':
+            raise NotLoggedIn(self.user)
+        heartbeats.touch(self)
+        return pb.Referenceable.remoteMessageReceived(self, broker, message,
+                                                      args, kw)
 
-    def startPingClientLoop(self):
+    def _presenceChanged(self):
         '''
-        This ensures that cascaders who are not connected are removed from 
-        the system. This also will logout users if they take too long to
-        respond
+        Must be called after the cascading state or subjects change. Updates
+        the indexes and queues a presence update for the other clients
         '''
-        try:
-            timeoutCall = reactor.callLater(TIMEOUT_SECS, self.remote_logout)
-            d = self.client.callRemote('ping')
-            d.addCallback(lambda r: timeoutCall.cancel())
-            reactor.callLater(PING_EVERY_SECS, self.startPingClientLoop)
-        except pb.DeadReferenceError:
-            logger.debug('Ping to %s failed... the user must have quit' % self.user)
-            self.remote_logout()
-    
+        cascaderIndex.update(self)
+        broadcaster.changed(self.user)
+        if cluster is not None:
+            cluster.publish(self)
+        presenceRecorded(self)
+
+    def clientLost(self):
+        '''
+        Called when the connection to the client has gone. The session is
+        kept for a little while in case the client reconnects (see resume)
+        '''
+        if not self.stale:
+            heartbeats.lost(self)
+
+    def resume(self, client, hostname, epoch, version):
+        '''
+        Moves the session over to a new connection from the same client,
+        keeping the subjects and cascading state. Returns the changes the
+        client has missed, in the same form as remote_syncSince
+        '''
+        presenceLogger.info('%s resumed their session', self.user)
+        self.client = client
+        self.outbound.setClient(client)
+        heartbeats.touch(self)
+        if hostname != self.hostname:
+            with data_lock:
+                self.hostname = hostname
+                self._presenceChanged()
+        return self._sync(epoch, version)
+
     def remote_logout(self):
         '''
         Automatically called when the client disconnects
 
         Cleans up after itself and will remove the information from the local lists
         '''
-        logging.info(self.user + "left")
+        presenceLogger.info('%s left', self.user)
         if self.stale:
             return
         self.stale = True
 
-        del users[self.user] 
+        heartbeats.remove(self)
+        self.outbound.close()
+        loginAdmission.done(self.user)
+        helpBroker.cancel(self.user)
+        with data_lock:
+            del users[self.user]
+            subscriptions.unsubscribe(self.user)
+            cascaderIndex.remove(self.user)
+            #Need to inform other clients
+            broadcaster.userLeft(self.user, self.hostname)
+        if cluster is not None:
+            cluster.loggedOut(self)
+        presenceGone(self.user)
+
+    def expire(self):
+        '''
+        Called when the client stopped answering heartbeats. As well as
+        logging out the connection is dropped, so a client that was only
+        stalled notices and logs in again rather than carrying on calling a
+        session that no longer exists
+        '''
+        self.remote_logout()
+        try:
+            self.client.broker.transport.loseConnection()
+        except AttributeError:
+            pass
 
-        #Need to inform other clients 
+    def handedOver(self):
+        '''
+        Called when the user is now logged in to another worker, or is being
+        moved to a new server process. The session is closed without the
+        other clients being told that the user left.
+
+        Any help requests the user is waiting on are left with the helpBroker,
+        which reaches them through the worker they are on now. When moving to
+        a new server process they have already been handed over (see
+        drainSession)
+        '''
+        presenceLogger.info('%s moved to another worker or server', self.user)
+        self.stale = True
+        heartbeats.remove(self)
+        self.outbound.close()
+        loginAdmission.done(self.user)
         with data_lock:
-            toLogout = []
-            for user in users.itervalues():
-                try:
-                    if user.cascading:
-                        user.client.callRemote('cascaderLeft', self.user)
-                    user.client.callRemote('userLeft', self.user)
-                except pb.DeadReferenceError:
-                    logger.debug('Client wasn\'t connected')
-                    toLogout.append(user)
-            [u.remote_logout() for u in toLogout]
+            del users[self.user]
+            subscriptions.unsubscribe(self.user)
+            cascaderIndex.remove(self.user)
+            broadcaster.forget(self.user)
+        if journal is not None:
+            journal.gone(self.user)
+        try:
+            self.client.broker.transport.loseConnection()
+        except AttributeError:
+            pass
 
     def remote_startCascading(self):
         '''
         Called by the client when the user wants to start cascading
 
-        It will also envoke cascaderJoined in all the clients connected to let them
-        know that the user has started cascading and to update their local lists
+        It will also queue a presence update so that all the clients connected
+        are told that the user has started cascading and can update their
+        local lists
         '''
+        self._startCascading()
 
-        self.cascading = True
-        logger.info(self.user + " is going to start cascading")
-        with data_lock:
-            #Need to inform all other clients that this cascader has joined
-            toLogout = []
-            for user in users.itervalues():
-                #This a remote procedure call to the client
-                try:
-                    user.client.callRemote('cascaderJoined', self.user,
-                                            self.hostname, self.subjects)
-                except pb.DeadReferenceError:
-                    logger.debug('Client wasn\'t connected')
-                    toLogout.append(user)
-            [u.remote_logout() for u in toLogout]
-
-        logger.info(self.user + " has started cascading")
+    def _startCascading(self):
+        presenceLogger.debug('%s is going to start cascading', self.user)
+        self._setState(True, self.subjects)
+        presenceLogger.info('%s has started cascading', self.user)
 
     def remote_stopCascading(self):
         '''
         Call by the client when the user wants to stop cascading
 
-        It will also envoke cascaderLeft on all of the clients connected to let 
-        them know to update their local lists
+        It will also queue a presence update so that all of the clients
+        connected know to update their local lists
         '''
+        self._stopCascading()
 
-        self.cascading = False
-        with data_lock:
-            toLogout = []
-            for user in users.itervalues():
-                try:
-                    user.client.callRemote('cascaderLeft', self.user)
-                except pb.DeadReferenceError:
-                    logger.debug('Client wasn\'t connected')
-                    toLogout.append(user)
-            [u.remote_logout() for u in toLogout]
-
-        logger.info(self.user + " has stopped cascading")
+    def _stopCascading(self):
+        self._setState(False, self.subjects)
+        presenceLogger.info('%s has stopped cascading', self.user)
 
     def remote_addSubjects(self, subjects):
         '''
         Called by the client when the user adds some subjects to their collections
 
-        It will also envoke casscaderAddedSubjects on all clients connected to 
-        notify them and so they can update their local lists
+        It will also queue a presence update so that all clients connected are
+        notified and can update their local lists
         '''
+        self._addSubjects(subjects)
 
-        #strip out things not listed in the valid subjects
-        subjects = set(subjects).intersection(subjectList)
-
+    def _addSubjects(self, subjects):
         with data_lock:
-            self.subjects.update(subjects)
-            if self.cascading: #don't need to inform if not cascaing
-                toLogout = []
-                for user in users.itervalues():
-                    try:
-                        user.client.callRemote('cascaderAddedSubjects', self.user, subjects)
-                    except pb.DeadReferenceError:
-                        logger.debug('Client wasn\'t connected')
-                        toLogout.append(user)
-                [u.remote_logout() for u in toLogout]
-
-        logger.info(self.user + " added " + str(list(subjects)) + " to their subject list")
+            self._setState(self.cascading, self.subjects | set(subjects))
+
+        presenceLogger.info('%s added %s to their subject list', self.user,
+                            list(subjects))
 
     def remote_removeSubjects(self, subjects):
         '''
         Called by the client when the user removes some subjects from their 
         collection
 
-        It will also envoke cascaderRemovedSubjects on all clients connected to 
-        notify them and so they can update their local lists
+        It will also queue a presence update so that all clients connected are
+        notified and can update their local lists
         '''
-        subjects = set(subjects).intersection(subjectList)
+        self._removeSubjects(subjects)
 
+    def _removeSubjects(self, subjects):
         with data_lock:
-            self.subjects = self.subjects - set(subjects)
+            self._setState(self.cascading, self.subjects - set(subjects))
 
-            toLogout = []
-            for user in users.itervalues():
-                try:
-                    user.client.callRemote('cascaderRemovedSubjects', self.user, subjects)
-                except pb.DeadReferenceError:
-                    logger.debug('Client wasn\'t connected')
-                    toLogout.append(user)
-            [u.remote_logout() for u in toLogout]
+        presenceLogger.info('%s removed %s from their list', self.user,
+                            list(subjects))
 
-        logger.info(self.user + " removed " + str(list(subjects)) + " from their list")
+    def remote_setState(self, cascading, subjects):
+        '''
+        Sets whether the user is cascading and the full set of subjects they
+        cascade in. Subjects that are not listed in the valid subjects are
+        ignored.
+
+        Only a real change queues a presence update (one for the whole
+        change), so this is safe to call again with the same state, for
+        example after reconnecting. Returns True if anything changed
+        '''
+        return self._setState(cascading, subjects)
+
+    def _setState(self, cascading, subjects):
+        subjects = set(subjects).intersection(subjectList)
+        cascading = bool(cascading)
+
+        with data_lock:
+            if self.stale:
+                return False
+            if cascading == self.cascading and subjects == self.subjects:
+                return False
+            self.cascading = cascading
+            self.subjects = subjects
+            self._presenceChanged()
+        return True
+
+    #the calls that can be made through applyBatch
+    BATCH_OPERATIONS = ('startCascading', 'stopCascading',
+                        'addSubjects', 'removeSubjects', 'setState')
+
+    def remote_applyBatch(self, operations):
+        '''
+        Called by the client to make several presence changes in one call,
+        normally the changes it queued up while it wasn't connected.
+
+        operations is a list of (name, args) where name is one of
+        BATCH_OPERATIONS. Returns a list with a (succeeded, result) tuple for
+        each operation, where result is the error message if it failed.
+        Other clients only get a single presence update for the whole batch.
+        The operations are made without going through the remote_ methods,
+        so they are only counted as part of the applyBatch call
+        '''
+        results = []
+        with data_lock:
+            for name, args in operations:
+                if name not in self.BATCH_OPERATIONS:
+                    results.append((False, 'Unknown operation ' + str(name)))
+                    continue
+                try:
+                    result = getattr(self, '_' + name)(*args)
+                except Exception as e:
+                    presenceLogger.warn('Batched %s failed: %s', name, e)
+                    results.append((False, str(e)))
+                else:
+                    results.append((True, result))
+        return results
 
     def remote_getCascaderList(self):
         '''
@@ -217,11 +550,108 @@ class UserService(pb.Referenceable):
         '''
 
         with data_lock:
-            returnvalue = [(value.user, value.hostname, value.subjects)
-                            for value in users.itervalues() if value.cascading]
-        logger.info(self.user + " asked for the cascader list")
+            returnvalue = self._cascaderList(cascaderIndex.find())
+        syncLogger.info('%s asked for the cascader list', self.user)
         return returnvalue
-    
+
+    def remote_findCascaders(self, lab, subjects):
+        '''
+        Called by the client to find the cascaders in the lab that are
+        cascading in any of the subjects. None for either means any.
+
+        Returns the same as getCascaderList
+        '''
+        with data_lock:
+            returnvalue = self._cascaderList(cascaderIndex.find(lab, subjects))
+        syncLogger.info('%s looked for cascaders in %s for %s', self.user, lab,
+                        subjects)
+        return returnvalue
+
+    def _cascaderList(self, usernames):
+        return [(users[u].user, users[u].hostname, users[u].subjects)
+                for u in usernames]
+
+    def _subscribedCascaders(self):
+        ''' The usernames of the cascaders this client is subscribed to '''
+        labs, subjects = self.interests
+        if labs is None:
+            return cascaderIndex.find(None, subjects)
+        result = set()
+        for lab in labs:
+            result |= cascaderIndex.find(lab, subjects)
+        return result
+
+    def _isInterestedIn(self, user):
+        return user.cascading and subscriptions.isInterested(
+                                    self.user,
+                                    hostLabs.labFromHostname(user.hostname),
+                                    user.subjects)
+
+    def _sync(self, epoch, version):
+        '''
+        Works out what the client needs to be brought up to date from the
+        given version. If the changes since that version are not known a
+        snapshot of all the cascaders the client is interested in is used
+        instead.
+
+        Returns a dict of:
+            epoch, version - what the client should sync from next time
+            snapshot - True if cascaders is everything, so the client should
+                       throw away what it had
+            cascaders - list of (username, hostname, subjects)
+            left - list of usernames that are no longer cascading
+        '''
+        with data_lock:
+            changed = presenceLog.changedSince(epoch, version)
+            cascaders, left = [], []
+            if changed is None:
+                cascaders = self._cascaderList(self._subscribedCascaders())
+            else:
+                for username in changed:
+                    value = users.get(username)
+                    if value is not None and self._isInterestedIn(value):
+                        cascaders.append((value.user, value.hostname,
+                                          value.subjects))
+                    else:
+                        left.append(username)
+
+            broadcaster.synced(self.user)
+            loginAdmission.done(self.user)
+            return {'epoch' : presenceLog.epoch,
+                    'version' : presenceLog.version,
+                    'snapshot' : changed is None,
+                    'cascaders' : cascaders,
+                    'left' : left}
+
+    def remote_syncSince(self, epoch, version):
+        '''
+        Called by the client to get the presence changes since the given
+        version (see _sync for the result). Clients call this on login and
+        whenever they notice that they have missed a change.
+        '''
+        syncLogger.info('%s synced from version %s', self.user, version)
+        return self._sync(epoch, version)
+
+    def remote_subscribe(self, labs, subjects, epoch=None, version=None):
+        '''
+        Called by the client to set which labs and subjects it wants to be
+        told about. After this the client is only sent presence changes for
+        cascaders in one of the labs that are cascading in one of the
+        subjects. None for either labs or subjects means all of them.
+
+        The client should only pass a version if it had exactly this
+        subscription at that version, otherwise it will be sent a snapshot.
+        Returns the same as syncSince
+        '''
+        with data_lock:
+            subscriptions.subscribe(self.user, labs, subjects)
+        if cluster is not None:
+            cluster.publish(self)
+        presenceRecorded(self)
+        syncLogger.info('%s subscribed to labs %s and subjects %s', self.user,
+                        labs, subjects)
+        return self._sync(epoch, version)
+
     def remote_getSubjectList(self):
         '''
         Called by the client requesting a list of the current subjects that can 
@@ -230,62 +660,38 @@ class UserService(pb.Referenceable):
         Will return as a list
         '''
 
-        logger.info(self.user + " asked for the subject list")
+        syncLogger.info('%s asked for the subject list', self.user)
         return subjectList
 
     def remote_askForHelp(self, helpId, username, subject, problem):
         '''
         Called when the client is asking another user for help
 
-        This will call a function on the client that the user who the help is being
-        requested from (userAskingForHelp) and return the result of this function 
-        to the user who called it in the first place
+        The request is passed to the helpBroker, which asks the cascader
+        (calling userAskingForHelp on their client). If they say no, don't
+        answer in time or aren't logged in it is offered to the other
+        cascaders that can help. The client is told how the request is
+        getting on by calls to helpProgress (see HelpBroker)
 
-        The helpId variable is generated by the client and should just be passed on
-        '''
+        Returns a deferred that fires with (accepted, why, cascader), where
+        cascader is who accepted or None if no one did
 
-        logger.info(self.user + " asked " + username + " for help on " + problem + \
-                " in the subject " + subject)
-        try:
-            deferred = users[username].client.callRemote('userAskingForHelp',
-                                                          helpId, self.user,
-                                                          self.hostname,
-                                                          subject, problem) 
-        except pb.DeadReferenceError:
-            logger.debug('Client wasn\'t connected')
-            users[username].remote_logout()
-            raise ClientNotConnected(username)
-        except KeyError:
-            raise ClientNotConnected(username)
-
-        cb = lambda res : self.onAskForHelpResponse(res, helpId, username, subject, problem)
-        deferred.addCallback(cb)
-        return deferred 
-
-    def onAskForHelpResponse(self, result, helpId, cascUsername, subject, problem):
-        '''
-        Deals with logging from the cascaders response for asking for hlp
+        The helpId variable is generated by the client and should just be passed on
         '''
-        (answer,why) = result
 
-        if answer:
-            logger.info(cascUsername + " said yes, help is now being given")
+        helpLogger.info('%s asked %s for help on %s in the subject %s',
+                        self.user, username, problem, subject)
+        trace(helpId, 'server.askForHelp.received', user=self.user,
+              cascader=username)
+        if username not in users:
+            trace(helpId, 'server.askForHelp.notConnected', cascader=username)
 
-            messages = [cascUsername + ' accepted your help request',
-                        'Remember to use pastebin to show code',
-                        ('It may be easier to ask for a cascader to come to '
-                         'your desk so you can explain the problem in person')]
-            for m in messages:
-                self.serverMessage(helpId, m)
-
-            msgToCasc = '%s wanted help with %s because: %s' % (self.user, subject, problem)
-            users[cascUsername].serverMessage(helpId, msgToCasc)
-        else:
-            logger.info(cascUsername + " said no: " + why)
-
-            msg = cascUsername + ' rejected your help request' 
-            self.client.callRemote('serverSentMessage', helpId, msg)
-        return result
+        def onAnswer(result):
+            helpAnswered(result, helpId, self.user, subject, problem)
+            trace(helpId, 'server.askForHelp.replied')
+            return result
+        d = helpBroker.ask(helpId, self.user, username, subject, problem)
+        return d.addCallback(onAnswer)
 
     def remote_sendMessage(self, helpId, toUser, message):
         '''
@@ -296,7 +702,8 @@ class UserService(pb.Referenceable):
 
         HelpId is generated by the client and should just be passed on
         '''
-        logger.info(self.user + "->" + toUser + ":" + message)
+        messageLogger.info('%s->%s (%d chars)', self.user, toUser, len(message))
+        messageLogger.debug('%s->%s:%s', self.user, toUser, message)
 
         try:
             return users[toUser].message(helpId, message)
@@ -319,20 +726,29 @@ class UserService(pb.Referenceable):
         '''
 
         try:
-            return self.client.callRemote('userSentMessage', helpId, message)
+            return self.outbound.callRemote('userSentMessage', helpId, message)
         except pb.DeadReferenceError:
             logger.debug('DeadRef. Client not connected')
-            self.remote_logout()
+            self.clientLost()
             raise ClientNotConnected(self.user)
 
     def serverMessage(self, helpId, message):
         try:
-            return self.client.callRemote('serverSentMessage', helpId, message)
+            return self.outbound.callRemote('serverSentMessage', helpId, message)
         except pb.DeadReferenceError:
             logger.debug('DeadRef. Client not connected')
-            self.remote_logout()
+            self.clientLost()
             raise ClientNotConnected(self.user)
 
+    def remote_stats(self):
+        '''
+        Admin only. Returns the call stats for each remote method along with
+        the stats kept by the rest of the server
+        '''
+        if self.user not in admins:
+            raise ValueError('Only admins can get the stats')
+        return serverStats()
+
     def remote_ping(self):
         ''' Can be used to see that the server is up and functioning '''
         return 'pong'
@@ -347,13 +763,708 @@ class LoginService(pb.Root):
     to access other methods. This reduces the amount of checks required
     in the UserService class
     '''
-    def remote_userJoin(self, client, username, hostname):
-        if username in users:
-            raise ValueError("Username in use")
-        else:
-            return UserService(client, username, hostname)
+    def remote_userJoin(self, client, username, hostname, resumeToken=None,
+                        epoch=None, version=None):
+        '''
+        Logs the user in, returning a dict of:
+            server - the UserService for the client to use
+            resumeToken - given back on a reconnect to resume the session
+            resumed - True if an existing session was resumed
+            sync - if resumed, the changes since epoch and version (see
+                   remote_syncSince), otherwise None
+
+        A client that reconnects with the resumeToken it was given before the
+        old session timed out gets the old session back, with the subjects
+        and cascading state it had
+        '''
+        existing = users.get(username)
+        replacing = None
+        if (existing is not None and existing.provisional and
+                resumeToken != existing.resumeToken):
+            #a new login rather than the client that was logged in before
+            #the restart, so what was put back is out of date
+            replacing, existing = existing, None
+        if existing is not None:
+            if resumeToken is None or resumeToken != existing.resumeToken:
+                raise ValueError("Username in use")
+            if isinstance(existing, (PeerSession, ProvisionalSession)):
+                #reconnected to a different worker, or after a restart
+                if isinstance(existing, ProvisionalSession):
+                    presenceLogger.info('%s came back after the restart',
+                                        username)
+                    provisionalStats['resumed'] += 1
+                    provisionalStats['waiting'] -= 1
+                else:
+                    presenceLogger.info('%s moved here from worker %s',
+                                        username, existing.worker)
+                user = UserService(client, username, hostname, existing)
+                return {'server' : user,
+                        'resumeToken' : user.resumeToken,
+                        'resumed' : True,
+                        'sync' : user._sync(epoch, version)}
+            return {'server' : existing,
+                    'resumeToken' : existing.resumeToken,
+                    'resumed' : True,
+                    'sync' : existing.resume(client, hostname, epoch, version)}
+
+        retryAfter = loginAdmission.admit(username)
+        if retryAfter is not None:
+            logger.debug('%s told to retry login in %.1fs', username, retryAfter)
+            raise LoginBusy('%.1f' % retryAfter)
+        user = UserService(client, username, hostname)
+        if isinstance(replacing, ProvisionalSession):
+            provisionalStats['replaced'] += 1
+            provisionalStats['waiting'] -= 1
+        return {'server' : user,
+                'resumeToken' : user.resumeToken,
+                'resumed' : False,
+                'sync' : None}
+
+instrumentation.instrumentClass(UserService)
+instrumentation.instrumentClass(LoginService)
+
+
+class NotConnected(object):
+    ''' The outbound of a session that has no client '''
+
+    def __len__(self):
+        return 0
+
+    def callRemote(self, name, *args):
+        raise pb.DeadReferenceError('No client')
+
+
+class ProvisionalSession(object):
+    '''
+    A user that was logged in when the server stopped, put back from the
+    journal (or handed over by the old server, see handoff.py) so that the
+    cascader lists aren't empty while the clients reconnect. It has the
+    attributes of a UserService that presence needs, but no client. The
+    client takes it over if it resumes with its resumeToken, a login without
+    the token replaces it, and it expires if neither happens within
+    PROVISIONAL_SECS
+    '''
+
+    provisional = True
+    client = None
+
+    def __init__(self, state):
+        self.stale = False
+        self.user = state['user']
+        self._setState(state)
+        self.outbound = NotConnected()
+
+    def _setState(self, state):
+        self.hostname = state['hostname']
+        self.cascading = state['cascading']
+        self.subjects = set(state['subjects'])
+        self.interests = tuple(state['interests'])
+        self.resumeToken = state['resumeToken']
+
+    def update(self, state):
+        ''' The user changed on the old server before their client moved '''
+        with data_lock:
+            self._setState(state)
+            cascaderIndex.update(self)
+            broadcaster.changed(self.user)
+        presenceRecorded(self)
+
+    def clientLost(self):
+        pass
+
+    def message(self, helpId, message):
+        raise ClientNotConnected(self.user)
+
+    def serverMessage(self, helpId, message):
+        raise ClientNotConnected(self.user)
+
+    def handedOver(self):
+        '''
+        Called when the client has come back to another worker, or the user
+        is being moved to a new server process before their client came back
+        '''
+        self.stale = True
+        provisionalStats['waiting'] -= 1
+        with data_lock:
+            del users[self.user]
+            cascaderIndex.remove(self.user)
+            broadcaster.forget(self.user)
+        if journal is not None:
+            journal.gone(self.user)
+
+    def expire(self):
+        ''' Logs the user out if their client hasn't come back '''
+        if self.stale or users.get(self.user) is not self:
+            return
+        presenceLogger.info('%s didn\'t come back after the restart', self.user)
+        provisionalStats['expired'] += 1
+        self.logout()
+
+    def logout(self):
+        ''' Logs the user out, telling the other clients '''
+        self.stale = True
+        provisionalStats['waiting'] -= 1
+        with data_lock:
+            del users[self.user]
+            cascaderIndex.remove(self.user)
+            broadcaster.userLeft(self.user, self.hostname)
+        if cluster is not None:
+            cluster.loggedOut(self)
+        presenceGone(self.user)
+
+def helpCandidates(request):
+    '''
+    The cascaders that could take a help request, best first. These are the
+    cascader asked for by name, then the cascaders in the subject in the
+    lab of the user asking, then those in any other lab
+    '''
+    candidates = []
+    if request.preferred in users:
+        candidates.append(request.preferred)
+    subjects = [request.subject] if request.subject else None
+    student = users.get(request.student)
+    if student is not None:
+        lab = hostLabs.labFromHostname(student.hostname)
+        if lab is not None:
+            candidates.extend(sorted(cascaderIndex.find(lab, subjects)))
+    candidates.extend(sorted(cascaderIndex.find(None, subjects)))
+    return candidates
+
+def offerHelp(request, cascader):
+    ''' Asks the cascader if they will take the help request '''
+    session, student = users.get(cascader), users.get(request.student)
+    if session is None or student is None:
+        raise ClientNotConnected(cascader)
+    try:
+        d = session.outbound.callRemote('userAskingForHelp', request.helpId,
+                                        request.student, student.hostname,
+                                        request.subject, request.problem)
+    except pb.DeadReferenceError:
+        logger.debug('Client wasn\'t connected')
+        session.clientLost()
+        raise ClientNotConnected(cascader)
+    trace(request.helpId, 'server.userAskingForHelp.sent', cascader=cascader)
+
+    def onAnswer(answer):
+        trace(request.helpId, 'server.userAskingForHelp.answered',
+              cascader=cascader, accepted=answer[0])
+        if answer[0] and (request.done or request.cascader != cascader):
+            #the request has been passed on, so the cascader has to be told
+            trace(request.helpId, 'server.userAskingForHelp.late',
+                  cascader=cascader)
+            msg = ('%s\'s request had already been passed on to someone else'
+                   % request.student)
+            try:
+                session.serverMessage(request.helpId, msg)
+            except ClientNotConnected:
+                pass
+        return answer
+
+    def onErr(reason):
+        trace(request.helpId, 'server.userAskingForHelp.failed',
+              cascader=cascader, error=reason.getErrorMessage())
+        return reason
+    return d.addCallbacks(onAnswer, onErr)
+
+def helpProgress(request, event, details):
+    ''' Tells the user asking for help how their request is getting on '''
+    trace(request.helpId, 'server.help.' + event, **details)
+    session = users.get(request.student)
+    if session is None:
+        return
+    try:
+        d = session.outbound.callRemote('helpProgress', request.helpId, event,
+                                        details)
+    except pb.DeadReferenceError:
+        return
+    #older clients don't have helpProgress
+    d.addErrback(lambda reason: None)
+
+def tellUser(username, helpId, message):
+    ''' Sends a message from the server to a user, if they are still here '''
+    session = users.get(username)
+    if session is None or session.stale:
+        return
+    try:
+        d = session.serverMessage(helpId, message)
+    except ClientNotConnected:
+        return
+    if d is not None:
+        d.addErrback(lambda reason: None)
+
+def helpAnswered(result, helpId, username, subject, problem):
+    '''
+    Tells the user who asked for help, and the cascader who accepted, how
+    the request (see helpBroker) ended. Either may have left since
+    '''
+    (answer, why, cascUsername) = result
+    student = users.get(username)
+    if student is None or student.stale:
+        #the request is cancelled if the user asking logs out
+        return result
+
+    if answer:
+        helpLogger.info('%s said yes, help is now being given', cascUsername)
+
+        messages = [cascUsername + ' accepted your help request',
+                    'Remember to use pastebin to show code',
+                    ('It may be easier to ask for a cascader to come to '
+                     'your desk so you can explain the problem in person')]
+        for m in messages:
+            tellUser(username, helpId, m)
+        trace(helpId, 'server.serverMessage.sent')
+
+        msgToCasc = '%s wanted help with %s because: %s' % (username, subject, problem)
+        tellUser(cascUsername, helpId, msgToCasc)
+    else:
+        helpLogger.info('No one helped %s: %s', username, why)
+        tellUser(username, helpId, 'No cascader accepted your help request')
+    return result
+
+#queues the requests for help and passes them on to the next cascader when
+#one isn't answered
+helpBroker = HelpBroker(helpCandidates, offerHelp, helpProgress,
+                        HELP_ATTEMPT_SECS, HELP_TIMEOUT_SECS, HELP_RETRY_SECS)
+
+def localSessions():
+    ''' The sessions of the users logged in to this worker '''
+    return [u for u in users.values() if not isinstance(u, PeerSession)]
+
+def drainClients():
+    '''
+    Called once a new server process has taken over the port, moves the
+    clients over to it a few at a time (see handoff.py)
+    '''
+    global journal
+    if journal is not None:
+        #the new server keeps the journal from now on
+        journal.stop()
+        journal = None
+    sessions = localSessions()
+    gap = DRAIN_SECS / float(max(len(sessions), 1))
+    for i, session in enumerate(sessions):
+        clock.callLater(i * gap, drainSession, session)
+    clock.callLater(DRAIN_SECS, handoff.finished)
+
+def drainSession(session):
+    if session.stale or users.get(session.user) is not session:
+        return
+    #the new server is sent the latest state before the client moves
+    handoff.record(session)
+    for state in helpBroker.handOver(session.user):
+        handoff.recordHelp(state)
+    session.handedOver()
+
+def handedOverState(state):
+    ''' A user on the old server changed while this server took over '''
+    session = users.get(state['user'])
+    if session is None:
+        restoreSessions([state])
+    elif isinstance(session, ProvisionalSession):
+        session.update(state)
+
+def handedOverGone(username):
+    ''' A user on the old server logged out while this server took over '''
+    session = users.get(username)
+    if isinstance(session, ProvisionalSession):
+        session.logout()
+
+def handedOverHelp(state):
+    ''' A help request from a user moving over from the old server '''
+    d = helpBroker.adopt(state)
+    d.addCallback(helpAnswered, state['helpId'], state['student'],
+                  state['subject'], state['problem'])
+
+def restoreSessions(states):
+    '''
+    Puts back the users that were logged in before a restart, given their
+    states (see sessionState), as ProvisionalSessions which expire after
+    PROVISIONAL_SECS. Returns the sessions
+    '''
+    sessions = [ProvisionalSession(state) for state in states]
+    with data_lock:
+        for session in sessions:
+            users[session.user] = session
+            cascaderIndex.update(session)
+            broadcaster.changed(session.user)
+    provisionalStats['restored'] += len(sessions)
+    provisionalStats['waiting'] += len(sessions)
+    clock.callLater(PROVISIONAL_SECS,
+                    lambda: [session.expire() for session in sessions])
+    return sessions
+
+
+class ClusterPeers(object):
+    '''
+    What the Cluster needs from the server (see cluster.py). The users on
+    the other workers are kept in users as PeerSessions, so presence, syncs
+    and help requests treat them the same as the users on this worker
+    '''
+
+    #the calls the other workers can make to the clients on this worker
+    CALLS = ('userAskingForHelp', 'userSentMessage', 'serverSentMessage',
+             'helpProgress')
+
+    def localSessions(self):
+        return localSessions()
+
+    def peerChanged(self, peer, takeover):
+        with data_lock:
+            existing = users.get(peer.user)
+            if existing is not None and not isinstance(existing, PeerSession):
+                #logged in to two workers at once. A user whose client is
+                #connected wins over one put back after a restart, otherwise
+                #the lower worker keeps the user and the other gives them up
+                if existing.provisional != peer.provisional:
+                    keep = peer.provisional
+                else:
+                    keep = not takeover and cluster.workerId < peer.worker
+                if keep:
+                    return False
+                existing.handedOver()
+            users[peer.user] = peer
+            cascaderIndex.update(peer)
+            broadcaster.changed(peer.user)
+        return True
+
+    def peerGone(self, peer):
+        with data_lock:
+            if users.get(peer.user) is not peer:
+                return
+            del users[peer.user]
+            cascaderIndex.remove(peer.user)
+            broadcaster.userLeft(peer.user, peer.hostname)
+
+    def peerCall(self, username, name, args):
+        session = users.get(username)
+        if (name not in self.CALLS or session is None or
+                isinstance(session, PeerSession)):
+            raise ClientNotConnected(username)
+        try:
+            return session.outbound.callRemote(name, *args)
+        except pb.DeadReferenceError:
+            session.clientLost()
+            raise ClientNotConnected(username)
+
+    def notConnected(self, username):
+        return ClientNotConnected(username)
+
+def processStats():
+    ''' The cpu time and memory used by the server process '''
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats = {'cpuSecs' : usage.ru_utime + usage.ru_stime,
+             'maxRssKb' : usage.ru_maxrss}
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        stats['rssKb'] = pages * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        pass
+    return stats
+
+def serverStats():
+    ''' All the stats the server keeps '''
+    stats = instrumentation.snapshot()
+    stats.update({'usersOnline' : len(users),
+                  'process' : processStats(),
+                  'broadcast' : dict(broadcaster.stats),
+                  'heartbeat' : dict(heartbeats.stats),
+                  'admission' : dict(loginAdmission.stats),
+                  'outbound' : dict(outboundStats),
+                  'help' : dict(helpBroker.stats,
+                                queued=helpBroker.queued(),
+                                waiting=len(helpBroker.requests),
+                                wait=helpBroker.waitStats()),
+                  'logging' : dict(logQueue.stats)})
+    if journal is not None:
+        stats['journal'] = dict(journal.stats)
+    stats['provisional'] = dict(provisionalStats)
+    if cluster is not None:
+        stats['cluster'] = dict(cluster.stats,
+                                worker=cluster.workerId,
+                                peers=len(cluster.sessions))
+    return stats
+
+def writeMetrics(writer):
+    '''
+    Writes the metrics for a scrape to the MetricsWriter. This reads
+    counters that are kept up to date as things happen rather than going
+    through the users, so doesn't take the data_lock
+    '''
+    writer.gauge('cascaders_users_online', 'Users logged in', len(users))
+    writer.gauge('cascaders_cascading', 'Users cascading',
+                 len(cascaderIndex.cascaders))
+    writer.gauge('cascaders_cascading_by_subject', 'Cascaders in each subject',
+                 [({'subject' : subject}, len(usernames))
+                  for subject, usernames in cascaderIndex.bySubject.items()])
+    writer.gauge('cascaders_cascading_by_lab', 'Cascaders in each lab',
+                 [({'lab' : lab}, len(usernames))
+                  for lab, usernames in cascaderIndex.byLab.items()])
+
+    writer.counter('cascaders_presence_events_total',
+                   'Presence changes queued for broadcast',
+                   broadcaster.stats['events'])
+    writer.counter('cascaders_presence_calls_total',
+                   'Presence updates sent to clients',
+                   broadcaster.stats['calls'])
+    writer.histogram('cascaders_broadcast_fanout',
+                     'Clients sent each presence broadcast', FANOUT_BUCKETS,
+                     [({}, broadcaster.fanout, broadcaster.fanoutTotal)])
+
+    writer.gauge('cascaders_client_outbound_bytes',
+                 'Bytes waiting to be sent to the clients, as of the last '
+                 'call to each', outboundStats['waitingBytes'])
+    writer.gauge('cascaders_client_outbound_held',
+                 'Calls held back for the clients that are behind',
+                 outboundStats['held'])
+    writer.gauge('cascaders_clients_behind',
+                 'Clients that have calls held back',
+                 outboundStats['behind'])
+    writer.counter('cascaders_outbound_held_total',
+                   'Calls held back as the client was behind',
+                   outboundStats['queued'])
+    writer.counter('cascaders_outbound_coalesced_total',
+                   'Presence updates merged into one already held',
+                   outboundStats['coalesced'])
+    writer.counter('cascaders_outbound_dropped_total',
+                   'Calls dropped as the clients queue was full',
+                   outboundStats['dropped'])
+    writer.counter('cascaders_slow_clients_disconnected_total',
+                   'Clients disconnected for being behind too long',
+                   outboundStats['disconnected'])
+
+    writer.gauge('cascaders_help_queued',
+                 'Help requests waiting for a free cascader',
+                 helpBroker.queued())
+    writer.gauge('cascaders_help_waiting',
+                 'Help requests that no cascader has accepted yet',
+                 len(helpBroker.requests))
+    writer.counter('cascaders_help_attempts_total',
+                   'Help requests offered to a cascader',
+                   helpBroker.stats['attempts'])
+    writer.counter('cascaders_help_finished_total',
+                   'Help requests by how they finished',
+                   [({'outcome' : outcome}, helpBroker.stats[outcome])
+                    for outcome in ('accepted', 'gaveUp', 'cancelled',
+                                    'handedOver')])
+    writer.counter('cascaders_help_passed_on_total',
+                   'Help requests passed on to the next cascader, by why',
+                   [({'reason' : 'rejected'}, helpBroker.stats['rejected']),
+                    ({'reason' : 'timeout'}, helpBroker.stats['timeouts'])])
+    writer.histogram('cascaders_help_wait_seconds',
+                     'Time from asking for help to it being accepted or given '
+                     'up on', WAIT_BUCKETS,
+                     [({}, helpBroker.waitHistogram, helpBroker.waitTotalSecs)])
+
+    writer.gauge('cascaders_provisional_users',
+                 'Users put back after a restart whose clients haven\'t returned',
+                 provisionalStats['waiting'])
+    writer.counter('cascaders_provisional_resumed_total',
+                   'Users put back after a restart whose clients returned',
+                   provisionalStats['resumed'])
+    writer.counter('cascaders_provisional_replaced_total',
+                   'Users put back after a restart who logged in afresh',
+                   provisionalStats['replaced'])
+    writer.counter('cascaders_provisional_expired_total',
+                   'Users put back after a restart whose clients never returned',
+                   provisionalStats['expired'])
+    if journal is not None:
+        writer.counter('cascaders_journal_records_total',
+                       'Presence changes written to the journal',
+                       journal.stats['records'])
+        writer.counter('cascaders_journal_compactions_total',
+                       'Times the journal was compacted into a snapshot',
+                       journal.stats['compactions'])
+        writer.counter('cascaders_journal_write_errors_total',
+                       'Failed writes to the journal or snapshot',
+                       journal.stats['writeErrors'])
+
+    writer.counter('cascaders_pings_total', 'Pings sent to idle clients',
+                   heartbeats.stats['pings'])
+    writer.counter('cascaders_ping_timeouts_total',
+                   'Clients logged out for not answering',
+                   heartbeats.stats['expired'])
+
+    writer.counter('cascaders_logins_refused_total',
+                   'Logins told to retry later', loginAdmission.stats['refused'])
+    writer.counter('cascaders_log_records_dropped_total',
+                   'Log records dropped as the queue was full',
+                   logQueue.stats['dropped'])
+
+    methods = sorted(instrumentation.methods.items())
+    writer.counter('cascaders_calls_total', 'Calls to each remote method',
+                   [({'method' : name}, stats.calls) for name, stats in methods])
+    writer.counter('cascaders_call_errors_total',
+                   'Calls to each remote method that failed',
+                   [({'method' : name}, stats.errors) for name, stats in methods])
+    writer.gauge('cascaders_calls_in_flight',
+                 'Calls to each remote method not yet answered',
+                 [({'method' : name}, stats.inFlight) for name, stats in methods])
+    writer.histogram('cascaders_call_seconds',
+                     'Time taken by each remote method', BUCKETS,
+                     [({'method' : name}, stats.histogram, stats.totalSecs)
+                      for name, stats in methods if stats.calls])
 
 if __name__ == "__main__":
-    reactor.listenTCP(5010, pb.PBServerFactory(LoginService()))
+    parser = OptionParser()
+    parser.add_option('', '--broadcast-window', type='float',
+                      default=BROADCAST_WINDOW_SECS,
+                      help=('seconds presence changes are gathered for before '
+                            'being sent to clients'))
+    parser.add_option('', '--max-logins', type='int',
+                      default=MAX_LOGINS_IN_FLIGHT,
+                      help='the number of logins that can be in progress at once')
+    parser.add_option('', '--log-category', action='append', default=[],
+                      metavar='CATEGORY:LEVEL[:SAMPLE]',
+                      help=('sets the level of a category of logging (one of '
+                            + ', '.join(sorted(LOG_CATEGORIES)) + ') and '
+                            'optionally only logs one in every SAMPLE records'))
+    parser.add_option('', '--admin', action='append', default=[],
+                      help='a user that can call admin functions')
+    parser.add_option('', '--stats-file', default=STATS_FILENAME,
+                      help='the file the call stats are written to')
+    parser.add_option('', '--stats-every', type='float',
+                      default=STATS_DUMP_SECS,
+                      help='seconds between writing the call stats')
+    parser.add_option('', '--metrics-port', type='int',
+                      help=('serve metrics for Prometheus on this port '
+                            '(only on ' + METRICS_INTERFACE + ')'))
+    parser.add_option('', '--hosts',
+                      help='the hosts file used to find the lab of a host')
+    parser.add_option('', '--port', type='int', default=PORT,
+                      help='the port the clients connect to')
+    parser.add_option('', '--workers', type='int', default=0,
+                      help=('run this many worker processes that share the '
+                            'port, rather than a single process'))
+    parser.add_option('', '--broker', default=BROKER_SOCKET,
+                      help=('the unix socket of the broker the workers share '
+                            'presence through'))
+    parser.add_option('', '--journal', default=JOURNAL_FILENAME,
+                      help=('the file presence is journaled to, so the users '
+                            'logged in are put back after a restart. An empty '
+                            'string turns the journal off'))
+    parser.add_option('', '--handoff', default=HANDOFF_SOCKET,
+                      help=('the unix socket a new server can take over from '
+                            'this one on. An empty string turns this off'))
+    parser.add_option('', '--take-over', action='store_true',
+                      help=('take over the port and users from the server '
+                            'listening on the --handoff socket, which then '
+                            'moves its clients over and exits'))
+    parser.add_option('', '--worker', type='int',
+                      help='used internally to run one of the workers')
+    (options, args) = parser.parse_args()
+    if options.take_over and (options.workers > 0 or not options.handoff):
+        parser.error('--take-over needs a --handoff socket and no --workers')
+
+    reactor.addSystemEventTrigger('after', 'shutdown', logListener.stop)
+    if options.workers > 0 and options.worker is None:
+        #this process only runs the broker and looks after the workers
+        listenBroker(options.broker)
+        Supervisor(options.workers, os.path.abspath(__file__),
+                   sys.argv[1:]).start()
+        logger.info('Started %d workers on port %d', options.workers,
+                    options.port)
+        reactor.run()
+        sys.exit(0)
+
+    if options.worker is not None:
+        #each worker has its own files, the handler opens the new log file
+        #when it next writes
+        handler.close()
+        handler.baseFilename = os.path.abspath(
+                workerFilename(LOG_FILENAME, options.worker))
+        options.stats_file = workerFilename(options.stats_file,
+                                            options.worker)
+        if options.journal:
+            options.journal = workerFilename(options.journal, options.worker)
+        if options.metrics_port:
+            options.metrics_port += options.worker
+        #versions from one worker mean nothing to another
+        presenceLog.epoch += '-%d' % options.worker
+    broadcaster.window = options.broadcast_window
+    loginAdmission.maxInFlight = options.max_logins
+    for category in options.log_category:
+        parts = category.split(':')
+        if parts[0] not in LOG_CATEGORIES or len(parts) not in (2, 3):
+            parser.error('Bad log category: ' + category)
+        level = logging.getLevelName(parts[1].upper())
+        if not isinstance(level, int):
+            parser.error('Bad log level: ' + parts[1])
+        sample = int(parts[2]) if len(parts) == 3 else None
+        configureCategory(LOG_CATEGORIES[parts[0]], level, sample)
+    if options.hosts:
+        with open(options.hosts) as f:
+            hostLabs.read(f)
+
+    admins.update(options.admin)
+
+    if options.journal:
+        journal = PresenceJournal(options.journal, localSessions,
+                                  JOURNAL_COMPACT_SECS, JOURNAL_MAX_RECORDS)
+        def stopJournal():
+            #a server that has been handed over has already stopped it
+            if journal is not None:
+                journal.stop()
+        reactor.addSystemEventTrigger('after', 'shutdown', stopJournal)
+        if not options.take_over:
+            #when taking over the users come from the old server instead
+            restored = restoreSessions(journal.load().values())
+            logger.info('Put back %d users from the journal', len(restored))
+            journal.start()
+
+    heartbeats.start()
+    helpBroker.start()
+    StatsDumper(serverStats, options.stats_file, options.stats_every).start()
+    factory = pb.PBServerFactory(LoginService())
+    if options.worker is not None:
+        def brokerLost():
+            #the supervisor has gone, so this worker goes too
+            if reactor.running:
+                reactor.stop()
+        cluster = Cluster(options.worker, ClusterPeers())
+        cluster.connect(options.broker, brokerLost)
+        listenReusePort(options.port, factory)
+    else:
+        def startHandoff(port):
+            global handoff
+            if not options.handoff:
+                return
+            def done():
+                logger.info('Handed over to the new server, stopping')
+                if reactor.running:
+                    reactor.stop()
+            handoff = HandoffListener(port, lambda: [sessionState(s) for s in
+                                                     localSessions()],
+                                      drainClients, done)
+            listenHandoff(options.handoff, handoff)
+
+        if options.take_over:
+            ports = []
+            def listen(descriptor):
+                ports.append(reactor.adoptStreamPort(descriptor,
+                                                     socket.AF_INET, factory))
+            def draining():
+                if journal is not None:
+                    journal.start()
+            def tookOver(restored):
+                logger.info('Took over from the old server with %d users',
+                            restored)
+                takeover.over.addCallback(lambda _: startHandoff(ports[0]))
+            def failed(reason):
+                logger.error('Failed to take over: %s',
+                             reason.getErrorMessage())
+                reactor.stop()
+            takeover = Takeover(restoreSessions, listen, draining,
+                                handedOverState, handedOverGone,
+                                handedOverHelp)
+            takeover.connect(options.handoff).addCallbacks(tookOver, failed)
+        else:
+            #a port from listenTCP would shut the socket down when handed
+            #over, rather than leaving it to the new server
+            startHandoff(listenAdopted(options.port, factory))
+    if options.metrics_port:
+        reactor.listenTCP(options.metrics_port,
+                          Site(MetricsResource(writeMetrics)),
+                          interface=METRICS_INTERFACE)
     logger.info("Spinning the server up, stand by")
     reactor.run()
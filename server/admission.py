@@ -0,0 +1,88 @@
+'''
+Limits the number of logins that are being processed at once, so that when
+every client reconnects after a restart the server isn't swamped with
+snapshot requests
+'''
+from twisted.internet import reactor
+
+class LoginAdmission(object):
+    '''
+    A login is in flight from when the user joins until their first sync
+    (see done), or until holdSecs has passed in case the client never syncs.
+
+    When maxInFlight logins are in flight, further logins are refused and
+    told how long to wait. The waits are handed out as if refused logins
+    were queued behind each other, at the rate logins are currently being
+    completed, so clients come back spread out rather than all at once.
+    '''
+
+    def __init__(self, maxInFlight, holdSecs, maxRetrySecs, clock=reactor):
+        '''
+        maxInFlight - the number of logins allowed to be in flight
+        holdSecs - the longest a login is counted as in flight
+        maxRetrySecs - the longest a client is told to wait
+        clock - provides seconds, this is only not the reactor for testing
+        '''
+        self.maxInFlight = maxInFlight
+        self.holdSecs = holdSecs
+        self.maxRetrySecs = maxRetrySecs
+        self.clock = clock
+
+        #username -> time the login was admitted
+        self.inFlight = {}
+
+        #average time taken for a login to complete
+        self.loginSecs = 1.0
+
+        #the time that the last refused client was told to come back at
+        self.nextSlot = 0
+
+        self.stats = {'admitted' : 0, 'refused' : 0, 'expired' : 0}
+
+    def _expire(self, now):
+        for username, started in self.inFlight.items():
+            if now - started >= self.holdSecs:
+                del self.inFlight[username]
+                self.stats['expired'] += 1
+
+    def admit(self, username):
+        '''
+        Returns None if the login can go ahead, otherwise the number of seconds
+        the client should wait before trying again
+
+        >>> from twisted.internet import task
+        >>> clock = task.Clock()
+        >>> la = LoginAdmission(1, 10, 60, clock)
+        >>> la.admit('a') is None
+        True
+        >>> la.admit('b')
+        1.0
+        >>> la.admit('c')
+        2.0
+        >>> la.done('a')
+        >>> la.admit('b') is None
+        True
+        '''
+        now = self.clock.seconds()
+        if len(self.inFlight) >= self.maxInFlight:
+            self._expire(now)
+
+        if len(self.inFlight) < self.maxInFlight or username in self.inFlight:
+            self.inFlight[username] = now
+            self.stats['admitted'] += 1
+            return None
+
+        self.stats['refused'] += 1
+        step = self.loginSecs / self.maxInFlight
+        self.nextSlot = min(max(self.nextSlot, now) + step,
+                            now + self.maxRetrySecs)
+        return self.nextSlot - now
+
+    def done(self, username):
+        ''' Called when the login has finished, or the user has left '''
+        try:
+            started = self.inFlight.pop(username)
+        except KeyError:
+            return
+        taken = self.clock.seconds() - started
+        self.loginSecs = 0.9 * self.loginSecs + 0.1 * max(taken, 0.01)
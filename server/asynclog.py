@@ -0,0 +1,128 @@
+'''
+Logging that doesn't block the reactor. Records are put on a bounded queue
+and a background thread formats them and writes them out, so a slow disk
+only ever delays the logging thread.
+
+Python 2 has no QueueHandler or QueueListener, so simple versions of them
+are here.
+'''
+import logging
+import threading
+import Queue
+
+class QueueHandler(logging.Handler):
+    '''
+    Puts records on a queue rather than writing them. If the queue is full
+    the record is dropped and counted rather than waiting for space.
+
+    The message isn't formatted here, that is left to the thread that
+    writes it out. Callers should use the logging argument style, e.g.
+        logger.info('%s added %s', user, subjects)
+    rather than building the string themselves, and should pass copies of
+    anything that may change before it is written.
+    '''
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.stats = {'queued' : 0, 'dropped' : 0}
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.stats['dropped'] += 1
+        else:
+            self.stats['queued'] += 1
+
+
+class QueueListener(object):
+    ''' Takes records off a queue in a thread and passes them to handlers '''
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='logging')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        ''' Writes out everything already queued and stops the thread '''
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+class SampleFilter(logging.Filter):
+    '''
+    Only lets through one in every n records, for categories that are too
+    busy to log everything
+
+    >>> f = SampleFilter(3)
+    >>> [f.filter(None) for _ in range(6)]
+    [True, False, False, True, False, False]
+    >>> f.stats['sampledOut']
+    4
+    '''
+
+    def __init__(self, every):
+        logging.Filter.__init__(self)
+        self.every = every
+        self.count = 0
+        self.stats = {'sampledOut' : 0}
+
+    def filter(self, record):
+        self.count += 1
+        if (self.count - 1) % self.every == 0:
+            return True
+        self.stats['sampledOut'] += 1
+        return False
+
+
+def startAsyncLogging(logger, handlers, maxQueued):
+    '''
+    Makes the logger (and so all its child loggers) write to the handlers
+    from a background thread, holding at most maxQueued records. Returns the
+    QueueHandler and the started QueueListener
+    '''
+    queue = Queue.Queue(maxQueued)
+    queueHandler = QueueHandler(queue)
+    logger.addHandler(queueHandler)
+
+    listener = QueueListener(queue, *handlers)
+    listener.start()
+    return queueHandler, listener
+
+
+def configureCategory(logger, level=None, sampleEvery=None):
+    '''
+    Sets the level of a category logger and, if sampleEvery is more than
+    one, only logs one in every sampleEvery records from it. Returns the
+    SampleFilter used, or None
+    '''
+    if level is not None:
+        logger.setLevel(level)
+
+    for f in list(logger.filters):
+        if isinstance(f, SampleFilter):
+            logger.removeFilter(f)
+
+    if sampleEvery is None or sampleEvery <= 1:
+        return None
+    sampler = SampleFilter(sampleEvery)
+    logger.addFilter(sampler)
+    return sampler
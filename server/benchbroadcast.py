@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+Benchmark for the presence broadcasts. This simulates a lab logging in at
+the start of a session (every client logs in, adds some subjects and starts
+cascading) and reports how many calls the server made to clients, how fast
+it made them and how long it took for clients to hear about the changes.
+
+It uses fake clients and a simulated clock so doesn't need a network. The
+delivery latency is in simulated time so includes the time an event waits
+for the broadcast window to close. The tick cost is the wall time taken to
+process each step of the simulation.
+
+Run with: python benchbroadcast.py [--clients 50,100,200] [--window 0.25]
+'''
+import logging
+import random
+import time
+from optparse import OptionParser
+
+from twisted.internet import defer, task
+
+import Server
+from broadcast import BroadcastScheduler
+from presenceindex import CascaderIndex
+from presencelog import PresenceLog
+from subscriptions import SubscriptionIndex
+from tracing import percentile
+
+#the login storm is spread over this many (simulated) seconds
+STORM_SECS = 2.0
+STEP_SECS = 0.01
+
+class FakeClient(object):
+    ''' Stands in for the remote reference to a clients RpcService '''
+    def __init__(self, bench):
+        self.bench = bench
+
+    def callRemote(self, name, *args):
+        if name == 'presenceChanged':
+            self.bench.received(args[0])
+        return defer.succeed(None)
+
+
+class Bench(object):
+    def __init__(self, numClients, window):
+        '''
+        window - the broadcast window, if this is None then the changes
+        are flushed after every event which is how the server used to work
+        '''
+        self.numClients = numClients
+        self.window = window
+        self.clock = task.Clock()
+
+        Server.users.clear()
+        Server.subscriptions = SubscriptionIndex()
+        Server.cascaderIndex = CascaderIndex(Server.hostLabs)
+        Server.presenceLog = PresenceLog(Server.DELTA_LOG_SIZE)
+        Server.broadcaster = BroadcastScheduler(Server.users,
+                                                window or 0,
+                                                Server.presenceLog,
+                                                Server.subscriptions,
+                                                Server.hostLabs,
+                                                clock=self.clock)
+
+        self.issued = {}
+        self.latencies = []
+        self.tickCosts = []
+
+    def received(self, batch):
+        now = self.clock.seconds()
+        for username, _, _ in batch['joined']:
+            self.latencies.append(now - self.issued[username])
+        for username, _ in batch['added']:
+            self.latencies.append(now - self.issued[username])
+
+    def _event(self, f, *args):
+        f(*args)
+        if self.window is None:
+            self.clock.advance(0)
+
+    def run(self):
+        subjects = sorted(Server.subjectList)
+        rand = random.Random(0)
+        arrivals = sorted((rand.uniform(0, STORM_SECS), i)
+                          for i in range(self.numClients))
+
+        start = time.time()
+        while arrivals or Server.broadcaster.pending is not None:
+            stepStart = time.time()
+            while arrivals and arrivals[0][0] <= self.clock.seconds():
+                _, i = arrivals.pop(0)
+                username = 'user%d' % i
+                user = Server.UserService(FakeClient(self), username,
+                                          'host%d' % i)
+                user.remote_syncSince(None, None)
+                self.issued[username] = self.clock.seconds()
+                self._event(user.remote_addSubjects, rand.sample(subjects, 2))
+                self._event(user.remote_startCascading)
+            self.clock.advance(STEP_SECS)
+            self.tickCosts.append(time.time() - stepStart)
+        taken = time.time() - start
+
+        stats = Server.broadcaster.stats
+        return {'calls' : stats['calls'],
+                'callsPerSec' : stats['calls'] / taken,
+                'p50' : percentile(self.latencies, 0.5),
+                'p99' : percentile(self.latencies, 0.99),
+                'tickP99' : percentile(self.tickCosts, 0.99)}
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('', '--clients', default='25,50,100,200,400',
+                      help='comma seperated list of client counts')
+    parser.add_option('', '--window', type='float',
+                      default=Server.BROADCAST_WINDOW_SECS,
+                      help='the broadcast window to compare against')
+    (options, args) = parser.parse_args()
+
+    Server.logger.setLevel(logging.WARNING)
+
+    print '%-8s %-10s %10s %12s %10s %10s %12s' % ('clients', 'mode', 'calls',
+                                                   'calls/sec', 'p50 (s)',
+                                                   'p99 (s)', 'tick p99 (ms)')
+    for numClients in [int(c) for c in options.clients.split(',')]:
+        for window in (None, options.window):
+            mode = 'unbatched' if window is None else 'batch %gs' % window
+            r = Bench(numClients, window).run()
+            print '%-8d %-10s %10d %12.0f %10.3f %10.3f %12.2f' % (
+                    numClients, mode, r['calls'], r['callsPerSec'],
+                    r['p50'], r['p99'], r['tickP99'] * 1000)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+'''
+Compares how the server copes with the same load when it is run as 1 to
+--workers worker processes (see workers.py). For each number of workers a
+server is started on a spare port and the load generator from the client
+(loadgen.py) is run against it. Prints the throughput and latency of each,
+along with the cpu time used by the server processes:
+    python benchworkers.py --workers 4 --users 1000 --duration 60
+
+The load generator runs on the same machine and needs cpu as well, so
+there is only something to be gained from more workers if there are cores
+spare for them.
+'''
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER = os.path.join(HERE, 'Server.py')
+LOADGEN = os.path.join(HERE, '..', 'client', 'cascaders', 'loadgen.py')
+
+#how long the server has to start listening
+START_SECS = 30
+
+def sparePort():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def waitForPort(port, timeout=START_SECS):
+    end = time.time() + timeout
+    while time.time() < end:
+        s = socket.socket()
+        try:
+            s.connect(('127.0.0.1', port))
+            return
+        except socket.error:
+            time.sleep(0.1)
+        finally:
+            s.close()
+    raise RuntimeError('Server didn\'t start listening on %d' % port)
+
+def childCpuSecs():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def run(workers, options):
+    '''
+    Runs the load against a server with the given number of workers,
+    returning the summary from loadgen with the server cpu time added
+    '''
+    tmp = tempfile.mkdtemp(prefix='benchworkers')
+    port = sparePort()
+    devnull = open(os.devnull, 'w')
+    try:
+        server = subprocess.Popen([sys.executable, SERVER,
+                                   '--workers', str(workers),
+                                   '--port', str(port),
+                                   '--broker', os.path.join(tmp, 'broker.sock'),
+                                   '--log-category', 'presence:warning',
+                                   '--log-category', 'sync:warning',
+                                   '--log-category', 'help:warning',
+                                   '--log-category', 'messages:warning'],
+                                  cwd=tmp, stdout=devnull, stderr=devnull)
+        try:
+            waitForPort(port)
+            #the first worker listening doesn't mean they all are
+            time.sleep(1)
+            loadgen = subprocess.Popen([sys.executable, LOADGEN,
+                                        '--host', '127.0.0.1',
+                                        '--port', str(port),
+                                        '--users', str(options.users),
+                                        '--processes', str(options.processes),
+                                        '--mix', options.mix,
+                                        '--duration', str(options.duration),
+                                        '--login-rate', str(options.login_rate),
+                                        '--action-every',
+                                        str(options.action_every),
+                                        '--json'],
+                                       stdout=subprocess.PIPE)
+            out = loadgen.communicate()[0]
+            summary = json.loads(out.strip().splitlines()[-1])
+            cpuBefore = childCpuSecs()
+        finally:
+            server.terminate()
+            server.wait()
+        #the workers are children of the server, so their cpu time is
+        #counted once the server has been waited for
+        summary['serverCpuSecs'] = childCpuSecs() - cpuBefore
+        return summary
+    finally:
+        devnull.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('-w', '--workers', type='int', default=4,
+                      help='the most workers to try')
+    parser.add_option('-u', '--users', type='int', default=500,
+                      help='the number of bots')
+    parser.add_option('-p', '--processes', type='int', default=4,
+                      help='the number of processes the bots are split over')
+    parser.add_option('-m', '--mix', default='mixed',
+                      help='what the bots do (see loadgen.py)')
+    parser.add_option('-d', '--duration', type='float', default=30,
+                      help='seconds to run the load for each number of workers')
+    parser.add_option('', '--login-rate', type='float', default=100,
+                      help='logins per second')
+    parser.add_option('', '--action-every', type='float', default=2,
+                      help='seconds between the actions of each bot')
+    parser.add_option('', '--json', action='store_true',
+                      help='print the summary of every run as json')
+    (options, args) = parser.parse_args()
+
+    results = {}
+    if not options.json:
+        print '%-8s %10s %8s %10s %10s %10s %10s' % (
+                'workers', 'calls/s', 'failed', 'prop p50', 'prop p99',
+                'help p99', 'cpu secs')
+    for workers in range(1, options.workers + 1):
+        summary = results[workers] = run(workers, options)
+        if options.json:
+            continue
+        latency = summary['latency']
+        print '%-8d %10.1f %8d %9.3fs %9.3fs %9.3fs %10.1f' % (
+                workers, summary['callsPerSec'],
+                summary['counts'].get('callErrors', 0),
+                latency['propagation']['p50'], latency['propagation']['p99'],
+                latency['help answer']['p99'], summary['serverCpuSecs'])
+        sys.stdout.flush()
+    if options.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
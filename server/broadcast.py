@@ -0,0 +1,259 @@
+'''
+Batches up presence changes (cascaders joining, leaving and changing their
+subjects) so that each connected client is sent at most one update per tick
+rather than one call per client per event
+'''
+from twisted.spread import pb
+from twisted.internet import reactor
+
+import bisect
+import logging
+
+logger = logging.getLogger('MyLogger')
+
+#the upper bounds of the buckets used to count how many clients each flush
+#is sent to, the last bucket is everything larger
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+class BroadcastScheduler(object):
+    '''
+    Collects presence events for a short window and then sends every
+    interested client a single batched delta.
+
+    Rather than remembering each event, this remembers which users have
+    changed. When the window closes the current state of those users is
+    compared against what was last sent out, so a user that adds and then
+    removes a subject within the window generates no traffic at all.
+
+    Clients are only sent changes for cascaders that match their
+    subscription (see SubscriptionIndex). A cascader that starts matching a
+    clients subscription is sent as joined and one that stops matching is
+    sent as left, so the client never needs to know about cascaders outside
+    of its subscription.
+
+    Every change is recorded in the PresenceLog to give it a version. A
+    client is only sent batches once it has synced (see synced) and each
+    batch says which version it follows on from so the client can spot
+    if it has missed something. Batches go through each users OutboundQueue,
+    so a client that is behind is sent them merged into one.
+
+    The batch sent to the client (via presenceChanged) is a dict of:
+        since - the version the client was at before this batch
+        version - the version the client is at after this batch
+        joined - list of (username, hostname, subjects) for new cascaders
+        left - list of usernames that stopped cascading
+        added - list of (username, subjects) for subjects that were added
+        removed - list of (username, subjects) for subjects that were removed
+        usersLeft - list of usernames that logged out
+    '''
+
+    def __init__(self, users, window, log, subscriptions, hostLabs,
+                 clock=reactor):
+        '''
+        users - the dict of username to UserService for logged in users
+        window - the time in seconds that events are gathered for
+        log - the PresenceLog used to version changes
+        subscriptions - a SubscriptionIndex of what each client wants
+        hostLabs - provides labFromHostname
+        clock - provides callLater, this is only not the reactor for testing
+        '''
+        self.users = users
+        self.window = window
+        self.log = log
+        self.subscriptions = subscriptions
+        self.hostLabs = hostLabs
+        self.clock = clock
+
+        #the state of each cascader as it was last sent to the clients
+        #username -> (hostname, frozenset of subjects)
+        self.published = {}
+
+        self.dirty = set()
+        self.usersLeft = []
+        self.pending = None
+
+        #username -> the version that client was last sent or synced to
+        self.sentVersion = {}
+
+        #the clients that have synced since the last flush. They were sent
+        #the state as it was when they synced rather than what was last
+        #published, so they are sent the whole state of everyone that has
+        #changed rather than the differences
+        self.resynced = set()
+
+        self.stats = {'ticks' : 0, 'calls' : 0, 'events' : 0}
+
+        #the number of flushes sent to each number of clients (see
+        #FANOUT_BUCKETS) and the total number of clients sent to
+        self.fanout = [0] * (len(FANOUT_BUCKETS) + 1)
+        self.fanoutTotal = 0
+
+    def changed(self, username):
+        '''
+        Called when the cascading state, the hostname or the subjects of
+        the user has changed
+        '''
+        self.stats['events'] += 1
+        self.log.record(username)
+        self.dirty.add(username)
+        self._schedule()
+
+    def userLeft(self, username, hostname):
+        ''' Called when the user has logged out '''
+        self.forget(username)
+        self.usersLeft.append((username, hostname))
+        self.changed(username)
+
+    def forget(self, username):
+        ''' Stops sending batches to the client of the user '''
+        self.sentVersion.pop(username, None)
+        self.resynced.discard(username)
+
+    def synced(self, username):
+        '''
+        Called when the client has been sent the current state by some other
+        means than a batch, so all further batches follow on from now
+        '''
+        self.sentVersion[username] = self.log.version
+        self.resynced.add(username)
+
+    def _schedule(self):
+        if self.pending is None:
+            self.pending = self.clock.callLater(self.window, self.flush)
+
+    def _computeChanges(self, dirty):
+        '''
+        Updates the published state of the given usernames. Returns a list
+        of (username, previous state, current state) where a state is None if
+        the user isn't cascading. The states are the same for users that
+        changed and then changed back
+        '''
+        changes = []
+        for username in dirty:
+            user = self.users.get(username)
+            if user is not None and user.cascading:
+                cur = (user.hostname, frozenset(user.subjects))
+            else:
+                cur = None
+
+            prev = self.published.get(username)
+            if prev == cur:
+                changes.append((username, prev, cur))
+                continue
+
+            if cur is None:
+                del self.published[username]
+            else:
+                self.published[username] = cur
+            changes.append((username, prev, cur))
+        return changes
+
+    def _interested(self, state):
+        ''' The usernames that would want to see a cascader in this state '''
+        if state is None:
+            return set()
+        host, subjects = state
+        return self.subscriptions.subscribers(self.hostLabs.labFromHostname(host),
+                                              subjects)
+
+    def _buildBatches(self, changes, usersLeft, resynced):
+        ''' Returns a dict of username to the batch that user should be sent '''
+        batches = {}
+        def batchFor(username):
+            try:
+                return batches[username]
+            except KeyError:
+                batch = batches[username] = {'joined' : [],
+                                             'left' : [],
+                                             'added' : [],
+                                             'removed' : [],
+                                             'usersLeft' : []}
+                return batch
+
+        for username, prev, cur in changes:
+            before = self._interested(prev)
+            after = self._interested(cur)
+
+            for recipient in resynced:
+                if recipient in after:
+                    batchFor(recipient)['joined'].append((username, cur[0], set(cur[1])))
+                else:
+                    batchFor(recipient)['left'].append(username)
+            if prev == cur:
+                continue
+            before -= resynced
+            after -= resynced
+
+            for recipient in after - before:
+                batchFor(recipient)['joined'].append((username, cur[0], set(cur[1])))
+            for recipient in before - after:
+                batchFor(recipient)['left'].append(username)
+
+            if prev is None or cur is None:
+                continue
+            both = before & after
+            if prev[0] != cur[0]:
+                for recipient in both:
+                    batchFor(recipient)['joined'].append((username, cur[0], set(cur[1])))
+                continue
+
+            added, removed = cur[1] - prev[1], prev[1] - cur[1]
+            for recipient in both:
+                if added:
+                    batchFor(recipient)['added'].append((username, set(added)))
+                if removed:
+                    batchFor(recipient)['removed'].append((username, set(removed)))
+
+        for username, hostname in usersLeft:
+            if username in self.users:
+                #they logged in again within the window, so the changes
+                #above already say what the clients should know
+                continue
+            lab = self.hostLabs.labFromHostname(hostname)
+            for recipient in self.subscriptions.subscribers(lab):
+                batchFor(recipient)['usersLeft'].append(username)
+
+        return batches
+
+    def flush(self):
+        '''
+        Sends all the changes that have happened since the last flush to
+        the clients that are interested. This is normally called by the
+        scheduler, but can be called directly to force changes out
+        '''
+        if self.pending is not None and self.pending.active():
+            self.pending.cancel()
+        self.pending = None
+
+        dirty, self.dirty = self.dirty, set()
+        usersLeft, self.usersLeft = self.usersLeft, []
+        resynced, self.resynced = self.resynced, set()
+
+        batches = self._buildBatches(self._computeChanges(dirty), usersLeft,
+                                     resynced)
+        if not batches:
+            return
+
+        self.stats['ticks'] += 1
+        version = self.log.version
+        calls = self.stats['calls']
+        lost = []
+        for username, batch in batches.iteritems():
+            user = self.users.get(username)
+            if user is None or username not in self.sentVersion:
+                continue
+            batch['since'] = self.sentVersion[username]
+            batch['version'] = self.sentVersion[username] = version
+            try:
+                d = user.outbound.callRemote('presenceChanged', batch)
+                #a client that loses its connection syncs when it is back
+                d.addErrback(lambda reason: None)
+                self.stats['calls'] += 1
+            except pb.DeadReferenceError:
+                logger.debug('Client wasn\'t connected')
+                lost.append(user)
+        [u.clientLost() for u in lost]
+
+        sent = self.stats['calls'] - calls
+        self.fanout[bisect.bisect_left(FANOUT_BUCKETS, sent)] += 1
+        self.fanoutTotal += sent
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+'''
+A local message broker for the workers of a multi process server (see
+workers.py and cluster.py), over a unix socket.
+
+Each message is a dict, jellied and banana encoded as PB would send it (so
+tuples and sets come through as they were sent) in a netstring. The first message from a
+worker must be {'op' : 'hello', 'worker' : id}. After that a message with
+a 'to' is passed on to that worker only and anything else is passed on to
+every other worker, in the order it was sent. The broker tells the other
+workers when a worker joins ({'op' : 'joined'}) or goes ({'op' : 'left'}),
+and gives a message back to its sender if the worker it is to has gone
+({'op' : 'undelivered', 'message' : message}).
+
+Nothing else is kept here, the workers keep all the state, so this can be
+swapped for any pub/sub broker that can do the same. The supervisor in
+workers.py runs one in process, or it can be run on its own:
+    python broker.py [--socket cascader-broker.sock]
+'''
+import logging
+import os
+from optparse import OptionParser
+
+from twisted.internet import protocol, reactor
+from twisted.spread import banana, jelly
+from twisted.protocols.basic import NetstringReceiver
+
+logger = logging.getLogger('MyLogger')
+
+SOCKET_FILENAME = 'cascader-broker.sock'
+
+#the largest message a worker can send, a full presence update for a single
+#user is well under this
+MAX_MESSAGE_LENGTH = 1024 * 1024
+
+def encode(message):
+    '''
+    >>> decode(encode({'op' : 'call', 'args' : (('host', 1), set(['a']))}))
+    {'args': (('host', 1), set(['a'])), 'op': 'call'}
+    '''
+    return banana.encode(jelly.jelly(message))
+
+def decode(data):
+    return jelly.unjelly(banana.decode(data))
+
+
+class BrokerProtocol(NetstringReceiver):
+    ''' The brokers end of the connection to a worker '''
+
+    MAX_LENGTH = MAX_MESSAGE_LENGTH
+
+    def connectionMade(self):
+        self.worker = None
+
+    def stringReceived(self, data):
+        message = decode(data)
+        if self.worker is None:
+            if message.get('op') != 'hello':
+                logger.warn('Worker didn\'t say hello, dropping it')
+                self.transport.loseConnection()
+                return
+            self.worker = message['worker']
+            self.factory.joined(self)
+        else:
+            self.factory.route(self, data, message)
+
+    def connectionLost(self, reason):
+        if self.worker is not None:
+            self.factory.left(self)
+
+
+class Broker(protocol.ServerFactory):
+    protocol = BrokerProtocol
+
+    def __init__(self):
+        #worker id -> BrokerProtocol
+        self.workers = {}
+        self.stats = {'messages' : 0, 'delivered' : 0, 'undeliverable' : 0}
+
+    def joined(self, worker):
+        old = self.workers.get(worker.worker)
+        if old is not None:
+            #a restarted worker that connected before the old connection
+            #was noticed as gone
+            old.worker = None
+            old.transport.loseConnection()
+            self._tellOthers(worker, {'op' : 'left', 'worker' : worker.worker})
+        logger.info('Worker %s joined', worker.worker)
+        self.workers[worker.worker] = worker
+        self._tellOthers(worker, {'op' : 'joined', 'worker' : worker.worker})
+
+    def left(self, worker):
+        if self.workers.get(worker.worker) is not worker:
+            return
+        logger.info('Worker %s left', worker.worker)
+        del self.workers[worker.worker]
+        self._tellOthers(worker, {'op' : 'left', 'worker' : worker.worker})
+
+    def _tellOthers(self, worker, message):
+        self.route(worker, encode(message), message)
+
+    def route(self, sender, data, message):
+        '''
+        Passes the message (data is the message as it was sent) on to the
+        worker it is to, or to everyone else
+        '''
+        self.stats['messages'] += 1
+        to = message.get('to')
+        if to is None:
+            for worker in self.workers.itervalues():
+                if worker is not sender:
+                    worker.sendString(data)
+                    self.stats['delivered'] += 1
+            return
+        worker = self.workers.get(to)
+        if worker is None:
+            #the sender can give up on anything it was waiting for
+            self.stats['undeliverable'] += 1
+            sender.sendString(encode({'op' : 'undelivered',
+                                      'message' : message}))
+        else:
+            worker.sendString(data)
+            self.stats['delivered'] += 1
+
+
+def listenBroker(path, reactor=reactor):
+    ''' Starts a Broker listening on the unix socket at path '''
+    if os.path.exists(path):
+        os.unlink(path)
+    return reactor.listenUNIX(path, Broker(), mode=0600)
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('', '--socket', default=SOCKET_FILENAME,
+                      help='the unix socket the workers connect to')
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    listenBroker(options.socket)
+    reactor.run()
@@ -0,0 +1,295 @@
+'''
+Shares the users logged in to each worker of a multi process server with
+the other workers, through the broker (see broker.py).
+
+Every worker publishes the presence of the users logged in to it. The other
+workers keep those users as PeerSessions, which have the attributes of a
+UserService that presence needs, so they show up in the cascader lists and
+presence updates like any other user. Calls to the client of a PeerSession
+(help requests and messages) are passed to the worker it is logged in to,
+which makes the call and sends the answer back.
+
+The messages, as well as those in broker.py, are:
+    user - the state of a user logged in to the sender. takeover is set if
+           the user has just resumed a session from another worker, and
+           provisional if they were put back after the sender restarted
+    gone - a user logged out of the sender
+    call - asks the worker to call name with args on the client of user,
+           to be answered with an answer carrying the same id
+    answer - the result, or error, of a call
+    undelivered - the broker couldn't pass on message as its worker has gone
+'''
+import logging
+import itertools
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols.basic import NetstringReceiver
+
+from broker import MAX_MESSAGE_LENGTH, encode, decode
+
+logger = logging.getLogger('MyLogger')
+
+class PeerSession(object):
+    '''
+    Stands in for the UserService of a user logged in to another worker.
+    The other worker looks after the connection to the client, so this is
+    never part of the heartbeats or subscriptions
+    '''
+
+    stale = False
+    client = None
+    #set if the user was put back after a restart of their worker and their
+    #client hasn't come back yet
+    provisional = False
+
+    def __init__(self, cluster, worker, user):
+        self.worker = worker
+        self.user = user
+        self.hostname = None
+        self.cascading = False
+        self.subjects = set()
+        #the labs and subjects the client is subscribed to
+        self.interests = (None, None)
+        self.resumeToken = None
+        self.outbound = PeerOutbound(cluster, self)
+
+    def clientLost(self):
+        pass
+
+    def message(self, helpId, message):
+        return self.outbound.callRemote('userSentMessage', helpId, message)
+
+    def serverMessage(self, helpId, message):
+        return self.outbound.callRemote('serverSentMessage', helpId, message)
+
+
+class PeerOutbound(object):
+    ''' Passes calls to the client of a PeerSession to its worker '''
+
+    def __init__(self, cluster, peer):
+        self.cluster = cluster
+        self.peer = peer
+
+    def __len__(self):
+        return 0
+
+    def callRemote(self, name, *args):
+        return self.cluster.call(self.peer, name, args)
+
+
+class ClusterProtocol(NetstringReceiver):
+    ''' The workers end of the connection to the broker '''
+
+    MAX_LENGTH = MAX_MESSAGE_LENGTH
+
+    def connectionMade(self):
+        self.factory.cluster.connected(self)
+
+    def stringReceived(self, data):
+        self.factory.cluster.received(decode(data))
+
+    def send(self, message):
+        self.sendString(encode(message))
+
+    def connectionLost(self, reason):
+        self.factory.cluster.disconnected(reason)
+
+
+class ClusterFactory(protocol.ClientFactory):
+    protocol = ClusterProtocol
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def clientConnectionFailed(self, connector, reason):
+        self.cluster.disconnected(reason)
+
+
+class Cluster(object):
+    '''
+    This workers view of the other workers. The server is told about the
+    users on the other workers through the peers, which must have:
+        localSessions() - the UserServices of this worker
+        peerChanged(peer, takeover) - a PeerSession is new or has changed.
+            Returns False if the user is logged in here and should stay
+            that way
+        peerGone(peer) - a PeerSession has logged out
+        peerCall(username, name, args) - calls the client of a user on this
+            worker for another worker, returning the result or a deferred
+        notConnected(username) - the exception for a call to a user that
+            couldn't be made
+    '''
+
+    def __init__(self, workerId, peers):
+        self.workerId = workerId
+        self.peers = peers
+        self.onLost = None
+        self.protocol = None
+
+        #username -> PeerSession for the users on other workers
+        self.sessions = {}
+
+        self.callIds = itertools.count()
+        #call id -> (worker, username, deferred) of the calls not answered
+        self.waiting = {}
+
+        self.stats = {'published' : 0, 'received' : 0, 'callsSent' : 0,
+                      'callsReceived' : 0, 'callsFailed' : 0}
+
+    def connect(self, path, onLost=None):
+        '''
+        Connects to the broker listening on the unix socket at path.
+        onLost is called if the connection fails or is lost
+        '''
+        self.onLost = onLost
+        reactor.connectUNIX(path, ClusterFactory(self))
+
+    #--------------------------------------------------------------------------
+    # called by the server
+
+    def publish(self, session, takeover=False, to=None):
+        ''' Tells the other workers about the state of a local user '''
+        #the user may have been taken over from another worker
+        self.sessions.pop(session.user, None)
+        message = {'op' : 'user',
+                   'user' : session.user,
+                   'hostname' : session.hostname,
+                   'cascading' : session.cascading,
+                   'subjects' : set(session.subjects),
+                   'interests' : [None if i is None else set(i)
+                                  for i in session.interests],
+                   'resumeToken' : session.resumeToken,
+                   'provisional' : session.provisional,
+                   'takeover' : takeover}
+        if to is not None:
+            message['to'] = to
+        self.stats['published'] += 1
+        self._send(message)
+
+    def loggedOut(self, session):
+        self._send({'op' : 'gone', 'user' : session.user})
+
+    def call(self, peer, name, args):
+        '''
+        Asks the worker the peer is on to call name on its client. Returns a
+        deferred that fires with the result
+        '''
+        if self.protocol is None:
+            return defer.fail(self.peers.notConnected(peer.user))
+        callId = self.callIds.next()
+        d = defer.Deferred()
+        self.waiting[callId] = (peer.worker, peer.user, d)
+        self.stats['callsSent'] += 1
+        self._send({'op' : 'call', 'to' : peer.worker, 'id' : callId,
+                    'user' : peer.user, 'name' : name, 'args' : list(args)})
+        return d
+
+    #--------------------------------------------------------------------------
+    # the connection to the broker
+
+    def _send(self, message):
+        if self.protocol is not None:
+            message['worker'] = self.workerId
+            self.protocol.send(message)
+
+    def connected(self, protocol):
+        logger.info('Worker %s connected to the broker', self.workerId)
+        self.protocol = protocol
+        protocol.send({'op' : 'hello', 'worker' : self.workerId})
+        for session in self.peers.localSessions():
+            self.publish(session)
+
+    def disconnected(self, reason):
+        logger.warn('Worker %s lost the broker: %s', self.workerId,
+                    reason.getErrorMessage())
+        self.protocol = None
+        for worker in set(peer.worker for peer in self.sessions.values()):
+            self._workerLeft(worker)
+        for callId in self.waiting.keys():
+            self._failCall(callId)
+        if self.onLost is not None:
+            self.onLost()
+
+    def received(self, message):
+        try:
+            handler = getattr(self, '_on' + message['op'].capitalize())
+        except AttributeError:
+            logger.warn('Unknown message from the broker: %s', message)
+        else:
+            handler(message)
+
+    def _onJoined(self, message):
+        ''' A new worker needs to be told about everyone here '''
+        for session in self.peers.localSessions():
+            self.publish(session, to=message['worker'])
+
+    def _onLeft(self, message):
+        self._workerLeft(message['worker'])
+
+    def _workerLeft(self, worker):
+        for peer in [p for p in self.sessions.values() if p.worker == worker]:
+            del self.sessions[peer.user]
+            self.peers.peerGone(peer)
+        for callId, (to, username, d) in self.waiting.items():
+            if to == worker:
+                self._failCall(callId)
+
+    def _onUser(self, message):
+        self.stats['received'] += 1
+        username = message['user']
+        peer = self.sessions.get(username)
+        if peer is None:
+            peer = PeerSession(self, message['worker'], username)
+        peer.worker = message['worker']
+        peer.hostname = message['hostname']
+        peer.cascading = message['cascading']
+        peer.subjects = set(message['subjects'])
+        peer.interests = tuple(message['interests'])
+        peer.resumeToken = message['resumeToken']
+        peer.provisional = message['provisional']
+        if self.peers.peerChanged(peer, message['takeover']) is False:
+            self.sessions.pop(username, None)
+        else:
+            self.sessions[username] = peer
+
+    def _onGone(self, message):
+        peer = self.sessions.get(message['user'])
+        if peer is not None and peer.worker == message['worker']:
+            del self.sessions[peer.user]
+            self.peers.peerGone(peer)
+
+    def _onCall(self, message):
+        self.stats['callsReceived'] += 1
+        reply = {'op' : 'answer', 'to' : message['worker'],
+                 'id' : message['id']}
+        def answered(result):
+            reply['result'] = result
+            self._send(reply)
+        def failed(reason):
+            reply['error'] = reason.getErrorMessage()
+            self._send(reply)
+        d = defer.maybeDeferred(self.peers.peerCall, message['user'],
+                                message['name'], message['args'])
+        d.addCallbacks(answered, failed)
+
+    def _onAnswer(self, message):
+        try:
+            worker, username, d = self.waiting.pop(message['id'])
+        except KeyError:
+            return
+        if 'error' in message:
+            self.stats['callsFailed'] += 1
+            d.errback(self.peers.notConnected(username))
+        else:
+            d.callback(message['result'])
+
+    def _onUndelivered(self, message):
+        ''' The worker a message was sent to has gone '''
+        sent = message['message']
+        if sent['op'] == 'call' and sent['id'] in self.waiting:
+            self._failCall(sent['id'])
+
+    def _failCall(self, callId):
+        worker, username, d = self.waiting.pop(callId)
+        self.stats['callsFailed'] += 1
+        d.errback(self.peers.notConnected(username))
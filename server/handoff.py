@@ -0,0 +1,262 @@
+'''
+Hands a running server over to a new server process, so the server can be
+upgraded without the clients having to log in again. The running server
+listens for a new one on a unix socket (see --handoff), and the new one is
+started with:
+    python Server.py --take-over
+
+The old server passes the new one its listening socket, so no connection
+is refused while they change over, along with the state of everyone logged
+in. The new server puts the users back as ProvisionalSessions, as after a
+restart (see journal.py), and starts accepting connections on the socket.
+The old server then stops accepting and drains its clients, disconnecting
+a few at a time over the drain time. Each reconnects to the new server and
+resumes its session. Until a client has moved the old server passes on any
+change to its user, and as it moves its help requests are passed on too.
+Once they have all gone the old server exits. The
+new server listens on the handoff socket once the old one has gone.
+
+The messages are json in netstrings, each a dict with an op of:
+    snapshot - from the old server, sent along with the listening socket.
+               users is a list of the states of everyone logged in
+    ready - from the new server, which is accepting connections
+    draining - from the old server, which has stopped journaling so the
+               new one can start
+    user - from the old server, the state of a user has changed
+    gone - from the old server, a user has logged out
+    help - from the old server, request is the state of a help request
+           (see HelpRequest.state) from a user being moved
+    done - from the old server, every client has been moved
+'''
+import json
+import logging
+import os
+
+from twisted.internet import defer, interfaces, protocol, reactor
+from twisted.protocols.basic import NetstringReceiver
+from zope.interface import implementer
+
+from journal import sessionState
+
+logger = logging.getLogger('MyLogger')
+
+SOCKET_FILENAME = 'cascader-handoff.sock'
+
+#the largest message, a snapshot of thousands of users is well under this
+MAX_MESSAGE_LENGTH = 64 * 1024 * 1024
+
+class HandoffProtocol(NetstringReceiver):
+    ''' The old servers end of the connection to the new server '''
+
+    MAX_LENGTH = MAX_MESSAGE_LENGTH
+
+    def connectionMade(self):
+        self.factory.connected(self)
+
+    def stringReceived(self, data):
+        if json.loads(data).get('op') == 'ready':
+            self.factory.ready(self)
+
+    def send(self, message):
+        self.sendString(json.dumps(message))
+
+    def connectionLost(self, reason):
+        self.factory.lost(self, reason)
+
+
+class HandoffListener(protocol.ServerFactory):
+    '''
+    Waits for a new server to take over from this one. The server passes:
+        port - the listening port the clients connect to
+        snapshot() - the states of the users logged in (see sessionState)
+        drain() - called once the new server is accepting connections. The
+            clients should be disconnected, then finished called
+        done() - the new server has everything, so this one should stop
+
+    From when a new server connects until finished, every change to the
+    users must be passed to record or gone, and the help requests of each
+    user moved to recordHelp
+    '''
+    protocol = HandoffProtocol
+
+    def __init__(self, port, snapshot, drain, done):
+        self.port = port
+        self.snapshot = snapshot
+        self.drain = drain
+        self.done = done
+        #the unix port this listens on (see listenHandoff)
+        self.listening = None
+        #the connection to the new server taking over
+        self.handoff = None
+        self.draining = False
+
+    def connected(self, handoff):
+        if self.handoff is not None:
+            logger.warn('Already handing over, dropping another new server')
+            handoff.transport.loseConnection()
+            return
+        logger.info('A new server is taking over')
+        self.handoff = handoff
+        handoff.transport.sendFileDescriptor(self.port.fileno())
+        handoff.send({'op' : 'snapshot', 'users' : self.snapshot()})
+
+    def ready(self, handoff):
+        if handoff is not self.handoff or self.draining:
+            return
+        logger.info('The new server is accepting connections, draining')
+        self.draining = True
+        self.port.stopListening()
+        self.drain()
+        handoff.send({'op' : 'draining'})
+
+    def lost(self, handoff, reason):
+        if handoff is not self.handoff:
+            return
+        self.handoff = None
+        if self.draining:
+            self.done()
+        else:
+            logger.warn('The new server went before taking over: %s',
+                        reason.getErrorMessage())
+
+    def record(self, session):
+        if self.handoff is not None:
+            self.handoff.send(dict(sessionState(session), op='user'))
+
+    def gone(self, username):
+        if self.handoff is not None:
+            self.handoff.send({'op' : 'gone', 'user' : username})
+
+    def recordHelp(self, state):
+        if self.handoff is not None:
+            self.handoff.send({'op' : 'help', 'request' : state})
+
+    def finished(self):
+        ''' Called once every client has been disconnected '''
+        def stopped(result):
+            if self.handoff is not None:
+                self.handoff.send({'op' : 'done'})
+                self.handoff.transport.loseConnection()
+        #the socket file is removed before the new server listens on it
+        d = defer.maybeDeferred(self.listening.stopListening)
+        d.addBoth(stopped)
+
+
+@implementer(interfaces.IFileDescriptorReceiver)
+class TakeoverProtocol(NetstringReceiver):
+    ''' The new servers end of the connection to the old server '''
+
+    MAX_LENGTH = MAX_MESSAGE_LENGTH
+
+    def connectionMade(self):
+        self.descriptors = []
+
+    def fileDescriptorReceived(self, descriptor):
+        self.descriptors.append(descriptor)
+
+    def stringReceived(self, data):
+        message = json.loads(data)
+        try:
+            handler = getattr(self.factory, '_on' + message['op'].capitalize())
+        except AttributeError:
+            logger.warn('Unknown message from the old server: %s', message)
+        else:
+            handler(self, message)
+
+    def send(self, message):
+        self.sendString(json.dumps(message))
+
+    def connectionLost(self, reason):
+        self.factory.lost(reason)
+
+
+class Takeover(protocol.ClientFactory):
+    '''
+    Takes over from the server listening on a handoff socket. The server
+    passes:
+        restore(states) - puts back the users in the snapshot
+        listen(descriptor) - starts accepting connections on the listening
+            socket. The descriptor is closed afterwards
+        draining() - the old server has stopped journaling
+        changed(state) - a user on the old server has changed
+        gone(username) - a user on the old server has logged out
+        help(state) - a help request from a user moving over from the old
+            server
+    '''
+    protocol = TakeoverProtocol
+
+    def __init__(self, restore, listen, draining, changed, gone, help):
+        self.restore = restore
+        self.listen = listen
+        self.draining = draining
+        self.changed = changed
+        self.gone = gone
+        self.help = help
+        self.accepting = defer.Deferred()
+        self.over = defer.Deferred()
+        self.finished = False
+
+    def connect(self, path):
+        '''
+        Connects to the old server, returning a deferred that fires once
+        this server is accepting connections. over fires after that, once
+        the old server has gone
+        '''
+        reactor.connectUNIX(path, self)
+        return self.accepting
+
+    def clientConnectionFailed(self, connector, reason):
+        self.accepting.errback(reason)
+
+    def lost(self, reason):
+        if not self.accepting.called:
+            self.accepting.errback(reason)
+            return
+        if not self.finished:
+            logger.warn('Lost the old server before it had drained: %s',
+                        reason.getErrorMessage())
+        else:
+            logger.info('The old server has handed over every client')
+        self.over.callback(None)
+
+    def _onSnapshot(self, protocol, message):
+        if not protocol.descriptors:
+            logger.warn('The old server didn\'t send its listening socket')
+            protocol.transport.loseConnection()
+            return
+        descriptor = protocol.descriptors.pop(0)
+        self.restore(message['users'])
+        try:
+            self.listen(descriptor)
+        finally:
+            os.close(descriptor)
+        protocol.send({'op' : 'ready'})
+        self.accepting.callback(len(message['users']))
+
+    def _onDraining(self, protocol, message):
+        self.draining()
+
+    def _onUser(self, protocol, message):
+        del message['op']
+        self.changed(message)
+
+    def _onGone(self, protocol, message):
+        self.gone(message['user'])
+
+    def _onHelp(self, protocol, message):
+        state = message['request']
+        #json has no tuples, which is what the clients use for helpIds
+        if isinstance(state['helpId'], list):
+            state['helpId'] = tuple(state['helpId'])
+        self.help(state)
+
+    def _onDone(self, protocol, message):
+        self.finished = True
+
+
+def listenHandoff(path, listener, reactor=reactor):
+    ''' Starts the HandoffListener listening on the unix socket at path '''
+    if os.path.exists(path):
+        os.unlink(path)
+    listener.listening = reactor.listenUNIX(path, listener, mode=0600)
+    return listener.listening
@@ -0,0 +1,152 @@
+'''
+Checks that clients are still connected using a single timer for all of
+them rather than a timer per client
+'''
+import math
+import time
+
+from twisted.spread import pb
+from twisted.internet import reactor, task
+
+import logging
+
+logger = logging.getLogger('MyLogger')
+
+class HeartbeatWheel(object):
+    '''
+    A hashed timing wheel of sessions (UserService objects). Each tick the
+    wheel moves on one slot and looks at the sessions in that slot.
+
+    Any call from a client counts as a heartbeat (see touch), so a client is
+    only pinged when it has been idle for pingEvery seconds. If it then
+    doesn't reply within timeout seconds it is logged out.
+
+    Touching a session doesn't move it in the wheel, when its slot comes
+    round it is just put back in the slot for when it will next be idle.
+    This keeps touch cheap as it is called for every call from a client.
+    '''
+
+    def __init__(self, pingEvery, timeout, tick=1, clock=reactor):
+        '''
+        pingEvery - seconds a client can be idle before it is pinged
+        timeout - seconds a client has to respond to a ping
+        tick - seconds between each sweep of a slot
+        clock - the clock used, this is only not the reactor for testing
+        '''
+        self.pingEvery = pingEvery
+        self.timeout = timeout
+        self.tick = tick
+        self.clock = clock
+
+        numSlots = int(math.ceil(max(pingEvery, timeout) / float(tick))) + 1
+        self.slots = [set() for _ in range(numSlots)]
+        self.position = 0
+        self.slotOf = {}
+
+        self.loop = task.LoopingCall(self.sweep)
+        self.loop.clock = clock
+
+        self.stats = {'sweeps' : 0,
+                      'lastSweepSecs' : 0.0,
+                      'maxSweepSecs' : 0.0,
+                      'totalSweepSecs' : 0.0,
+                      'pings' : 0,
+                      'expired' : 0}
+
+    def start(self):
+        self.loop.start(self.tick, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def _schedule(self, session, delay):
+        ''' Puts the session in the slot that is delay seconds away '''
+        ticks = max(1, int(math.ceil(delay / float(self.tick))))
+        index = (self.position + ticks) % len(self.slots)
+        self.slots[index].add(session)
+        self.slotOf[session] = index
+
+    def add(self, session):
+        ''' Starts checking the session '''
+        session.lastSeen = self.clock.seconds()
+        session.pingSentAt = None
+        self._schedule(session, self.pingEvery)
+
+    def remove(self, session):
+        ''' Stops checking the session '''
+        try:
+            self.slots[self.slotOf.pop(session)].discard(session)
+        except KeyError:
+            pass
+
+    def touch(self, session):
+        ''' Records that we have heard from the client '''
+        session.lastSeen = self.clock.seconds()
+        session.pingSentAt = None
+
+    def lost(self, session):
+        '''
+        Called when the connection to the client has gone. The session is
+        kept for timeout seconds in case the client reconnects and resumes
+        it, after which it is expired
+        '''
+        if session.pingSentAt is not None or session not in self.slotOf:
+            return
+        session.pingSentAt = self.clock.seconds()
+        self.remove(session)
+        self._schedule(session, self.timeout)
+
+    def _ping(self, session, now):
+        session.pingSentAt = now
+        self.stats['pings'] += 1
+        try:
+            d = session.client.callRemote('ping')
+        except pb.DeadReferenceError:
+            logger.debug('Ping to %s failed... the user must have quit',
+                         session.user)
+            self._schedule(session, self.timeout)
+            return
+
+        def onErr(reason):
+            #the sweep will time the session out
+            logger.debug('Ping to %s failed: %s', session.user,
+                         reason.getErrorMessage())
+        d.addCallbacks(lambda r: self.touch(session), onErr)
+        self._schedule(session, self.timeout)
+
+    def _expire(self, session):
+        self.stats['expired'] += 1
+        session.expire()
+
+    def sweep(self):
+        ''' Moves the wheel on a slot and checks the sessions in that slot '''
+        start = time.time()
+        self.position = (self.position + 1) % len(self.slots)
+        slot, self.slots[self.position] = self.slots[self.position], set()
+
+        now = self.clock.seconds()
+        expired = self.stats['expired']
+        for session in slot:
+            del self.slotOf[session]
+            if session.pingSentAt is not None:
+                if now - session.pingSentAt >= self.timeout:
+                    self._expire(session)
+                else:
+                    self._schedule(session,
+                                   session.pingSentAt + self.timeout - now)
+            elif now - session.lastSeen >= self.pingEvery:
+                self._ping(session, now)
+            else:
+                self._schedule(session,
+                               session.lastSeen + self.pingEvery - now)
+
+        if self.stats['expired'] != expired:
+            logger.debug('Heartbeat expired %d sessions',
+                         self.stats['expired'] - expired)
+
+        taken = time.time() - start
+        self.stats['sweeps'] += 1
+        self.stats['lastSweepSecs'] = taken
+        self.stats['totalSweepSecs'] += taken
+        self.stats['maxSweepSecs'] = max(self.stats['maxSweepSecs'], taken)
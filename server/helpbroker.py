@@ -0,0 +1,383 @@
+'''
+Looks after help requests on the server, so a student asking a cascader
+who is away from their desk isn't left waiting forever. A request is
+offered to one cascader at a time and if they reject it, or don't answer
+within the attempt time, it is offered to the next cascader that can help.
+'''
+import bisect
+import heapq
+import itertools
+import random
+
+from twisted.internet import defer, reactor, task
+
+import logging
+
+from tracing import percentile
+
+logger = logging.getLogger('MyLogger.help')
+
+#the upper bound in seconds of each wait time bucket, the last bucket is
+#everything slower
+WAIT_BUCKETS = (1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 240, 300)
+
+#the most wait times kept to work out the percentiles from
+MAX_WAIT_SAMPLES = 1000
+
+class HelpRequest(object):
+    ''' A student waiting for help '''
+
+    def __init__(self, helpId, student, cascader, subject, problem, asked):
+        self.helpId = helpId
+        self.student = student
+        #the cascader the student asked for, they are offered it first
+        self.preferred = cascader
+        self.subject = subject
+        self.problem = problem
+        self.asked = asked
+        #the cascaders that have been offered the request
+        self.tried = set()
+        #the cascader it is offered to at the moment, None while queued
+        self.cascader = None
+        self.attemptCall = None
+        self.deadlineCall = None
+        #the reason given by the last cascader to reject it
+        self.why = 'No response'
+        #set once the request has gone to another server (see handOver)
+        self.handedOver = False
+        #fires with (accepted, why, cascader) once the request is finished
+        self.result = defer.Deferred()
+
+    @property
+    def done(self):
+        return self.handedOver or self.result.called
+
+    def state(self):
+        '''
+        What another server needs to carry on with the request. The cascader
+        it is being offered to isn't counted as tried, so they are asked again
+        '''
+        return {'helpId' : self.helpId,
+                'student' : self.student,
+                'preferred' : self.preferred,
+                'subject' : self.subject,
+                'problem' : self.problem,
+                'asked' : self.asked,
+                'tried' : sorted(self.tried - set([self.cascader])),
+                'why' : self.why}
+
+
+class HelpBroker(object):
+    '''
+    Holds the help requests that haven't been accepted, oldest first, so a
+    request that has been passed on doesn't fall behind those asked after
+    it. Each cascader is only offered one request at a time, apart from
+    the cascader a student asked for by name who is always offered their
+    request first.
+
+    The server passes:
+        candidates(request) - the usernames of the cascaders that could
+            take the request, best first
+        offer(request, cascader) - offers the request to the cascader,
+            returning a deferred of (accepted, why) or raising if the
+            cascader isn't connected
+        progress(request, event, details) - tells the student how their
+            request is getting on. The events are queued (position),
+            asking (cascader), noAnswer (cascader), rejected (cascader,
+            why), accepted (cascader) and gaveUp (why)
+
+    >>> clock = task.Clock()
+    >>> answers = {}
+    >>> def offer(request, cascader):
+    ...     answers[cascader] = defer.Deferred()
+    ...     return answers[cascader]
+    >>> broker = HelpBroker(lambda r: ['a', 'b'], offer, lambda *a: None,
+    ...                     30, 300, clock=clock)
+    >>> results = []
+    >>> d = broker.ask('id', 'student', 'a', 'inf1', 'help')
+    >>> _ = d.addCallback(results.append)
+    >>> clock.advance(30)
+    >>> answers['b'].callback((True, ''))
+    >>> results
+    [(True, '', 'b')]
+    >>> broker.stats['timeouts'], broker.stats['accepted']
+    (1, 1)
+    '''
+
+    def __init__(self, candidates, offer, progress, attemptSecs, maxWaitSecs,
+                 retrySecs=5, clock=reactor):
+        '''
+        attemptSecs - how long a cascader has to answer before the request
+            is offered to the next one
+        maxWaitSecs - the longest a request is held before the student is
+            told no one can help
+        retrySecs - how often requests waiting for a free cascader are
+            looked at again
+        clock - the clock used, this is only not the reactor for testing
+        '''
+        self.candidates = candidates
+        self.offer = offer
+        self.progress = progress
+        self.attemptSecs = attemptSecs
+        self.maxWaitSecs = maxWaitSecs
+        self.clock = clock
+
+        #heap of (time asked, sequence, request) of the requests not being
+        #offered to anyone, finished requests are skipped when popped
+        self.queue = []
+        self.sequence = itertools.count()
+        #helpId -> HelpRequest of every unfinished request
+        self.requests = {}
+        #the cascaders that have been offered a request and not answered
+        self.busy = set()
+
+        self.loop = task.LoopingCall(self.dispatch)
+        self.loop.clock = clock
+        self.retrySecs = retrySecs
+
+        self.waitHistogram = [0] * (len(WAIT_BUCKETS) + 1)
+        self.waitTotalSecs = 0.0
+        self.waitSamples = []
+        self.waitCount = 0
+
+        self.stats = {'asked' : 0, 'attempts' : 0, 'accepted' : 0,
+                      'rejected' : 0, 'timeouts' : 0, 'gaveUp' : 0,
+                      'cancelled' : 0, 'late' : 0, 'handedOver' : 0}
+
+    def start(self):
+        self.loop.start(self.retrySecs, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def queued(self):
+        ''' The number of requests that are waiting for a cascader '''
+        return sum(1 for r in self.requests.itervalues() if r.cascader is None)
+
+    def waitStats(self):
+        ''' The percentiles of the time taken for requests to be finished '''
+        return {'count' : self.waitCount,
+                'totalSecs' : self.waitTotalSecs,
+                'p50' : percentile(self.waitSamples, 0.5),
+                'p90' : percentile(self.waitSamples, 0.9),
+                'p99' : percentile(self.waitSamples, 0.99)}
+
+    def ask(self, helpId, student, cascader, subject, problem):
+        '''
+        Queues a request for help, returning a deferred that fires with
+        (accepted, why, cascader) once a cascader accepts, or with
+        (False, why, None) after maxWaitSecs
+        '''
+        if helpId in self.requests:
+            raise ValueError('Already asking for help with %s' % (helpId,))
+        request = HelpRequest(helpId, student, cascader, subject, problem,
+                              self.clock.seconds())
+        self.requests[helpId] = request
+        self.stats['asked'] += 1
+        request.deadlineCall = self.clock.callLater(self.maxWaitSecs,
+                                                    self._giveUp, request)
+        self._queue(request)
+        self.dispatch()
+        if request.cascader is None and not request.done:
+            self.progress(request, 'queued', {'position' : self.queued()})
+        return request.result
+
+    def cancel(self, student):
+        ''' Drops the requests of a student that has gone '''
+        for request in self.requests.values():
+            if request.student == student:
+                self.stats['cancelled'] += 1
+                self._finish(request, (False, 'Cancelled', None))
+
+    def handOver(self, student):
+        '''
+        Takes out the requests of a student who is moving to a new server
+        process, without telling them, and returns their states for the new
+        server to adopt
+
+        >>> clock = task.Clock()
+        >>> old = HelpBroker(lambda r: [], None, lambda *a: None, 30, 300,
+        ...                  clock=clock)
+        >>> _ = old.ask('id', 'student', 'a', 'inf1', 'help')
+        >>> clock.advance(100)
+        >>> states = old.handOver('student')
+        >>> old.requests, old.stats['handedOver']
+        ({}, 1)
+        >>> new = HelpBroker(lambda r: [], None, lambda *a: None, 30, 300,
+        ...                  clock=clock)
+        >>> results = []
+        >>> _ = new.adopt(states[0]).addCallback(results.append)
+        >>> clock.advance(199)
+        >>> results
+        []
+        >>> clock.advance(1)
+        >>> results
+        [(False, 'No response', None)]
+        '''
+        states = []
+        for request in self.requests.values():
+            if request.student != student:
+                continue
+            del self.requests[request.helpId]
+            self._cancelCalls(request)
+            request.handedOver = True
+            self.stats['handedOver'] += 1
+            states.append(request.state())
+        return states
+
+    def adopt(self, state):
+        '''
+        Carries on with a request handed over by the old server (see
+        handOver), returning a deferred like ask does. The request keeps
+        its place in the queue and its deadline
+        '''
+        helpId = state['helpId']
+        if helpId in self.requests:
+            raise ValueError('Already asking for help with %s' % (helpId,))
+        request = HelpRequest(helpId, state['student'], state['preferred'],
+                              state['subject'], state['problem'],
+                              state['asked'])
+        request.tried = set(state['tried'])
+        request.why = state['why']
+        self.requests[helpId] = request
+        remaining = request.asked + self.maxWaitSecs - self.clock.seconds()
+        request.deadlineCall = self.clock.callLater(max(0, remaining),
+                                                    self._giveUp, request)
+        self._queue(request)
+        self.dispatch()
+        return request.result
+
+    def _queue(self, request):
+        request.cascader = None
+        heapq.heappush(self.queue,
+                       (request.asked, next(self.sequence), request))
+
+    def _nextCascader(self, request):
+        for cascader in self.candidates(request):
+            if cascader == request.student or cascader in request.tried:
+                continue
+            if cascader == request.preferred or cascader not in self.busy:
+                return cascader
+        return None
+
+    def dispatch(self):
+        ''' Offers the queued requests to any cascaders that are free '''
+        waiting = []
+        while self.queue:
+            entry = heapq.heappop(self.queue)
+            request = entry[2]
+            if request.done or request.cascader is not None:
+                continue
+            cascader = self._nextCascader(request)
+            if cascader is None:
+                waiting.append(entry)
+            else:
+                self._offer(request, cascader)
+        for entry in waiting:
+            heapq.heappush(self.queue, entry)
+
+    def _offer(self, request, cascader):
+        request.cascader = cascader
+        request.tried.add(cascader)
+        self.busy.add(cascader)
+        self.stats['attempts'] += 1
+        logger.info('Offering the request from %s to %s', request.student,
+                    cascader)
+        try:
+            d = self.offer(request, cascader)
+        except Exception as e:
+            logger.info('Couldn\'t offer the request to %s: %s', cascader, e)
+            self.busy.discard(cascader)
+            self._queue(request)
+            return
+        self.progress(request, 'asking', {'cascader' : cascader})
+        request.attemptCall = self.clock.callLater(self.attemptSecs,
+                                                   self._noAnswer, request,
+                                                   cascader)
+        d.addCallbacks(self._answered, self._failed,
+                       callbackArgs=(request, cascader),
+                       errbackArgs=(request, cascader))
+
+    def _current(self, request, cascader):
+        ''' True if the request is still waiting on this cascader '''
+        return not request.done and request.cascader == cascader
+
+    def _moveOn(self, request):
+        if request.attemptCall is not None and request.attemptCall.active():
+            request.attemptCall.cancel()
+        request.attemptCall = None
+        self._queue(request)
+        self.dispatch()
+        if request.cascader is None and not request.done:
+            self.progress(request, 'queued', {'position' : self.queued()})
+
+    def _answered(self, answer, request, cascader):
+        self.busy.discard(cascader)
+        accepted, why = answer
+        if not self._current(request, cascader):
+            if accepted:
+                self.stats['late'] += 1
+                logger.info('%s accepted the request from %s after it had '
+                            'moved on', cascader, request.student)
+            self.dispatch()
+            return (False, 'Too late')
+        if accepted:
+            self.stats['accepted'] += 1
+            self.progress(request, 'accepted', {'cascader' : cascader})
+            self._finish(request, (True, why, cascader))
+            return answer
+        self.stats['rejected'] += 1
+        request.why = why
+        self.progress(request, 'rejected', {'cascader' : cascader, 'why' : why})
+        self._moveOn(request)
+        return answer
+
+    def _failed(self, reason, request, cascader):
+        self.busy.discard(cascader)
+        logger.info('Offering the request from %s to %s failed: %s',
+                    request.student, cascader, reason.getErrorMessage())
+        if self._current(request, cascader):
+            self._moveOn(request)
+
+    def _noAnswer(self, request, cascader):
+        request.attemptCall = None
+        if not self._current(request, cascader):
+            return
+        self.stats['timeouts'] += 1
+        logger.info('%s didn\'t answer the request from %s', cascader,
+                    request.student)
+        self.progress(request, 'noAnswer', {'cascader' : cascader})
+        self._moveOn(request)
+
+    def _giveUp(self, request):
+        request.deadlineCall = None
+        if request.done:
+            return
+        self.stats['gaveUp'] += 1
+        logger.info('No one took the request from %s', request.student)
+        self.progress(request, 'gaveUp', {'why' : request.why})
+        self._finish(request, (False, request.why, None))
+
+    def _cancelCalls(self, request):
+        for call in (request.attemptCall, request.deadlineCall):
+            if call is not None and call.active():
+                call.cancel()
+        request.attemptCall = request.deadlineCall = None
+
+    def _finish(self, request, result):
+        del self.requests[request.helpId]
+        self._cancelCalls(request)
+        self._waited(self.clock.seconds() - request.asked)
+        request.result.callback(result)
+
+    def _waited(self, secs):
+        self.waitCount += 1
+        self.waitTotalSecs += secs
+        self.waitHistogram[bisect.bisect_left(WAIT_BUCKETS, secs)] += 1
+        if len(self.waitSamples) < MAX_WAIT_SAMPLES:
+            self.waitSamples.append(secs)
+        else:
+            i = random.randint(0, self.waitCount - 1)
+            if i < MAX_WAIT_SAMPLES:
+                self.waitSamples[i] = secs
@@ -0,0 +1,178 @@
+'''
+Counts calls to the remote_ methods of the services and how long they
+take, so it is possible to see which calls are hot
+'''
+from __future__ import with_statement
+
+import bisect
+import functools
+import json
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.python import failure
+
+import logging
+
+logger = logging.getLogger('MyLogger')
+
+#the upper bound in seconds of each latency bucket, the last bucket is
+#everything slower
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+class MethodStats(object):
+    '''
+    The counters for a single method. Calls that return a deferred are
+    timed until the deferred fires and go in their own histogram
+    '''
+    __slots__ = ('calls', 'errors', 'inFlight', 'maxInFlight', 'totalSecs',
+                 'histogram', 'deferredCalls', 'deferredTotalSecs',
+                 'deferredHistogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.inFlight = 0
+        self.maxInFlight = 0
+        self.totalSecs = 0.0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+        self.deferredCalls = 0
+        self.deferredTotalSecs = 0.0
+        self.deferredHistogram = [0] * (len(BUCKETS) + 1)
+
+    def started(self):
+        self.calls += 1
+        self.inFlight += 1
+        if self.inFlight > self.maxInFlight:
+            self.maxInFlight = self.inFlight
+
+    def finished(self, secs, error=False):
+        self.inFlight -= 1
+        if error:
+            self.errors += 1
+        self.totalSecs += secs
+        self.histogram[bisect.bisect_left(BUCKETS, secs)] += 1
+
+    def deferredFinished(self, result, start):
+        ''' Added as a callback and errback to a deferred result '''
+        secs = time.time() - start
+        self.inFlight -= 1
+        if isinstance(result, failure.Failure):
+            self.errors += 1
+        self.deferredTotalSecs += secs
+        self.deferredHistogram[bisect.bisect_left(BUCKETS, secs)] += 1
+        return result
+
+    def asDict(self):
+        return {'calls' : self.calls,
+                'errors' : self.errors,
+                'inFlight' : self.inFlight,
+                'maxInFlight' : self.maxInFlight,
+                'totalSecs' : self.totalSecs,
+                'histogram' : list(self.histogram),
+                'deferredCalls' : self.deferredCalls,
+                'deferredTotalSecs' : self.deferredTotalSecs,
+                'deferredHistogram' : list(self.deferredHistogram)}
+
+
+class Instrumentation(object):
+    '''
+    Holds the MethodStats of every instrumented method. Classes are
+    instrumented with instrumentClass, which wraps their remote_ methods
+
+    >>> class S(object):
+    ...     def remote_a(self): return 1
+    ...     def remote_b(self): raise ValueError()
+    ...     def remote_c(self): return defer.succeed(2)
+    >>> inst = Instrumentation()
+    >>> inst.instrumentClass(S)
+    >>> s = S()
+    >>> s.remote_a()
+    1
+    >>> s.remote_b()
+    Traceback (most recent call last):
+    ValueError
+    >>> d = s.remote_c()
+    >>> stats = inst.snapshot()['methods']
+    >>> stats['S.a']['calls'], stats['S.b']['errors'], stats['S.c']['deferredCalls']
+    (1, 1, 1)
+    >>> stats['S.c']['inFlight']
+    0
+    '''
+
+    def __init__(self):
+        #'Class.method' -> MethodStats
+        self.methods = {}
+        self.started = time.time()
+
+    def instrumentClass(self, cls):
+        ''' Wraps all the remote_ methods defined on the class '''
+        for attr, value in cls.__dict__.items():
+            if attr.startswith('remote_') and callable(value):
+                name = cls.__name__ + '.' + attr[len('remote_'):]
+                setattr(cls, attr, self._wrap(name, value))
+
+    def _wrap(self, name, method):
+        stats = self.methods[name] = MethodStats()
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            stats.started()
+            start = time.time()
+            try:
+                result = method(*args, **kwargs)
+            except:
+                stats.finished(time.time() - start, True)
+                raise
+            if isinstance(result, defer.Deferred):
+                stats.deferredCalls += 1
+                result.addBoth(stats.deferredFinished, start)
+            else:
+                stats.finished(time.time() - start)
+            return result
+        return wrapper
+
+    def reset(self):
+        ''' Zeros the stats of every method '''
+        for stats in self.methods.itervalues():
+            stats.__init__()
+        self.started = time.time()
+
+    def snapshot(self):
+        ''' Returns the stats as simple types that can be sent or saved '''
+        methods = {}
+        for name, stats in self.methods.iteritems():
+            methods[name] = stats.asDict()
+        return {'time' : time.time(),
+                'uptimeSecs' : time.time() - self.started,
+                'buckets' : list(BUCKETS),
+                'methods' : methods}
+
+
+class StatsDumper(object):
+    '''
+    Periodically writes the result of a function (which should return
+    something that can be turned into json) to a file
+    '''
+
+    def __init__(self, function, filename, interval, clock=reactor):
+        self.function = function
+        self.filename = filename
+        self.loop = task.LoopingCall(self.dump)
+        self.loop.clock = clock
+        self.interval = interval
+
+    def start(self):
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def dump(self):
+        try:
+            with open(self.filename, 'w') as f:
+                json.dump(self.function(), f)
+        except IOError as e:
+            logger.warn('Failed to write stats to %s: %s', self.filename, e)
@@ -0,0 +1,246 @@
+'''
+Keeps a journal of the presence of the users logged in, so that a server
+that is restarted can put back the cascaders that were there before their
+clients reconnect (see ProvisionalSession in Server.py).
+
+Every change is appended to the journal as a line of json. Every so often
+the journal is compacted: the state of everyone logged in is written to a
+snapshot and the journal is started again. The snapshot is written to a
+temporary file that is renamed over the old one, so there is always a
+whole snapshot.
+
+Loading reads the snapshot and then the journal. A record holds the whole
+state of a user, so records that are in both (from a crash part way
+through compacting) do no harm, and a torn last line (from a crash part
+way through a write) is ignored.
+
+The files are written by a background thread, in the order the records
+were made, so a slow disk never holds up the reactor. Records are flushed
+as they are written, so once written they survive the server crashing,
+though not the machine. The files hold the users' resume tokens, so only
+the user the server runs as can read them.
+'''
+from __future__ import with_statement
+
+import json
+import logging
+import os
+import threading
+import Queue
+
+from twisted.internet import reactor, task
+
+logger = logging.getLogger('MyLogger')
+
+def sessionState(session):
+    ''' The state of a user that is journaled, and passed on in a handoff '''
+    return {'user' : session.user,
+            'hostname' : session.hostname,
+            'cascading' : session.cascading,
+            'subjects' : sorted(session.subjects),
+            'interests' : [None if i is None else sorted(i)
+                           for i in session.interests],
+            'resumeToken' : session.resumeToken}
+
+def _openPrivate(filename, mode):
+    '''
+    Opens a file for writing (mode is 'w' or 'a') that only this user can
+    read, including one that was made before with looser permissions
+    '''
+    flags = os.O_WRONLY | os.O_CREAT
+    flags |= os.O_APPEND if mode == 'a' else os.O_TRUNC
+    fd = os.open(filename, flags, 0600)
+    try:
+        os.fchmod(fd, 0600)
+        return os.fdopen(fd, mode)
+    except OSError:
+        os.close(fd)
+        raise
+
+
+class PresenceJournal(object):
+    ''' Journals presence changes and compacts them into snapshots '''
+
+    def __init__(self, filename, sessions, compactEvery, maxRecords,
+                 clock=reactor):
+        '''
+        filename - the journal, the snapshot is the same with .snapshot added
+        sessions - function returning the sessions to write to a snapshot
+        compactEvery - seconds between compacting the journal
+        maxRecords - the journal is compacted early when it gets this long
+        clock - the clock used, this is only not the reactor for testing
+        '''
+        self.filename = filename
+        self.snapshotFilename = filename + '.snapshot'
+        self.sessions = sessions
+        self.compactEvery = compactEvery
+        self.maxRecords = maxRecords
+
+        #only used by the writer thread
+        self.file = None
+        #(operation, argument) for the writer thread, None to stop it
+        self.queue = Queue.Queue()
+        self.thread = None
+        #the number of records in the journal since the last snapshot
+        self.records = 0
+
+        self.loop = task.LoopingCall(self.compact)
+        self.loop.clock = clock
+
+        self.stats = {'records' : 0, 'compactions' : 0, 'tornRecords' : 0,
+                      'writeErrors' : 0}
+
+    def load(self):
+        '''
+        Returns a dict of username to the last recorded state of every user
+        that was logged in. Each state is a dict of user, hostname,
+        cascading, subjects, interests (the labs and subjects subscribed to)
+        and resumeToken
+
+        >>> import tempfile
+        >>> class U: pass
+        >>> a, b = U(), U()
+        >>> a.user, a.hostname, a.cascading, a.subjects = 'a', 'h1', True, set(['x'])
+        >>> b.user, b.hostname, b.cascading, b.subjects = 'b', 'h2', False, set()
+        >>> a.resumeToken = b.resumeToken = 't'
+        >>> a.interests = b.interests = (None, None)
+        >>> filename = tempfile.mktemp()
+        >>> j = PresenceJournal(filename, lambda: [a], 60, 100)
+        >>> j.start()
+        >>> j.record(b)
+        >>> j.gone('a')
+        >>> j.stop()
+        >>> with open(filename, 'a') as f:
+        ...     f.write('{"user": "c", "hostn')
+        >>> j.load().keys()
+        [u'b']
+        >>> j.stats['tornRecords']
+        1
+        >>> oct(os.stat(filename).st_mode & 0777)
+        '0600'
+        >>> os.remove(filename); os.remove(j.snapshotFilename)
+        '''
+        users = {}
+        for filename in (self.snapshotFilename, self.filename):
+            self._replay(filename, users)
+        return users
+
+    def _replay(self, filename, users):
+        try:
+            f = open(filename)
+        except IOError:
+            return
+        with f:
+            for number, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    #nothing is written after a torn record, as the journal
+                    #is compacted when the server starts
+                    logger.warn('Ignoring torn record at line %d of %s',
+                                number + 1, filename)
+                    self.stats['tornRecords'] += 1
+                    break
+                if record.get('gone'):
+                    users.pop(record['user'], None)
+                else:
+                    users[record['user']] = record
+
+    def start(self):
+        ''' Compacts what was there before and starts journaling '''
+        self.thread = threading.Thread(target=self._run, name='journal')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.compact()
+        self.loop.start(self.compactEvery, now=False)
+
+    def stop(self):
+        ''' Writes out everything already recorded and stops the thread '''
+        if self.loop.running:
+            self.loop.stop()
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def record(self, session):
+        ''' Records the state of a user (anything like a UserService) '''
+        self._write(sessionState(session))
+
+    def gone(self, username):
+        ''' Records that a user is no longer logged in '''
+        self._write({'user' : username, 'gone' : True})
+
+    def _write(self, record):
+        if self.thread is None:
+            return
+        self.queue.put(('append', json.dumps(record) + '\n'))
+        self.records += 1
+        if self.records >= self.maxRecords:
+            self.compact()
+
+    def compact(self):
+        '''
+        Writes everyone to a new snapshot and starts an empty journal. The
+        snapshot is taken now, the writer thread writes it once it has
+        written the records before it
+        '''
+        if self.thread is None:
+            return
+        lines = [json.dumps(sessionState(session)) + '\n'
+                 for session in self.sessions()]
+        self.queue.put(('compact', lines))
+        self.records = 0
+
+    #--------------------------------------------------------------------------
+    # the writer thread
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            operation, argument = item
+            if operation == 'append':
+                self._append(argument)
+            else:
+                self._compact(argument)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _append(self, line):
+        if self.file is None:
+            return
+        try:
+            self.file.write(line)
+            self.file.flush()
+        except IOError as e:
+            logger.warn('Failed to write to the presence journal: %s', e)
+            self.stats['writeErrors'] += 1
+            return
+        self.stats['records'] += 1
+
+    def _compact(self, lines):
+        temp = self.snapshotFilename + '.tmp'
+        try:
+            with _openPrivate(temp, 'w') as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temp, self.snapshotFilename)
+
+            if self.file is not None:
+                self.file.close()
+            self.file = _openPrivate(self.filename, 'w')
+        except (IOError, OSError) as e:
+            logger.warn('Failed to compact the presence journal: %s', e)
+            self.stats['writeErrors'] += 1
+            if self.file is None or self.file.closed:
+                #carry on adding to the journal that is there
+                try:
+                    self.file = _openPrivate(self.filename, 'a')
+                except (IOError, OSError):
+                    self.file = None
+            return
+        self.stats['compactions'] += 1
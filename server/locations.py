@@ -0,0 +1,46 @@
+'''
+Provides the lab that a host is in. This uses the same hosts file as the
+client (see labmap.Locator in the client) so the server and clients agree
+on where everyone is
+'''
+from __future__ import with_statement
+
+import os
+import ConfigParser as configparser
+
+HOSTS_FILENAME = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              '..', 'client', 'cascaders', 'data', 'hosts')
+
+class HostLabs(object):
+    ''' Lookup from hostname to the lab the host is in '''
+
+    def __init__(self, fileHandle=None):
+        '''
+        fileHandle - a file like object that holds the hosts data, if this is
+        None then no hosts are known about
+        '''
+        self.hostsLab = {}
+        if fileHandle is not None:
+            self.read(fileHandle)
+
+    def read(self, fileHandle):
+        ''' Replaces the known hosts with those in the given file '''
+        hosts = configparser.ConfigParser()
+        hosts.readfp(fileHandle)
+
+        hostsLab = {}
+        for lab in hosts.sections():
+            for hostname, _ in hosts.items(lab):
+                hostsLab[hostname] = lab
+        self.hostsLab = hostsLab
+
+    def labFromHostname(self, hostname):
+        return self.hostsLab.get(hostname)
+
+def loadHostLabs(filename=HOSTS_FILENAME):
+    ''' Loads the hosts file, if it can't be read no hosts are known '''
+    try:
+        with open(filename) as f:
+            return HostLabs(f)
+    except IOError:
+        return HostLabs()
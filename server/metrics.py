@@ -0,0 +1,108 @@
+'''
+Serves the servers gauges and counters over http in the Prometheus text
+format so that they can be scraped
+'''
+from twisted.web import resource
+
+def escapeLabel(value):
+    return (str(value).replace('\\', '\\\\')
+                      .replace('"', '\\"')
+                      .replace('\n', '\\n'))
+
+class MetricsWriter(object):
+    '''
+    Builds up the text of a scrape
+
+    >>> w = MetricsWriter()
+    >>> w.gauge('users_online', 'Users logged in', 3)
+    >>> w.counter('calls_total', 'Calls', [({'method' : 'ping'}, 2)])
+    >>> print w.text(),
+    # HELP users_online Users logged in
+    # TYPE users_online gauge
+    users_online 3
+    # HELP calls_total Calls
+    # TYPE calls_total counter
+    calls_total{method="ping"} 2
+    '''
+
+    def __init__(self):
+        self.lines = []
+
+    def _metric(self, kind, name, help, values):
+        '''
+        values is either a single number or a list of (labels, value) where
+        labels is a dict
+        '''
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+        if not isinstance(values, list):
+            values = [({}, values)]
+        for labels, value in values:
+            self.lines.append(self._sample(name, labels, value))
+
+    def _sample(self, name, labels, value):
+        if not labels:
+            return '%s %s' % (name, value)
+        labelText = ','.join('%s="%s"' % (k, escapeLabel(v))
+                             for k, v in sorted(labels.iteritems()))
+        return '%s{%s} %s' % (name, labelText, value)
+
+    def gauge(self, name, help, values):
+        self._metric('gauge', name, help, values)
+
+    def counter(self, name, help, values):
+        self._metric('counter', name, help, values)
+
+    def histogram(self, name, help, bounds, series):
+        '''
+        bounds - the upper bound of each bucket apart from the last
+        series - a list of (labels, buckets, total) where buckets is the
+                 count in each bucket (not cumulative, one more than the
+                 number of bounds) and total is the sum of the values
+        '''
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s histogram' % name)
+        for labels, buckets, total in series:
+            count = 0
+            for bound, n in zip(list(bounds) + ['+Inf'], buckets):
+                count += n
+                bucketLabels = dict(labels)
+                bucketLabels['le'] = bound
+                self.lines.append(self._sample(name + '_bucket',
+                                               bucketLabels, count))
+            self.lines.append(self._sample(name + '_sum', labels, total))
+            self.lines.append(self._sample(name + '_count', labels, count))
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def outboundBytes(remote):
+    '''
+    Returns the number of bytes waiting to be sent to the client on the
+    other end of the RemoteReference, or None if it isn't known
+    '''
+    try:
+        transport = remote.broker.transport
+        return (len(transport.dataBuffer) - transport.offset +
+                transport._tempDataLen)
+    except AttributeError:
+        return None
+
+
+class MetricsResource(resource.Resource):
+    '''
+    A twisted.web resource that serves the metrics. The function given is
+    called with a MetricsWriter for every scrape
+    '''
+    isLeaf = True
+
+    def __init__(self, write):
+        resource.Resource.__init__(self)
+        self.write = write
+
+    def render_GET(self, request):
+        writer = MetricsWriter()
+        self.write(writer)
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return writer.text()
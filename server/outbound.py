@@ -0,0 +1,275 @@
+'''
+Queues the calls the server makes to a client, so that a client that is slow
+to read what it is sent (on a congested link, or not answering) can't make
+the server hold an unbounded amount of data for it
+'''
+from twisted.spread import pb
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+import logging
+
+from metrics import outboundBytes
+
+logger = logging.getLogger('MyLogger')
+
+#how often a queue that is held up by bytes waiting to be written is retried
+RETRY_SECS = 0.5
+
+class QueueFull(pb.DeadReferenceError):
+    '''
+    Raised when a call can't be queued as the clients queue is full. This is
+    a DeadReferenceError so that callers treat the client as having gone
+    '''
+    pass
+
+
+def mergePresence(older, newer):
+    '''
+    Merges two presence batches (see BroadcastScheduler) into one that has
+    the same effect as applying the older and then the newer one. Only the
+    last thing that happened to each cascader is kept
+
+    >>> older = {'since' : 1, 'version' : 2, 'joined' : [('a', 'h', set(['x']))],
+    ...          'left' : ['b'], 'added' : [('c', set(['y']))], 'removed' : [],
+    ...          'usersLeft' : ['b']}
+    >>> newer = {'since' : 2, 'version' : 5, 'joined' : [('b', 'h', set(['z']))],
+    ...          'left' : ['c'], 'added' : [('a', set(['y']))],
+    ...          'removed' : [('a', set(['x']))], 'usersLeft' : []}
+    >>> merged = mergePresence(older, newer)
+    >>> merged['since'], merged['version']
+    (1, 5)
+    >>> sorted(merged['joined'])
+    [('a', 'h', set(['y'])), ('b', 'h', set(['z']))]
+    >>> merged['left'], merged['added'], merged['removed'], merged['usersLeft']
+    (['c'], [], [], ['b'])
+    '''
+    #username -> ('left',), ('joined', hostname, subjects) or
+    #('changed', added, removed), in the order the client applies them
+    final = {}
+    for batch in (older, newer):
+        for username in batch['left']:
+            final[username] = ('left',)
+        for username, hostname, subjects in batch['joined']:
+            final[username] = ('joined', hostname, set(subjects))
+        for username, subjects in batch['added']:
+            _mergeSubjects(final, username, set(subjects), set())
+        for username, subjects in batch['removed']:
+            _mergeSubjects(final, username, set(), set(subjects))
+
+    merged = {'since' : older['since'],
+              'version' : newer['version'],
+              'joined' : [],
+              'left' : [],
+              'added' : [],
+              'removed' : [],
+              'usersLeft' : list(older['usersLeft'])}
+    for username in newer['usersLeft']:
+        if username not in merged['usersLeft']:
+            merged['usersLeft'].append(username)
+    for username, change in final.iteritems():
+        if change[0] == 'left':
+            merged['left'].append(username)
+        elif change[0] == 'joined':
+            merged['joined'].append((username, change[1], change[2]))
+        else:
+            if change[1]:
+                merged['added'].append((username, change[1]))
+            if change[2]:
+                merged['removed'].append((username, change[2]))
+    return merged
+
+def _mergeSubjects(final, username, added, removed):
+    change = final.get(username)
+    if change is None:
+        final[username] = ('changed', added, removed)
+    elif change[0] == 'joined':
+        change[2].update(added)
+        change[2].difference_update(removed)
+    elif change[0] == 'changed':
+        change[1].update(added)
+        change[1].difference_update(removed)
+        change[2].update(removed)
+        change[2].difference_update(added)
+
+
+class OutboundQueue(object):
+    '''
+    Sends calls to a client, holding them back while the client is behind.
+    A client is behind when it has maxUnanswered calls that it hasn't
+    answered, or when more than maxBytes are waiting to be written to it.
+
+    At most maxQueued calls are held, after which calls fail with QueueFull.
+    Calls in COALESCE are merged into a call of the same name that is
+    already held rather than being held themselves, so however far behind a
+    client gets it only ever has one presence update waiting.
+
+    A client that is still behind after slowSecs is disconnected and onSlow
+    is called. Everything held for it fails with PBConnectionLost.
+    '''
+
+    #name -> function that merges the arguments of two calls into one
+    COALESCE = {'presenceChanged' : lambda older, newer:
+                                        (mergePresence(older[0], newer[0]),)}
+
+    def __init__(self, client, maxQueued, maxBytes, maxUnanswered, slowSecs,
+                 onSlow, stats, clock=reactor):
+        '''
+        client - the RemoteReference to the client
+        onSlow - called when the client is disconnected for being too slow
+        stats - a dict of counters shared between all the queues, with
+                queued, coalesced, dropped and disconnected. held (the
+                calls held), behind (the clients with calls held) and
+                waitingBytes (the bytes waiting to be written to the
+                clients, as of the last call to each) are kept up to date
+                for all of the queues
+        clock - the clock used, this is only not the reactor for testing
+        '''
+        self.client = client
+        self.maxQueued = maxQueued
+        self.maxBytes = maxBytes
+        self.maxUnanswered = maxUnanswered
+        self.slowSecs = slowSecs
+        self.onSlow = onSlow
+        self.stats = stats
+        self.clock = clock
+
+        #list of [name, args, deferreds] for the calls held back
+        self.queue = []
+        self.unanswered = 0
+        #when the queue last went from empty to having calls in it
+        self.behindSince = None
+        self.retry = None
+        #the bytes waiting to be written the last time they were looked at
+        self.waitingBytes = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def callRemote(self, name, *args):
+        '''
+        Calls the method on the client, or holds the call back if the client
+        is behind. Returns a deferred that fires with the result.
+
+        Raises DeadReferenceError if the client isn't connected, or
+        QueueFull if the call can't be held
+        '''
+        if not self.queue and not self._behind():
+            return self._send(name, args)
+
+        d = defer.Deferred()
+        merge = self.COALESCE.get(name)
+        if merge is not None:
+            for call in self.queue:
+                if call[0] == name:
+                    call[1] = merge(call[1], args)
+                    call[2].append(d)
+                    self.stats['coalesced'] += 1
+                    return d
+
+        if len(self.queue) >= self.maxQueued:
+            self.stats['dropped'] += 1
+            raise QueueFull('Too many calls waiting to be sent')
+        if not self.queue:
+            self.behindSince = self.clock.seconds()
+            self.stats['behind'] += 1
+        self.queue.append([name, args, [d]])
+        self.stats['queued'] += 1
+        self.stats['held'] += 1
+        self._scheduleRetry()
+        return d
+
+    def setClient(self, client):
+        ''' Moves over to a new connection, failing anything held '''
+        self._failQueued('Moved to a new connection')
+        self._waiting(0)
+        self.client = client
+        self.unanswered = 0
+
+    def close(self):
+        ''' Fails anything held and stops retrying '''
+        self._failQueued('Logged out')
+        self._waiting(0)
+
+    def _behind(self):
+        if self.unanswered >= self.maxUnanswered:
+            return True
+        waiting = outboundBytes(self.client)
+        self._waiting(waiting or 0)
+        return waiting is not None and waiting > self.maxBytes
+
+    def _waiting(self, waitingBytes):
+        self.stats['waitingBytes'] += waitingBytes - self.waitingBytes
+        self.waitingBytes = waitingBytes
+
+    def _send(self, name, args):
+        client = self.client
+        d = client.callRemote(name, *args)
+        self.unanswered += 1
+        d.addBoth(self._answered, client)
+        return d
+
+    def _answered(self, result, client):
+        if client is self.client:
+            self.unanswered -= 1
+            self._drain()
+        return result
+
+    def _scheduleRetry(self):
+        if self.retry is None or not self.retry.active():
+            self.retry = self.clock.callLater(RETRY_SECS, self._drain)
+
+    def _drain(self):
+        ''' Sends what it can of the queue '''
+        while self.queue and not self._behind():
+            name, args, deferreds = self.queue.pop(0)
+            self.stats['held'] -= 1
+            if not self.queue:
+                self.stats['behind'] -= 1
+            try:
+                d = self._send(name, args)
+            except pb.DeadReferenceError:
+                reason = failure.Failure()
+                self._failQueued(reason)
+                [waiting.errback(reason) for waiting in deferreds]
+                return
+            d.addBoth(self._fireAll, deferreds)
+
+        if not self.queue:
+            self.behindSince = None
+            if self.retry is not None and self.retry.active():
+                self.retry.cancel()
+        elif self.clock.seconds() - self.behindSince >= self.slowSecs:
+            self._disconnect()
+        else:
+            self._scheduleRetry()
+
+    def _fireAll(self, result, deferreds):
+        for d in deferreds:
+            d.callback(result)
+
+    def _failQueued(self, reason):
+        if not isinstance(reason, failure.Failure):
+            reason = failure.Failure(pb.PBConnectionLost(reason))
+        queue, self.queue = self.queue, []
+        if queue:
+            self.stats['held'] -= len(queue)
+            self.stats['behind'] -= 1
+        self.behindSince = None
+        if self.retry is not None and self.retry.active():
+            self.retry.cancel()
+        for name, args, deferreds in queue:
+            for d in deferreds:
+                #nothing may be waiting for the result of the call
+                d.addErrback(lambda r: None)
+                d.errback(reason)
+
+    def _disconnect(self):
+        self.stats['disconnected'] += 1
+        logger.info('Disconnecting a client %d calls behind', len(self.queue))
+        self._failQueued('Too slow')
+        try:
+            self.client.broker.transport.loseConnection()
+        except AttributeError:
+            pass
+        self.onSlow()
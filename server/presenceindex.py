@@ -0,0 +1,117 @@
+'''
+Indexes of who is cascading where and in what, so that questions like "who
+cascades inf2a in Level 5 North" can be answered without looking at every
+logged in user
+'''
+from collections import defaultdict
+
+class CascaderIndex(object):
+    '''
+    Incrementally maintained indexes over the logged in users:
+        hostname -> username for every user
+        subject -> usernames of cascaders with that subject
+        lab -> usernames of cascaders in that lab
+
+    The users must be passed to update whenever their cascading state,
+    hostname or subjects change
+    '''
+
+    def __init__(self, hostLabs):
+        '''
+        hostLabs - provides labFromHostname
+        '''
+        self.hostLabs = hostLabs
+
+        self.byHost = {}
+        self.bySubject = defaultdict(set)
+        self.byLab = defaultdict(set)
+        self.cascaders = set()
+
+        #username -> (hostname, lab, subjects) as currently indexed, the
+        #lab and subjects are None if the user isn't cascading
+        self.indexed = {}
+
+    def update(self, user):
+        '''
+        Re-indexes the user (a UserService or anything with user, hostname,
+        cascading and subjects attributes)
+
+        >>> from locations import HostLabs
+        >>> class U: pass
+        >>> u = U()
+        >>> u.user, u.hostname, u.cascading, u.subjects = 'a', 'h', True, set(['x'])
+        >>> ci = CascaderIndex(HostLabs())
+        >>> ci.update(u)
+        >>> ci.find(None, ['x'])
+        set(['a'])
+        >>> u.subjects = set(['y'])
+        >>> ci.update(u)
+        >>> ci.find(None, ['x'])
+        set([])
+        >>> ci.userAtHost('h')
+        'a'
+        '''
+        self.remove(user.user)
+
+        self.byHost[user.hostname] = user.user
+        if user.cascading:
+            lab = self.hostLabs.labFromHostname(user.hostname)
+            subjects = frozenset(user.subjects)
+            self.cascaders.add(user.user)
+            self.byLab[lab].add(user.user)
+            for subject in subjects:
+                self.bySubject[subject].add(user.user)
+        else:
+            lab = subjects = None
+        self.indexed[user.user] = (user.hostname, lab, subjects)
+
+    def remove(self, username):
+        ''' Removes all references to the user from the indexes '''
+        try:
+            hostname, lab, subjects = self.indexed.pop(username)
+        except KeyError:
+            return
+
+        if self.byHost.get(hostname) == username:
+            del self.byHost[hostname]
+        if subjects is None:
+            return
+
+        self.cascaders.discard(username)
+        self._discard(self.byLab, lab, username)
+        for subject in subjects:
+            self._discard(self.bySubject, subject, username)
+
+    def _discard(self, index, key, username):
+        index[key].discard(username)
+        if not index[key]:
+            del index[key]
+
+    def userAtHost(self, hostname):
+        return self.byHost.get(hostname)
+
+    def find(self, lab=None, subjects=None):
+        '''
+        Returns the set of usernames cascading in the lab in any of the
+        subjects. None for either means any.
+
+        When both are given this walks the smaller of the lab and each
+        subject set, so it takes time proportional to the result rather than
+        to the number of users
+        '''
+        if subjects is None:
+            if lab is None:
+                return set(self.cascaders)
+            return set(self.byLab.get(lab, ()))
+
+        result = set()
+        labUsers = self.byLab.get(lab, set()) if lab is not None else None
+        for subject in subjects:
+            subjectUsers = self.bySubject.get(subject, set())
+            if labUsers is None:
+                result |= subjectUsers
+            elif len(labUsers) < len(subjectUsers):
+                result.update(u for u in labUsers if u in subjectUsers)
+            else:
+                result.update(u for u in subjectUsers if u in labUsers)
+        return result
@@ -0,0 +1,71 @@
+'''
+Gives every presence change a version so that clients can ask for just the
+changes since the last version they saw
+'''
+import time
+from collections import deque
+
+class PresenceLog(object):
+    '''
+    Keeps a bounded log of which users changed at each version.
+
+    The epoch identifies this run of the server. Versions from a different
+    epoch mean nothing, so a client with one has to get a full snapshot.
+    '''
+
+    def __init__(self, maxLength):
+        '''
+        maxLength - the number of changes kept, after this older changes are
+        trimmed and a client that is further behind needs a snapshot
+        '''
+        self.epoch = str(time.time())
+        self.version = 0
+        self.log = deque(maxlen=maxLength)
+
+    def record(self, username):
+        '''
+        Records that the given user has changed, returning the new version
+
+        >>> pl = PresenceLog(10)
+        >>> pl.record('a')
+        1
+        >>> pl.record('b')
+        2
+        '''
+        self.version += 1
+        self.log.append((self.version, username))
+        return self.version
+
+    def changedSince(self, epoch, version):
+        '''
+        Returns the set of usernames that have changed since the version,
+        or None if the changes are not all known because either the epoch
+        or version is not valid or the log has been trimmed
+
+        >>> pl = PresenceLog(2)
+        >>> [pl.record(u) for u in ('a', 'b', 'a')]
+        [1, 2, 3]
+        >>> sorted(pl.changedSince(pl.epoch, 1))
+        ['a', 'b']
+        >>> pl.changedSince(pl.epoch, 3)
+        set([])
+        >>> pl.changedSince(pl.epoch, 0) is None
+        True
+        >>> pl.changedSince(pl.epoch, None) is None
+        True
+        >>> pl.changedSince('other', 2) is None
+        True
+        '''
+        if epoch != self.epoch or version is None or version > self.version:
+            return None
+
+        oldest = self.log[0][0] if self.log else self.version + 1
+        if version < oldest - 1:
+            return None
+
+        changed = set()
+        for v, username in reversed(self.log):
+            if v <= version:
+                break
+            changed.add(username)
+        return changed
@@ -0,0 +1,1170 @@
+#!/usr/bin/env python
+'''
+Runs the server against thousands of simulated clients for hours of
+simulated time, checking that the server stays consistent and reporting
+what it did.
+
+The services are the real LoginService and UserService. The clients talk to
+them over in memory loopback connections rather than sockets, and
+everything (heartbeats, broadcast windows, help timeouts and the clients
+themselves) runs off a task.Clock. Time jumps straight to the next thing
+that is due, so idle time costs nothing and the wall time taken is the
+server doing its work. Hours of heartbeats for thousands of clients take
+a minute or so, while presence changes cost in proportion to the number
+of clients each one is broadcast to.
+
+By default the loopback connections pass the arguments and results of calls
+straight through rather than serializing them. With --pb the clients are connected with real
+PB brokers joined by loopback transports, which is much slower but also
+exercises the serialization.
+
+On top of the clients logging in, idling and changing their subjects, the
+simulation has:
+    - broadcast storms, where half the clients change at once
+    - disconnect cascades, where every client in a lab loses its
+      connection and reconnects later (resuming the session if it can)
+    - hung clients, which stay connected but stop answering pings
+    - sleeping clients, which hang for longer than the heartbeat timeout
+      and then carry on calling the server on the connection they had,
+      as a laptop does when it wakes up. The server must have dropped the
+      connection when it logged them out, so they then log in again
+    - stalled clients, which answer pings but stop answering presence
+      updates, so the server holds their calls back and in the end
+      disconnects them (see OutboundQueue). They then reconnect
+    - help requests, some of which are never answered, so are passed on
+      to the next cascader (see HelpBroker)
+    - server restarts (with --restart-every), where every client loses its
+      connection and the server puts back the users from its journal
+      until their clients come back (see ProvisionalSession)
+    - handovers to a new server process (with --handoff-every), where the
+      clients are drained a few at a time and the new server puts back
+      the users and help requests the old one passed on (see handoff.py)
+
+Every --check-every simulated seconds the invariants are checked (see
+Simulation.check), including that every client's list of cascaders matches
+what the server would send it. Any that don't hold are printed and the exit
+status is 1.
+
+The same seed gives the same counters on every run. Only the wall time
+changes, so the counters can be compared between versions of the server.
+
+Run with: python simulate.py [--clients 1000] [--hours 1] [--seed 0] [--json]
+
+These should all run without breaking any invariants. The last one hands
+the server over while users put back after a restart are still waiting for
+their clients, and has clients that hang and so are logged out while
+still connected:
+    python simulate.py
+    python simulate.py --clients 200 --restart-every 600
+    python simulate.py --clients 200 --handoff-every 700
+    python simulate.py --clients 200 --restart-every 600 \\
+                       --handoff-every 700 --hung 0.2
+'''
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from twisted.spread import pb
+from twisted.internet import address, defer, task
+from twisted.python import failure
+
+import Server
+from admission import LoginAdmission
+from broadcast import BroadcastScheduler
+from heartbeat import HeartbeatWheel
+from helpbroker import HelpBroker
+from journal import PresenceJournal, sessionState
+from locations import HostLabs
+from presenceindex import CascaderIndex
+from presencelog import PresenceLog
+from subscriptions import SubscriptionIndex
+
+#clients log in spread out over this many seconds at the start
+LOGIN_SPREAD_SECS = 60
+#the changes in a broadcast storm are spread over this many seconds
+STORM_SPREAD_SECS = 2
+#the fraction of the clients that change in a storm
+STORM_FRACTION = 0.5
+#the fraction of the clients cut off in a disconnect cascade that come back
+#quickly enough that they may be able to resume their session
+QUICK_RECONNECT_FRACTION = 0.6
+#the fraction of cascaders that never answer a help request
+IGNORE_HELP_FRACTION = 0.2
+#how long a cascader takes to answer a help request
+MAX_HELP_ANSWER_SECS = 60
+
+#the fraction of the clients in each lab
+LABS = {'Level 5 West' : 0.3,
+        'Level 4 Lab' : 0.25,
+        'Level 5 North' : 0.2,
+        'Level 5 South' : 0.15,
+        '4.14a' : 0.05,
+        '4.07' : 0.05}
+
+#------------------------------------------------------------------------------
+# in memory networks
+
+class LoopbackReference(object):
+    '''
+    Stands in for a RemoteReference to an object at the other end of a
+    LoopbackConnection
+    '''
+
+    def __init__(self, connection, target):
+        self.connection = connection
+        self.target = target
+
+    @property
+    def broker(self):
+        return self.connection
+
+    def callRemote(self, name, *args, **kw):
+        return self.connection.call(self.target, name, args, kw)
+
+    def notifyOnDisconnect(self, callback):
+        self.connection.disconnectCallbacks.append(lambda: callback(self))
+
+
+class LoopbackConnection(object):
+    '''
+    An in memory connection between the server and a client. Referenceables
+    are passed as LoopbackReferences, like PB does, but nothing is
+    serialized (see copy). Calls and answers are delivered in order when
+    the network is pumped, and the calls are dispatched through
+    remoteMessageReceived like PB does (this class provides the serialize
+    and unserialize a broker would).
+    '''
+
+    def __init__(self, network):
+        self.network = network
+        self.connected = True
+        self.references = {}
+        #the deferreds of calls that haven't been answered
+        self.waiting = set()
+        self.disconnectCallbacks = []
+
+    @property
+    def transport(self):
+        return self
+
+    def reference(self, obj):
+        try:
+            return self.references[obj]
+        except KeyError:
+            ref = self.references[obj] = LoopbackReference(self, obj)
+            return ref
+
+    def _pass(self, value):
+        if isinstance(value, pb.Referenceable):
+            return self.reference(value)
+        return value
+
+    def copy(self, value):
+        '''
+        Passes the value to the other end. To keep this cheap only the value
+        itself, or if it is a list, tuple or dict the items in it, are passed
+        by reference. Anything else is shared rather than copied, so neither
+        end may change what it has been sent
+        '''
+        if type(value) in (list, tuple):
+            return type(value)([self._pass(v) for v in value])
+        if type(value) is dict:
+            return dict((k, self._pass(v)) for k, v in value.iteritems())
+        return self._pass(value)
+
+    def serialize(self, value, perspective=None):
+        if isinstance(value, defer.Deferred):
+            return value.addCallback(self.copy)
+        return self.copy(value)
+
+    def unserialize(self, value):
+        return value
+
+    def call(self, target, name, args, kw):
+        if not self.connected:
+            raise pb.DeadReferenceError('Calling Stale Broker')
+        args, kw = self.copy(args), self.copy(kw)
+        d = defer.Deferred()
+        self.waiting.add(d)
+        self.network.send(self, self._deliver, target, name, args, kw, d)
+        return d
+
+    def _deliver(self, target, name, args, kw, d):
+        try:
+            result = target.remoteMessageReceived(self, name, args, kw)
+        except:
+            result = failure.Failure()
+        if isinstance(result, defer.Deferred):
+            result.addBoth(self._sendAnswer, d)
+        else:
+            self._sendAnswer(result, d)
+
+    def _sendAnswer(self, result, d):
+        self.network.send(self, self._answer, d, result)
+
+    def _answer(self, d, result):
+        if d in self.waiting:
+            self.waiting.remove(d)
+            d.callback(result)
+
+    def loseConnection(self):
+        if not self.connected:
+            return
+        self.connected = False
+        waiting, self.waiting = self.waiting, set()
+        for d in waiting:
+            d.errback(pb.PBConnectionLost('Connection lost'))
+        for callback in self.disconnectCallbacks:
+            callback()
+
+
+class LoopbackNetwork(object):
+    ''' Connects clients to the root with LoopbackConnections '''
+
+    def __init__(self, root):
+        self.root = root
+        self.pending = []
+        self.stats = {'connections' : 0, 'messages' : 0}
+
+    def connect(self):
+        '''
+        Returns the new connection and a deferred that fires with a
+        reference to the root
+        '''
+        self.stats['connections'] += 1
+        connection = LoopbackConnection(self)
+        d = defer.Deferred()
+        self.send(connection, d.callback, connection.reference(self.root))
+        return connection, d
+
+    def send(self, connection, deliver, *args):
+        ''' Queues deliver to be called with args when the network is pumped '''
+        self.pending.append((connection, deliver, args))
+        self.stats['messages'] += 1
+
+    def pump(self):
+        ''' Delivers messages until there is nothing left to deliver '''
+        while self.pending:
+            pending, self.pending = self.pending, []
+            for connection, deliver, args in pending:
+                if connection.connected:
+                    deliver(*args)
+
+
+class LoopbackTransport(object):
+    '''
+    One end of an in memory connection between two PB brokers. Data written
+    is held until the network is pumped, at which point it is given to the
+    broker at the other end
+    '''
+
+    def __init__(self, network, host, peer):
+        self.network = network
+        self.host = host
+        self.peerAddress = peer
+        self.protocol = None
+        self.other = None
+        self.buffer = []
+        self.connected = True
+        self.disconnecting = False
+
+    def write(self, data):
+        if not self.connected:
+            return
+        if not self.buffer:
+            self.network.pending.append(self)
+        self.buffer.append(data)
+        self.network.stats['messages'] += 1
+        self.network.stats['bytes'] += len(data)
+
+    def writeSequence(self, data):
+        for d in data:
+            self.write(d)
+
+    def loseConnection(self):
+        self.network.disconnect(self)
+
+    abortConnection = loseConnection
+
+    def getPeer(self):
+        return self.peerAddress
+
+    def getHost(self):
+        return self.host
+
+
+class PBLoopbackNetwork(object):
+    '''
+    Connects clients to the root with real PB brokers joined by
+    LoopbackTransports. This is a lot slower than the LoopbackNetwork, but
+    everything is serialized as it would be on a real network
+    '''
+
+    def __init__(self, root):
+        self.serverFactory = pb.PBServerFactory(root)
+        self.pending = []
+        self.nextPort = 1
+        self.stats = {'connections' : 0, 'messages' : 0, 'bytes' : 0}
+
+    def connect(self):
+        ''' Returns the client's transport and the deferred root object '''
+        self.nextPort += 1
+        serverAddress = address.IPv4Address('TCP', '10.0.0.1', 5010)
+        clientAddress = address.IPv4Address('TCP', '10.1.0.1', self.nextPort)
+        clientFactory = pb.PBClientFactory()
+        serverProtocol = self.serverFactory.buildProtocol(clientAddress)
+        clientProtocol = clientFactory.buildProtocol(serverAddress)
+
+        serverTransport = LoopbackTransport(self, serverAddress, clientAddress)
+        clientTransport = LoopbackTransport(self, clientAddress, serverAddress)
+        serverTransport.other = clientTransport
+        clientTransport.other = serverTransport
+        serverTransport.protocol = serverProtocol
+        clientTransport.protocol = clientProtocol
+
+        self.stats['connections'] += 1
+        serverProtocol.makeConnection(serverTransport)
+        clientProtocol.makeConnection(clientTransport)
+        return clientTransport, clientFactory.getRootObject()
+
+    def disconnect(self, transport):
+        ''' Drops the connection at once, anything not yet delivered is lost '''
+        if not transport.connected:
+            return
+        reason = failure.Failure(pb.PBConnectionLost('Connection lost'))
+        for t in (transport, transport.other):
+            t.connected = False
+            t.buffer = []
+        for t in (transport, transport.other):
+            t.protocol.connectionLost(reason)
+
+    def pump(self):
+        ''' Delivers data until there is nothing left to deliver '''
+        while self.pending:
+            pending, self.pending = self.pending, []
+            for transport in pending:
+                data, transport.buffer = ''.join(transport.buffer), []
+                if data and transport.connected:
+                    transport.other.protocol.dataReceived(data)
+
+#------------------------------------------------------------------------------
+# clients
+
+class SimClient(pb.Referenceable):
+    '''
+    A client that does what the real one does (login, resume, sync, apply
+    presence batches, answer pings and help requests) with the decisions
+    made by the simulation's random number generator
+    '''
+
+    def __init__(self, sim, username, hostname, lab):
+        self.sim = sim
+        self.username = username
+        self.hostname = hostname
+        self.lab = lab
+
+        self.state = 'offline'
+        self.connection = None
+        self.server = None
+        self.resumeToken = None
+        self.epoch = None
+        self.version = None
+        self.hung = False
+        self.hungAt = None
+        #the server dropped the connection while the client was hung, which
+        #it only notices once it wakes up
+        self.lostWhileHung = False
+        #stops answering presence updates until the server disconnects it
+        self.stalled = False
+        #when the connection was lost, or None if it hasn't been since the
+        #last login
+        self.lostAt = None
+
+        rand = sim.rand
+        self.cascading = rand.random() < 0.5
+        self.subjects = set(rand.sample(sim.subjects, rand.randint(1, 3)))
+        #most clients only watch their own lab
+        subscription = rand.random()
+        if subscription < 0.15:
+            self.labs, self.subscribed = None, None
+        elif subscription < 0.7:
+            self.labs, self.subscribed = [lab], None
+        else:
+            self.labs = [lab]
+            self.subscribed = rand.sample(sim.subjects, 2)
+
+        #username -> (hostname, set of subjects)
+        self.view = {}
+        self.helpIds = 0
+
+    @property
+    def online(self):
+        return self.state == 'online' and not self.hung and not self.stalled
+
+    #--------------------------------------------------------------------------
+    # calls from the server
+
+    def remote_ping(self):
+        if self.hung:
+            return defer.Deferred()
+        return 'pong'
+
+    def remote_presenceChanged(self, batch):
+        self.sim.count('batchesReceived')
+        if self.stalled:
+            return defer.Deferred()
+        if self.state != 'online' or self.hung:
+            return
+        if batch['since'] != self.version:
+            self.sim.count('batchGaps')
+            self.server.callRemote('syncSince', self.epoch,
+                                   self.version).addCallback(self._applySync)
+            return
+        for username, hostname, subjects in batch['joined']:
+            self.view[username] = (hostname, set(subjects))
+        for username in batch['left'] + batch['usersLeft']:
+            self.view.pop(username, None)
+        for username, subjects in batch['added']:
+            if username in self.view:
+                self.view[username][1].update(subjects)
+        for username, subjects in batch['removed']:
+            if username in self.view:
+                self.view[username][1].difference_update(subjects)
+        self.version = batch['version']
+
+    def remote_userAskingForHelp(self, helpId, username, hostname, subject,
+                                 problem):
+        rand = self.sim.rand
+        if self.hung or rand.random() < IGNORE_HELP_FRACTION:
+            self.sim.count('helpIgnored')
+            return defer.Deferred()
+        answer = (rand.random() < 0.6, 'busy')
+        return task.deferLater(self.sim.clock,
+                               rand.uniform(1, MAX_HELP_ANSWER_SECS),
+                               lambda: answer)
+
+    def remote_serverSentMessage(self, helpId, message):
+        self.sim.count('serverMessages')
+
+    def remote_helpProgress(self, helpId, event, details):
+        if event in ('noAnswer', 'rejected'):
+            self.sim.count('helpPassedOn')
+
+    def remote_userSentMessage(self, helpId, message):
+        self.sim.count('userMessages')
+
+    #--------------------------------------------------------------------------
+    # things the client does
+
+    def login(self):
+        if self.state != 'offline' or self.hung:
+            return
+        self.state = 'connecting'
+        self.connection, d = self.sim.network.connect()
+        d.addCallback(self._connected, self.connection)
+        d.addCallbacks(self._joined, self._joinFailed)
+
+    def _connected(self, root, connection):
+        root.notifyOnDisconnect(lambda ref: self._connectionLost(connection))
+        return root.callRemote('userJoin', self, self.username, self.hostname,
+                               self.resumeToken, self.epoch, self.version)
+
+    def _connectionLost(self, connection):
+        ''' The server dropped the connection, so log in again shortly '''
+        if connection is not self.connection or self.state == 'offline':
+            return
+        if self.hung:
+            self.lostWhileHung = True
+            return
+        self.sim.count('droppedByServer')
+        self.state = 'offline'
+        self.stalled = False
+        self.lostAt = self.sim.clock.seconds()
+        self.sim.clock.callLater(
+                self.sim.rand.uniform(1, Server.PING_EVERY_SECS), self.login)
+
+    def _joined(self, result):
+        self.server = result['server']
+        self.resumeToken = result['resumeToken']
+        if result['resumed']:
+            self.sim.count('resumed')
+            self._applySync(result['sync'])
+            return
+        self.sim.count('loggedIn')
+        self.server.callRemote('setState', self.cascading, self.subjects)
+        d = self.server.callRemote('subscribe', self.labs, self.subscribed)
+        d.addCallbacks(self._applySync, self._failed)
+
+    def _joinFailed(self, reason):
+        self.state = 'offline'
+        self.connection.loseConnection()
+        if reason.check('Server.LoginBusy'):
+            self.sim.count('loginsBusy')
+            self.sim.clock.callLater(float(reason.value.args[0]), self.login)
+        else:
+            self._failed(reason)
+
+    def _failed(self, reason):
+        if not reason.check(pb.PBConnectionLost):
+            self.sim.count('clientErrors')
+            self.sim.error('%s: %s' % (self.username, reason.getErrorMessage()))
+
+    def _applySync(self, sync):
+        if sync['snapshot']:
+            self.view = {}
+        for username, hostname, subjects in sync['cascaders']:
+            self.view[username] = (hostname, set(subjects))
+        for username in sync['left']:
+            self.view.pop(username, None)
+        self.epoch = sync['epoch']
+        self.version = sync['version']
+        self.state = 'online'
+        self.lostAt = None
+
+    def setState(self, cascading, subjects):
+        if not self.online:
+            return
+        self._sendState(cascading, subjects)
+
+    def _sendState(self, cascading, subjects):
+        self.cascading = cascading
+        self.subjects = set(subjects)
+        self.sim.count('stateChanges')
+        self.server.callRemote('setState', self.cascading,
+                               self.subjects).addErrback(self._failed)
+
+    def wake(self):
+        '''
+        A hung client carries on as if nothing happened, calling the server
+        on the connection it had before noticing whether it was dropped
+        '''
+        self.hung = False
+        self.sim.count('woke')
+        if self.state == 'online':
+            try:
+                self._sendState(*self.sim._randomState())
+            except pb.DeadReferenceError:
+                self.sim.count('callsAfterDrop')
+        if self.lostWhileHung:
+            self.lostWhileHung = False
+            self._connectionLost(self.connection)
+        elif self.state == 'offline':
+            self.login()
+
+    def askForHelp(self):
+        if not self.online:
+            return
+        others = sorted(u for u in self.view if u != self.username)
+        if not others:
+            return
+        cascader = self.sim.rand.choice(others)
+        subject = sorted(self.view[cascader][1] or ['none'])[0]
+        self.helpIds += 1
+        helpId = (self.username, self.helpIds)
+        self.sim.count('helpAsked')
+
+        def onAnswer(result):
+            accepted, why, helper = result
+            if accepted:
+                self.sim.count('helpAccepted')
+                if not self.online:
+                    return
+                self.server.callRemote('sendMessage', helpId, helper,
+                                       'thanks').addErrback(lambda r: None)
+            elif why == 'No response':
+                self.sim.count('helpTimedOut')
+            else:
+                self.sim.count('helpRejected')
+
+        def onErr(reason):
+            if reason.check('Server.ClientNotConnected'):
+                self.sim.count('helpNotConnected')
+            elif reason.check(pb.PBConnectionLost):
+                self.sim.count('helpConnectionLost')
+            else:
+                self._failed(reason)
+
+        d = self.server.callRemote('askForHelp', helpId, cascader, subject,
+                                   'it does not work')
+        d.addCallbacks(onAnswer, onErr)
+
+    def dropConnection(self):
+        if self.state == 'offline':
+            return
+        self.state = 'offline'
+        self.lostAt = self.sim.clock.seconds()
+        self.connection.loseConnection()
+
+class SimHandoff(object):
+    '''
+    Stands in for the HandoffListener while the server is drained, keeping
+    what the old server passes on for the new one
+    '''
+
+    def __init__(self, sim, states):
+        self.sim = sim
+        #username -> state, as sent in the snapshot and then as changed
+        self.states = states
+        self.help = []
+
+    def record(self, session):
+        self.states[session.user] = sessionState(session)
+
+    def gone(self, username):
+        self.states.pop(username, None)
+
+    def recordHelp(self, state):
+        self.help.append(state)
+
+    def finished(self):
+        self.sim.tookOver(self)
+
+#------------------------------------------------------------------------------
+
+class Simulation(object):
+    def __init__(self, numClients, hours, seed=0, changeEvery=600,
+                 stormEvery=900, cascadeEvery=1200, helpEvery=30,
+                 hungFraction=0.01, stalledFraction=0.01, checkEvery=300,
+                 network=LoopbackNetwork, restartEvery=0, handoffEvery=0,
+                 sleepyFraction=0.01):
+        '''
+        changeEvery - the average seconds between a client changing its
+                      subjects or cascading state
+        stormEvery, cascadeEvery - seconds between broadcast storms and
+                                   disconnect cascades
+        helpEvery - seconds between help requests from all the clients
+        hungFraction - the fraction of clients that hang during the run
+        stalledFraction - the fraction of clients that stall during the run
+        checkEvery - seconds between checking the invariants
+        network - the class of network used between the clients and server
+        restartEvery - seconds between restarts of the server
+        handoffEvery - seconds between handing the server over to a new
+                       server process
+        sleepyFraction - the fraction of clients that hang for a while and
+                         then carry on during the run
+
+        Any of the intervals can be 0 for that thing never to happen
+        '''
+        self.duration = hours * 3600
+        self.changeEvery = changeEvery
+        self.rand = random.Random(seed)
+        self.clock = task.Clock()
+        self.counters = dict.fromkeys(['batchesReceived', 'batchGaps',
+                                       'loggedIn', 'resumed', 'loginsBusy',
+                                       'stateChanges', 'helpAsked',
+                                       'helpAccepted', 'helpRejected',
+                                       'helpTimedOut', 'helpIgnored',
+                                       'helpPassedOn',
+                                       'helpNotConnected',
+                                       'helpConnectionLost', 'serverMessages',
+                                       'userMessages', 'disconnects',
+                                       'storms', 'cascades', 'hung',
+                                       'woke', 'callsAfterDrop',
+                                       'stalled', 'droppedByServer',
+                                       'restarts', 'handoffs', 'checks',
+                                       'clientErrors'], 0)
+        self.violations = []
+        self.subjects = sorted(Server.subjectList)
+
+        self._resetServer()
+        Server.provisionalStats = dict.fromkeys(Server.provisionalStats, 0)
+        #the journal is only kept if the server is restarted
+        self.journalDir = None
+        self.restartedAt = None
+        if restartEvery > 0:
+            self.journalDir = tempfile.mkdtemp(prefix='simulate')
+            self._startJournal({})
+        self.network = network(Server.LoginService())
+
+        hostsLab = {}
+        self.clients = []
+        labs = sorted(LABS)
+        weights = [LABS[lab] for lab in labs]
+        for i in range(numClients):
+            lab = self._weightedChoice(labs, weights)
+            hostname = 'sim%d' % i
+            hostsLab[hostname] = lab
+            self.clients.append(SimClient(self, 'user%d' % i, hostname, lab))
+        Server.hostLabs.hostsLab = hostsLab
+
+        for client in self.clients:
+            self.clock.callLater(self.rand.uniform(0, LOGIN_SPREAD_SECS),
+                                 client.login)
+        for _ in range(int(numClients * hungFraction)):
+            self.clock.callLater(self.rand.uniform(0, self.duration),
+                                 self.hang)
+        for _ in range(int(numClients * sleepyFraction)):
+            self.clock.callLater(self.rand.uniform(0, self.duration),
+                                 self.sleep)
+        for _ in range(int(numClients * stalledFraction)):
+            self.clock.callLater(self.rand.uniform(0, self.duration),
+                                 self.stall)
+
+        if changeEvery > 0:
+            self._every(1, self.churn)
+        self._every(helpEvery, self.askForHelp)
+        self._every(stormEvery, self.storm)
+        self._every(cascadeEvery, self.cascade)
+        self._every(restartEvery, self.restart)
+        self._every(handoffEvery, self.handOver)
+        self._every(checkEvery, self.check)
+
+    def _resetServer(self):
+        ''' Gives the server a fresh set of globals driven by the clock '''
+        for logger in [Server.logger] + Server.LOG_CATEGORIES.values():
+            logger.setLevel(logging.WARNING)
+        Server.clock = self.clock
+        Server.users = {}
+        Server.hostLabs = HostLabs()
+        Server.subscriptions = SubscriptionIndex()
+        Server.cascaderIndex = CascaderIndex(Server.hostLabs)
+        Server.presenceLog = PresenceLog(Server.DELTA_LOG_SIZE)
+        Server.presenceLog.epoch = 'simulated-%d' % (
+                self.counters['restarts'] + self.counters['handoffs'])
+        Server.broadcaster = BroadcastScheduler(Server.users,
+                                                Server.BROADCAST_WINDOW_SECS,
+                                                Server.presenceLog,
+                                                Server.subscriptions,
+                                                Server.hostLabs,
+                                                clock=self.clock)
+        Server.heartbeats = HeartbeatWheel(Server.PING_EVERY_SECS,
+                                           Server.TIMEOUT_SECS,
+                                           Server.HEARTBEAT_TICK_SECS,
+                                           clock=self.clock)
+        Server.heartbeats.start()
+        Server.loginAdmission = LoginAdmission(Server.MAX_LOGINS_IN_FLIGHT,
+                                               Server.LOGIN_HOLD_SECS,
+                                               Server.MAX_LOGIN_RETRY_SECS,
+                                               clock=self.clock)
+        Server.helpBroker = HelpBroker(Server.helpCandidates, Server.offerHelp,
+                                       Server.helpProgress,
+                                       Server.HELP_ATTEMPT_SECS,
+                                       Server.HELP_TIMEOUT_SECS,
+                                       Server.HELP_RETRY_SECS,
+                                       clock=self.clock)
+        Server.helpBroker.start()
+        Server.outboundStats = dict.fromkeys(Server.outboundStats, 0)
+        Server.journal = None
+        Server.handoff = None
+        Server.instrumentation.reset()
+
+    def _startJournal(self, states):
+        ''' Starts journaling, after putting back the users in states '''
+        if self.journalDir is None:
+            Server.restoreSessions(states.values())
+            return
+        Server.journal = PresenceJournal(
+                os.path.join(self.journalDir, 'presence.journal'),
+                Server.localSessions, Server.JOURNAL_COMPACT_SECS,
+                Server.JOURNAL_MAX_RECORDS, clock=self.clock)
+        Server.restoreSessions(states.values())
+        Server.journal.start()
+
+    def _weightedChoice(self, items, weights):
+        r = self.rand.uniform(0, sum(weights))
+        for item, weight in zip(items, weights):
+            r -= weight
+            if r <= 0:
+                return item
+        return items[-1]
+
+    def _every(self, interval, f):
+        ''' Calls f every interval seconds, or never if interval isn't positive '''
+        if interval <= 0:
+            return
+        loop = task.LoopingCall(f)
+        loop.clock = self.clock
+        loop.start(interval, now=False)
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def error(self, message):
+        self.violations.append('%8.1fs %s' % (self.clock.seconds(), message))
+
+    def _online(self):
+        return [c for c in self.clients if c.online]
+
+    #--------------------------------------------------------------------------
+    # what happens during the simulation
+
+    def _randomState(self):
+        return (self.rand.random() < 0.6,
+                self.rand.sample(self.subjects, self.rand.randint(1, 3)))
+
+    def churn(self):
+        ''' Run every second, changes the state of a few clients '''
+        online = self._online()
+        expected = len(online) / float(self.changeEvery)
+        changes = int(expected) + (self.rand.random() < expected % 1)
+        for client in self.rand.sample(online, min(changes, len(online))):
+            client.setState(*self._randomState())
+
+    def storm(self):
+        ''' Lots of clients change at about the same time '''
+        self.count('storms')
+        online = self._online()
+        for client in self.rand.sample(online,
+                                       int(len(online) * STORM_FRACTION)):
+            self.clock.callLater(self.rand.uniform(0, STORM_SPREAD_SECS),
+                                 client.setState, *self._randomState())
+
+    def cascade(self):
+        '''
+        Every client in a lab loses its connection. Most come back quickly
+        enough to try and resume their session, the rest come back later
+        '''
+        self.count('cascades')
+        lab = self.rand.choice(sorted(LABS))
+        for client in self.clients:
+            if client.lab != lab or client.state == 'offline' or client.hung:
+                continue
+            self.count('disconnects')
+            client.dropConnection()
+            if self.rand.random() < QUICK_RECONNECT_FRACTION:
+                delay = self.rand.uniform(1, Server.PING_EVERY_SECS)
+            else:
+                delay = self.rand.uniform(60, 600)
+            self.clock.callLater(delay, client.login)
+
+    def hang(self, client=None):
+        ''' A client stops answering the server but stays connected '''
+        if client is None:
+            online = self._online()
+            if not online:
+                return
+            client = self.rand.choice(online)
+        self.count('hung')
+        client.hung = True
+        client.hungAt = self.clock.seconds()
+
+    def sleep(self):
+        '''
+        A client hangs for long enough to be logged out and then wakes up
+        and carries on
+        '''
+        online = self._online()
+        if online:
+            client = self.rand.choice(online)
+            self.hang(client)
+            timeout = Server.PING_EVERY_SECS + Server.TIMEOUT_SECS
+            self.clock.callLater(self.rand.uniform(timeout, 3 * timeout),
+                                 client.wake)
+
+    def stall(self):
+        ''' A client stops answering presence updates but stays connected '''
+        online = self._online()
+        if online:
+            self.count('stalled')
+            self.rand.choice(online).stalled = True
+
+    def restart(self):
+        '''
+        The server crashes and is started again. Every client loses its
+        connection and comes back shortly, resuming its session from the
+        users the server put back from its journal
+        '''
+        if Server.handoff is not None:
+            return
+        self.count('restarts')
+        Server.journal.stop()
+        self._replaceServer(Server.journal.load())
+
+    def handOver(self):
+        '''
+        A new server process takes over. The old one is sent everyone logged
+        in and drains its clients over the drain time, which reconnect to it
+        as there is only one server here. Once it has finished the new
+        server starts with what the old one passed on
+        '''
+        if Server.handoff is not None:
+            return
+        self.count('handoffs')
+        Server.handoff = SimHandoff(self, dict(
+                (s.user, sessionState(s)) for s in Server.localSessions()))
+        Server.drainClients()
+
+    def tookOver(self, handoff):
+        self._replaceServer(handoff.states, handoff.help)
+
+    def _replaceServer(self, states, helpStates=()):
+        '''
+        Stops everything the old server had running and starts a new one,
+        with the users in states and the help requests in helpStates put
+        back. Every client loses its connection and comes back shortly
+        '''
+        self.restartedAt = self.clock.seconds()
+        #stop everything the old server had running
+        Server.heartbeats.stop()
+        pending = Server.broadcaster.pending
+        if pending is not None and pending.active():
+            pending.cancel()
+        #the help requests go with the server, without being answered
+        Server.helpBroker.stop()
+        for request in Server.helpBroker.requests.values():
+            for call in (request.attemptCall, request.deadlineCall):
+                if call is not None and call.active():
+                    call.cancel()
+        for session in Server.users.values():
+            if not session.provisional:
+                session.outbound.close()
+            session.stale = True
+        for client in self.clients:
+            if client.state == 'offline':
+                continue
+            client.dropConnection()
+            if not client.hung:
+                self.clock.callLater(
+                        self.rand.uniform(1, Server.PING_EVERY_SECS),
+                        client.login)
+
+        #the outbound and help stats are kept over the restart, so they count
+        #for the whole run, as are the labs of the hosts
+        outboundStats, hostsLab = Server.outboundStats, Server.hostLabs.hostsLab
+        helpStats = Server.helpBroker.stats
+        self._resetServer()
+        Server.outboundStats = outboundStats
+        Server.helpBroker.stats = helpStats
+        Server.hostLabs.hostsLab = hostsLab
+        #the users the old server put back went with it
+        Server.provisionalStats['waiting'] = 0
+        self._startJournal(states)
+        for state in helpStates:
+            Server.handedOverHelp(state)
+
+    def askForHelp(self):
+        online = self._online()
+        if online:
+            self.rand.choice(online).askForHelp()
+
+    #--------------------------------------------------------------------------
+
+    def check(self):
+        '''
+        Checks that:
+            - the servers indexes agree with the logged in users
+            - the count of users put back after a restart that are waiting
+              for their clients is right
+            - every logged in user is in the heartbeat wheel once
+            - no more logins are in flight than are allowed
+            - every client that is online is logged in and its list of
+              cascaders is the same as the server would send it
+            - clients that have hung or lost their connection have been
+              logged out once they have had time to time out, and users put
+              back after a restart whose clients haven't come back have
+              expired
+            - no session holds more calls than it is allowed to, or has been
+              behind for longer than a slow client is allowed
+            - no help request has been held for longer than it is allowed
+
+        The pending presence changes are sent out first, so the clients are
+        up to date. While the server is being drained the clients keep the
+        users that have moved to the new server, so their lists aren't
+        compared.
+        '''
+        self.count('checks')
+        Server.broadcaster.flush()
+        self.network.pump()
+
+        users = Server.users
+        #the users put back after a restart don't have a client
+        connected = dict((u, s) for u, s in users.iteritems()
+                         if not s.provisional)
+        if set(connected) != set(Server.subscriptions.interests):
+            self.error('Subscriptions don\'t match the logged in users')
+        cascading = set(u for u, s in users.iteritems() if s.cascading)
+        if cascading != Server.cascaderIndex.cascaders:
+            self.error('Cascader index doesn\'t match the logged in users')
+        if any(s.stale for s in users.itervalues()):
+            self.error('Logged out session still in the users')
+        provisional = len(users) - len(connected)
+        if Server.provisionalStats['waiting'] != provisional:
+            self.error('%d users put back are counted as waiting, not %d'
+                       % (Server.provisionalStats['waiting'], provisional))
+
+        wheel = Server.heartbeats
+        if set(wheel.slotOf) != set(connected.itervalues()):
+            self.error('Heartbeat sessions don\'t match the logged in users')
+        if sum(len(slot) for slot in wheel.slots) != len(wheel.slotOf):
+            self.error('Sessions are in more than one heartbeat slot')
+        for session, index in wheel.slotOf.iteritems():
+            if session not in wheel.slots[index]:
+                self.error('%s is not in its heartbeat slot' % session.user)
+
+        admission = Server.loginAdmission
+        if len(admission.inFlight) > admission.maxInFlight:
+            self.error('%d logins in flight' % len(admission.inFlight))
+
+        now = self.clock.seconds()
+        for session in connected.itervalues():
+            outbound = session.outbound
+            if len(outbound) > outbound.maxQueued:
+                self.error('%s has %d calls held' % (session.user,
+                                                     len(outbound)))
+            if (outbound.behindSince is not None and
+                    now - outbound.behindSince > outbound.slowSecs + 1):
+                self.error('%s has been behind for %.0fs'
+                           % (session.user, now - outbound.behindSince))
+
+        for request in Server.helpBroker.requests.itervalues():
+            if now - request.asked > Server.HELP_TIMEOUT_SECS:
+                self.error('The help request from %s has been held for %.0fs'
+                           % (request.student, now - request.asked))
+
+        #the longest a session can take to be logged out after the client
+        #has gone quiet
+        deadline = (Server.PING_EVERY_SECS + Server.TIMEOUT_SECS +
+                    2 * Server.HEARTBEAT_TICK_SECS)
+        #subscription -> the cascaders a client with it should have
+        expectedFor = {}
+        for client in self.clients:
+            session = users.get(client.username)
+            if client.online:
+                if session is None:
+                    self.error('%s is online but not logged in'
+                               % client.username)
+                    continue
+                interests = Server.subscriptions.interests.get(client.username)
+                try:
+                    expected = expectedFor[interests]
+                except KeyError:
+                    expected = expectedFor[interests] = dict(
+                            (u, (h, set(s))) for u, h, s in
+                            session._cascaderList(
+                                    session._subscribedCascaders()))
+                if client.view != expected and Server.handoff is None:
+                    self.error('%s has the wrong cascaders' % client.username)
+            elif session is not None:
+                allowed = deadline
+                if session.provisional:
+                    quietSince = self.restartedAt
+                    allowed = Server.PROVISIONAL_SECS
+                elif client.hung:
+                    quietSince = client.hungAt
+                else:
+                    quietSince = client.lostAt
+                if quietSince is not None and now - quietSince > allowed:
+                    self.error('%s still logged in %.0fs after going quiet'
+                               % (client.username, now - quietSince))
+
+    def run(self):
+        ''' Runs the simulation to the end, returning the wall time taken '''
+        start = time.time()
+        while True:
+            self.network.pump()
+            calls = self.clock.getDelayedCalls()
+            if not calls:
+                break
+            due = calls[0].getTime()
+            if due > self.duration:
+                break
+            self.clock.advance(due - self.clock.seconds())
+        self.check()
+        if self.journalDir is not None:
+            Server.journal.stop()
+            shutil.rmtree(self.journalDir, ignore_errors=True)
+        return time.time() - start
+
+    def results(self):
+        ''' The counters from the run, which are the same for every run '''
+        methods = Server.instrumentation.snapshot()['methods']
+        calls = dict((name, stats['calls'])
+                     for name, stats in methods.iteritems() if stats['calls'])
+        errors = dict((name, stats['errors'])
+                      for name, stats in methods.iteritems() if stats['errors'])
+        return {'simulatedSecs' : self.clock.seconds(),
+                'clients' : len(self.clients),
+                'loggedInAtEnd' : len(Server.users),
+                'events' : dict(self.counters),
+                'network' : dict(self.network.stats),
+                'broadcast' : dict(Server.broadcaster.stats,
+                                   fanoutTotal=Server.broadcaster.fanoutTotal),
+                'heartbeat' : {'pings' : Server.heartbeats.stats['pings'],
+                               'expired' : Server.heartbeats.stats['expired'],
+                               'sweeps' : Server.heartbeats.stats['sweeps']},
+                'admission' : dict(Server.loginAdmission.stats),
+                'outbound' : dict(Server.outboundStats),
+                'provisional' : dict(Server.provisionalStats),
+                'help' : dict(Server.helpBroker.stats),
+                'calls' : calls,
+                'callErrors' : errors,
+                'violations' : len(self.violations)}
+
+
+def printResults(results, out, prefix=''):
+    for name, value in sorted(results.items()):
+        if isinstance(value, dict):
+            printResults(value, out, prefix + name + '.')
+        elif isinstance(value, float):
+            out.write('%-45s %12.1f\n' % (prefix + name, value))
+        else:
+            out.write('%-45s %12d\n' % (prefix + name, value))
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('', '--clients', type='int', default=1000,
+                      help='the number of clients')
+    parser.add_option('', '--hours', type='float', default=1,
+                      help='the simulated time to run for')
+    parser.add_option('', '--seed', type='int', default=0,
+                      help='seeds the random choices, the same seed gives '
+                           'the same counters')
+    parser.add_option('', '--change-every', type='float', default=600,
+                      help='average seconds between a client changing state')
+    parser.add_option('', '--storm-every', type='float', default=900,
+                      help='seconds between broadcast storms')
+    parser.add_option('', '--cascade-every', type='float', default=1200,
+                      help='seconds between disconnect cascades')
+    parser.add_option('', '--help-every', type='float', default=30,
+                      help='seconds between help requests')
+    parser.add_option('', '--hung', type='float', default=0.01,
+                      help='the fraction of clients that hang')
+    parser.add_option('', '--sleepy', type='float', default=0.01,
+                      help='the fraction of clients that hang for longer '
+                           'than the heartbeat timeout and then carry on')
+    parser.add_option('', '--stalled', type='float', default=0.01,
+                      help='the fraction of clients that stop answering '
+                           'presence updates')
+    parser.add_option('', '--restart-every', type='float', default=0,
+                      help='seconds between restarts of the server')
+    parser.add_option('', '--handoff-every', type='float', default=0,
+                      help=('seconds between handing the server over to a '
+                            'new server process'))
+    parser.add_option('', '--check-every', type='float', default=300,
+                      help='seconds between checking the invariants')
+    parser.add_option('', '--pb', action='store_true',
+                      help=('connect the clients with real PB brokers, which '
+                            'is slower but serializes everything'))
+    parser.add_option('', '--json', action='store_true',
+                      help='print the counters as json')
+    (options, args) = parser.parse_args()
+
+    sim = Simulation(options.clients, options.hours, options.seed,
+                     options.change_every, options.storm_every,
+                     options.cascade_every, options.help_every,
+                     options.hung, options.stalled, options.check_every,
+                     PBLoopbackNetwork if options.pb else LoopbackNetwork,
+                     options.restart_every, options.handoff_every,
+                     options.sleepy)
+    taken = sim.run()
+    results = sim.results()
+
+    if options.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        printResults(results, sys.stdout)
+    sys.stderr.write('%.0f simulated seconds took %.1fs (%.0fx real time)\n'
+                     % (results['simulatedSecs'], taken,
+                        results['simulatedSecs'] / taken))
+    for violation in sim.violations[:50]:
+        sys.stderr.write(violation + '\n')
+    if sim.violations:
+        sys.stderr.write('%d invariants broken\n' % len(sim.violations))
+        sys.exit(1)
@@ -0,0 +1,105 @@
+'''
+Keeps track of which labs and subjects each client is watching so that
+presence events only need to be sent to the clients that care about them
+'''
+from collections import defaultdict
+
+class SubscriptionIndex(object):
+    '''
+    Inverted indexes from lab and from subject to the usernames of the
+    clients subscribed to them.
+
+    A subscription of None for the labs or subjects means that the client
+    wants everything, which is the default for a client that has never
+    subscribed
+    '''
+
+    def __init__(self):
+        self.byLab = defaultdict(set)
+        self.bySubject = defaultdict(set)
+        self.allLabs = set()
+        self.allSubjects = set()
+
+        #username -> (labs, subjects)
+        self.interests = {}
+
+    def subscribe(self, username, labs=None, subjects=None):
+        '''
+        Replaces any existing subscription for the user
+
+        >>> si = SubscriptionIndex()
+        >>> si.subscribe('a', ['lab'], None)
+        >>> si.subscribe('b', None, ['inf2a'])
+        >>> sorted(si.subscribers('lab', ['inf2a']))
+        ['a', 'b']
+        >>> sorted(si.subscribers('otherlab', ['inf2a']))
+        ['b']
+        >>> sorted(si.subscribers('lab', ['inf2b']))
+        ['a']
+        '''
+        self.unsubscribe(username)
+
+        labs = None if labs is None else frozenset(labs)
+        subjects = None if subjects is None else frozenset(subjects)
+        self.interests[username] = (labs, subjects)
+
+        self._add(self.byLab, self.allLabs, labs, username)
+        self._add(self.bySubject, self.allSubjects, subjects, username)
+
+    def unsubscribe(self, username):
+        '''
+        >>> si = SubscriptionIndex()
+        >>> si.subscribe('a', ['lab'], ['inf2a'])
+        >>> si.unsubscribe('a')
+        >>> si.subscribers('lab', ['inf2a'])
+        set([])
+        '''
+        try:
+            labs, subjects = self.interests.pop(username)
+        except KeyError:
+            return
+        self._remove(self.byLab, self.allLabs, labs, username)
+        self._remove(self.bySubject, self.allSubjects, subjects, username)
+
+    def isInterested(self, username, lab, subjects):
+        ''' Tests a single users subscription '''
+        try:
+            labs, subs = self.interests[username]
+        except KeyError:
+            return False
+        if labs is not None and lab not in labs:
+            return False
+        if subs is not None and subjects is not None and not subs & set(subjects):
+            return False
+        return True
+
+    def subscribers(self, lab, subjects=None):
+        '''
+        Returns the set of usernames that are interested in a cascader in
+        the given lab with any of the given subjects. If subjects is None
+        then only the lab is matched
+        '''
+        result = self.allLabs | self.byLab.get(lab, set())
+        if subjects is None or not result:
+            return result
+
+        subjectSubs = set(self.allSubjects)
+        for subject in subjects:
+            subjectSubs |= self.bySubject.get(subject, set())
+        return result & subjectSubs
+
+    def _add(self, index, everything, keys, username):
+        if keys is None:
+            everything.add(username)
+        else:
+            for key in keys:
+                index[key].add(username)
+
+    def _remove(self, index, everything, keys, username):
+        if keys is None:
+            everything.discard(username)
+        else:
+            for key in keys:
+                index[key].discard(username)
+                if not index[key]:
+                    del index[key]
@@ -0,0 +1,168 @@
+'''
+Records when a help request passes through the server, so that when help is
+slow it is possible to see which hop is slow. The clients record the same
+kind of events (see cascaders/core/tracing.py in the client), and the lines
+the two write must stay the same so that they can be merged. The server
+keeps its own copy of the helpers as it is run without the client.
+
+Events are logged as lines containing
+    TRACE {"helpId": ..., "event": ..., "time": ...}
+
+Run this file with the server log and any client trace files to merge the
+events into a timeline for each help request along with the latency
+percentiles of each hop:
+    python tracing.py cascader.log client-trace.log
+
+The times come from the clock of the machine that recorded them, so hops
+between machines are only as accurate as the clocks are in sync.
+'''
+from __future__ import with_statement
+
+import json
+import logging
+import sys
+import time
+from collections import defaultdict
+from optparse import OptionParser
+
+logger = logging.getLogger('MyLogger.trace')
+
+#starts the json of an event in a line of a log
+TRACE_MARKER = 'TRACE '
+
+class TraceEvent(object):
+    ''' Only turned into json if it is actually logged '''
+    def __init__(self, helpId, event, fields):
+        self.fields = fields
+        fields['helpId'] = traceKey(helpId)
+        fields['event'] = event
+        fields['time'] = time.time()
+
+    def __str__(self):
+        return TRACE_MARKER + json.dumps(self.fields)
+
+def traceKey(helpId):
+    '''
+    The helpId as a string, as the helpId is a tuple of the username and an
+    id
+
+    >>> traceKey(('user', 12))
+    'user/12'
+    '''
+    if isinstance(helpId, (tuple, list)):
+        return '/'.join(str(part) for part in helpId)
+    return str(helpId)
+
+def trace(helpId, event, **fields):
+    ''' Records that the event happened to the help request now '''
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('%s', TraceEvent(helpId, event, fields))
+
+def percentile(values, fraction):
+    '''
+    The value that the fraction of the values are at or below
+
+    >>> percentile([3, 1, 2, 4], 0.5)
+    2
+    >>> percentile([1, 2, 3, 4], 0.99)
+    4
+    >>> percentile([], 0.5)
+    0
+    '''
+    if not values:
+        return 0
+    values = sorted(values)
+    index = max(0, int(len(values) * fraction + 0.5) - 1)
+    return values[min(index, len(values) - 1)]
+
+#------------------------------------------------------------------------------
+# merging traces
+
+def readEvents(lines):
+    '''
+    Returns the trace events found in the lines, ignoring everything else
+
+    >>> [e['event'] for e in readEvents(
+    ...     ['x - TRACE {"helpId": "a/1", "event": "e", "time": 1}',
+    ...      'something else'])]
+    [u'e']
+    '''
+    for line in lines:
+        index = line.find(TRACE_MARKER)
+        if index == -1:
+            continue
+        try:
+            yield json.loads(line[index + len(TRACE_MARKER):])
+        except ValueError:
+            continue
+
+def timelines(events):
+    ''' Returns a dict of helpId to its events sorted by time '''
+    byHelpId = defaultdict(list)
+    for event in events:
+        byHelpId[event['helpId']].append(event)
+    for helpEvents in byHelpId.values():
+        helpEvents.sort(key=lambda e: e['time'])
+    return byHelpId
+
+def hopLatencies(byHelpId):
+    '''
+    Returns a dict of (from event, to event) to the list of seconds taken
+    between them, plus ('start', 'end') for the whole of each request
+    '''
+    hops = defaultdict(list)
+    for helpEvents in byHelpId.values():
+        for prev, cur in zip(helpEvents, helpEvents[1:]):
+            hops[(prev['event'], cur['event'])].append(cur['time'] - prev['time'])
+        if len(helpEvents) > 1:
+            hops[('start', 'end')].append(helpEvents[-1]['time'] -
+                                          helpEvents[0]['time'])
+    return hops
+
+def printTimeline(helpId, helpEvents, out):
+    out.write('%s\n' % helpId)
+    start = helpEvents[0]['time']
+    for event in helpEvents:
+        extra = ', '.join('%s=%s' % (k, v) for k, v in sorted(event.items())
+                          if k not in ('helpId', 'event', 'time'))
+        out.write('  %+9.3fs %-40s %s\n' % (event['time'] - start,
+                                            event['event'], extra))
+
+def printPercentiles(hops, out):
+    out.write('%-75s %6s %9s %9s %9s\n' % ('hop', 'count', 'p50', 'p90', 'p99'))
+    for (src, dst), values in sorted(hops.items()):
+        out.write('%-75s %6d %8.3fs %8.3fs %8.3fs\n' %
+                  (src + ' -> ' + dst, len(values),
+                   percentile(values, 0.5), percentile(values, 0.9),
+                   percentile(values, 0.99)))
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] tracefile...')
+    parser.add_option('-t', '--timelines', action='store_true',
+                      help='print the timeline of every help request')
+    parser.add_option('', '--help-id',
+                      help='only print the timeline for this help request')
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error('No trace files given')
+
+    events = []
+    for filename in args:
+        with open(filename) as f:
+            events.extend(readEvents(f))
+    byHelpId = timelines(events)
+
+    if options.help_id:
+        if options.help_id not in byHelpId:
+            parser.error('No events for ' + options.help_id)
+        printTimeline(options.help_id, byHelpId[options.help_id], sys.stdout)
+        sys.exit(0)
+
+    if options.timelines:
+        for helpId, helpEvents in sorted(byHelpId.items()):
+            printTimeline(helpId, helpEvents, sys.stdout)
+        sys.stdout.write('\n')
+
+    sys.stdout.write('%d help requests, %d events\n' % (len(byHelpId),
+                                                        len(events)))
+    printPercentiles(hopLatencies(byHelpId), sys.stdout)
@@ -0,0 +1,125 @@
+'''
+Runs the server as several worker processes. Every worker listens on the
+same port with SO_REUSEPORT, so the kernel spreads new connections over
+them, and each worker owns the connections it accepts. The workers share
+who is logged in through the broker (see broker.py and cluster.py), which
+the supervisor runs in its own process alongside starting the workers.
+'''
+import logging
+import os
+import socket
+import sys
+
+from twisted.internet import defer, error, protocol, reactor
+
+logger = logging.getLogger('MyLogger')
+
+#not in the socket module of older pythons, this is the value on linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+#how long the supervisor waits before restarting a worker that has died
+RESTART_SECS = 1
+
+def listenAdopted(port, factory, backlog=50, interface='', reusePort=False):
+    '''
+    Listens on the port like reactor.listenTCP, but on a socket made here
+    and adopted by the reactor. Unlike with listenTCP, the socket isn't shut
+    down when the port stops listening, so another process it has been
+    passed to (see handoff.py) carries on accepting connections on it. With
+    reusePort other processes can listen on the same port as well
+    '''
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reusePort:
+            s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        s.bind((interface, port))
+        s.listen(backlog)
+        s.setblocking(False)
+        #the reactor takes a copy of the socket
+        return reactor.adoptStreamPort(s.fileno(), socket.AF_INET, factory)
+    finally:
+        s.close()
+
+def listenReusePort(port, factory, backlog=50, interface=''):
+    ''' Listens on the port, allowing other processes to listen on it too '''
+    return listenAdopted(port, factory, backlog, interface, reusePort=True)
+
+def workerFilename(filename, workerId):
+    '''
+    The file a worker uses in place of filename, so workers don't write over
+    each other
+
+    >>> workerFilename('cascader.log', 2)
+    'cascader-2.log'
+    '''
+    base, ext = os.path.splitext(filename)
+    return '%s-%d%s' % (base, workerId, ext)
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, supervisor, workerId):
+        self.supervisor = supervisor
+        self.workerId = workerId
+
+    def processEnded(self, reason):
+        self.supervisor.ended(self.workerId, reason)
+
+
+class Supervisor(object):
+    '''
+    Starts the workers, each running script with args and --worker ID, and
+    restarts any that die until the reactor shuts down
+    '''
+
+    def __init__(self, numWorkers, script, args):
+        self.numWorkers = numWorkers
+        self.script = script
+        self.args = list(args)
+        self.stopping = False
+        #worker id -> the IProcessTransport of the running worker
+        self.processes = {}
+        #the deferreds to fire once every worker has stopped
+        self.waiting = []
+        self.stats = {'started' : 0, 'restarted' : 0}
+
+    def start(self):
+        for workerId in range(self.numWorkers):
+            self._spawn(workerId)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def _spawn(self, workerId):
+        if self.stopping:
+            return
+        argv = ([sys.executable, self.script] + self.args +
+                ['--worker', str(workerId)])
+        self.processes[workerId] = reactor.spawnProcess(
+                WorkerProcess(self, workerId), sys.executable, argv,
+                env=os.environ, childFDs={0 : 0, 1 : 1, 2 : 2})
+        self.stats['started'] += 1
+
+    def ended(self, workerId, reason):
+        del self.processes[workerId]
+        if self.stopping:
+            if not self.processes:
+                waiting, self.waiting = self.waiting, []
+                [d.callback(None) for d in waiting]
+            return
+        logger.warn('Worker %d died (%s), restarting it', workerId,
+                    reason.getErrorMessage())
+        self.stats['restarted'] += 1
+        reactor.callLater(RESTART_SECS, self._spawn, workerId)
+
+    def stop(self):
+        ''' Stops the workers, returning a deferred that fires once they have '''
+        self.stopping = True
+        if not self.processes:
+            return defer.succeed(None)
+        for process in self.processes.values():
+            try:
+                process.signalProcess('TERM')
+            except error.ProcessExitedAlready:
+                pass
+        d = defer.Deferred()
+        self.waiting.append(d)
+        return d